@@ -2,20 +2,32 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import importlib.util
 import logging
 from abc import ABC, abstractmethod
-from collections.abc import AsyncIterator
+from collections import deque
+from collections.abc import AsyncIterator, Iterable
 from copy import deepcopy
 from functools import cached_property as ft_cached_property
 from functools import wraps
-from typing import Any
+from itertools import islice
+from typing import TYPE_CHECKING, Any
 
-from httpx import AsyncClient, HTTPStatusError
+from httpx import AsyncClient, HTTPStatusError, Limits, Timeout, TimeoutException
+
+from ..cache.local import LocalCache
+
+if TYPE_CHECKING:
+    from ..core.config import ServicesModel
 
 log = logging.getLogger(__name__)
 
 NextPageParams = tuple[str, dict] | tuple[None, None]
 
+# The request errors which are logged and replaced by a default value
+HTTP_ERRORS = (HTTPStatusError, TimeoutException)
+
 
 def handle_http_error(default_factory):
     def exception_handler(f):
@@ -23,7 +35,7 @@ def handle_http_error(default_factory):
         async def wrapper(*args, **kw):
             try:
                 return await f(*args, **kw)
-            except HTTPStatusError as e:
+            except HTTP_ERRORS as e:
                 log.warning("Request failed: %s", e)
                 return default_factory()
 
@@ -32,6 +44,51 @@ def handle_http_error(default_factory):
     return exception_handler
 
 
+def single_flight(f):
+    """Share one call between the concurrent identical calls of a coroutine function.
+
+    While a call is in flight, the callers with the same arguments wait for its result instead of
+    sending their own request. Nothing is kept once the call is done, use it above the cache
+    decorator.
+    """
+    in_flight = {}
+
+    @wraps(f)
+    async def wrapper(*args, **kw):
+        key = (args, tuple(sorted(kw.items())))
+        try:
+            future = in_flight.get(key)
+        except TypeError:
+            # Unhashable arguments, don't bother
+            return await f(*args, **kw)
+        if future is None:
+            future = in_flight[key] = asyncio.ensure_future(f(*args, **kw))
+            future.add_done_callback(lambda _: in_flight.pop(key, None))
+        # A caller going away must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    return wrapper
+
+
+def get_client_kwargs(services: "ServicesModel") -> dict[str, Any]:
+    """Return the arguments for the proxy of a service, from the services settings."""
+    pool = services.http_pool
+    http2 = pool.http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        log.warning("HTTP/2 is enabled but the h2 package is missing, falling back to HTTP/1.1")
+        http2 = False
+    return {
+        "max_concurrent_requests": services.max_concurrent_requests,
+        "http2": http2,
+        "limits": Limits(
+            max_connections=pool.max_connections,
+            max_keepalive_connections=pool.max_keepalive_connections,
+            keepalive_expiry=pool.keepalive_expiry,
+        ),
+        "timeout": Timeout(None, connect=pool.connect_timeout, read=pool.read_timeout),
+    }
+
+
 class PaginationRecursionError(RuntimeError):
     pass
 
@@ -40,8 +97,21 @@ class APIClient(ABC):
     payload_field: str | None
     """The payload field in a paginated response."""
 
-    def __init__(self, base_url: str | None = None, **kwargs):
+    cache_scope: str | None = None
+    """The scope of the cache settings for this API."""
+
+    max_concurrent_pages: int = 5
+    """How many pages are fetched at the same time when the number of pages is known."""
+
+    def __init__(
+        self, base_url: str | None = None, max_concurrent_requests: int | None = None, **kwargs
+    ):
         self.base_url = base_url
+        # Hot lookups are answered without leaving the process
+        self.local_cache = LocalCache(self.cache_scope)
+        self._requests_semaphore = (
+            asyncio.Semaphore(max_concurrent_requests) if max_concurrent_requests else None
+        )
 
         kwargs.setdefault("timeout", None)
         if self.api_url is not None:
@@ -89,9 +159,29 @@ class APIClient(ABC):
         """
         raise NotImplementedError()
 
+    def determine_remaining_pages_params(
+        self, url: str, params: dict, result: dict
+    ) -> list[tuple[str, dict]] | None:
+        """Determine parameters for all the remaining pages, if the API allows it.
+
+        Override this if the number of pages is known from the first result, the remaining pages
+        will then be fetched concurrently.
+
+        :param url:     API endpoint URL
+        :param params:  Query parameters of the first page
+        :param result:  Result dictionary of the first page
+        :return:        List of (URL, params dict) tuples for the remaining pages, or None if the
+                        pages must be fetched one after the other
+        """
+        return None
+
     async def get(self, url: str, **kwargs) -> Any:
         """Query the API for a single result."""
-        response = await self.client.get(url, **kwargs)
+        if self._requests_semaphore is None:
+            response = await self.client.get(url, **kwargs)
+        else:
+            async with self._requests_semaphore:
+                response = await self.client.get(url, **kwargs)
         response.raise_for_status()
         return response.json()
 
@@ -108,19 +198,52 @@ class APIClient(ABC):
             # determine_next_page_params may modify this, ensure original object stays untouched
             params = deepcopy(params)
 
-        visited_urls_params = set()
+        result = await self.get(url, params=params, **kwargs)
 
-        while url:
-            result = await self.get(url, params=params, **kwargs)
+        remaining_pages = self.determine_remaining_pages_params(url, params, result)
+        if remaining_pages is not None:
+            for item in self.extract_payload(result, payload_field=payload_field):
+                yield item
+            async for result in self._get_pages(remaining_pages, **kwargs):
+                for item in self.extract_payload(result, payload_field=payload_field):
+                    yield item
+            return
+
+        visited_urls_params = set()
 
+        while True:
             visited_urls_params.add((url, repr(params)))
 
             for item in self.extract_payload(result, payload_field=payload_field):
                 yield item
 
             url, params = self.determine_next_page_params(url, params, result)
+            if not url:
+                break
 
             if (url, repr(params)) in visited_urls_params:
                 raise PaginationRecursionError(
                     f"Paginated results seem to cause recursion: {url=!r} {params=!r}"
                 )
+
+            result = await self.get(url, params=params, **kwargs)
+
+    async def _get_pages(self, pages: Iterable[tuple[str, dict]], **kwargs) -> AsyncIterator:
+        """Fetch pages concurrently, and yield their results in order."""
+        pages = iter(pages)
+        pending = deque()
+
+        def fetch_more():
+            for url, params in islice(pages, self.max_concurrent_pages - len(pending)):
+                pending.append(asyncio.ensure_future(self.get(url, params=params, **kwargs)))
+
+        try:
+            fetch_more()
+            while pending:
+                result = await pending.popleft()
+                # Keep fetching while the caller processes this page
+                fetch_more()
+                yield result
+        finally:
+            for task in pending:
+                task.cancel()
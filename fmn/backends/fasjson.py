@@ -2,20 +2,25 @@
 #
 # SPDX-License-Identifier: MIT
 
-import asyncio
 import logging
 import re
 from functools import cache as ft_cache
 from functools import cached_property as ft_cached_property
-from itertools import chain
 from typing import TYPE_CHECKING, Any
 
 from cashews import cache
 from httpx_gssapi import HTTPSPNEGOAuth
 
-from ..cache.util import cache_ttl, get_pattern_for_cached_calls
+from ..cache.local import local_cached
+from ..cache.util import cache_ttl, delete_tags
 from ..core.config import get_settings
-from .base import APIClient, NextPageParams, handle_http_error
+from .base import (
+    APIClient,
+    NextPageParams,
+    get_client_kwargs,
+    handle_http_error,
+    single_flight,
+)
 
 if TYPE_CHECKING:
     from fedora_messaging.message import Message
@@ -29,14 +34,16 @@ class FASJSONAsyncProxy(APIClient):
 
     API_VERSION = "v1"
 
+    cache_scope = "fasjson"
+
     FAS_TOPIC_RE = re.compile(
         r"fas\.(?P<usergroup>user|group)\.(?P<event>member\.sponsor|create|update)$"
     )
 
     payload_field = "result"
 
-    def __init__(self, base_url: str) -> None:
-        super().__init__(base_url=base_url, auth=HTTPSPNEGOAuth())
+    def __init__(self, base_url: str, **kwargs) -> None:
+        super().__init__(base_url=base_url, auth=HTTPSPNEGOAuth(), **kwargs)
 
     @ft_cached_property
     def api_url(self) -> str:
@@ -51,7 +58,20 @@ class FASJSONAsyncProxy(APIClient):
 
         return None, None
 
-    @cache(ttl=cache_ttl("fasjson"), prefix="v1")
+    def determine_remaining_pages_params(
+        self, url: str, params: dict, result: dict
+    ) -> list[tuple[str, dict]] | None:
+        if "page" not in result or not {"page_number", "total_pages"} <= result["page"].keys():
+            return None
+        return [
+            (url, {**params, "page_number": page_number})
+            for page_number in range(
+                result["page"]["page_number"] + 1, result["page"]["total_pages"] + 1
+            )
+        ]
+
+    @single_flight
+    @cache(ttl=cache_ttl("fasjson"), prefix="v2", tags=["{self}:search_users"])
     async def search_users(
         self,
         username: str | None = None,
@@ -64,17 +84,24 @@ class FASJSONAsyncProxy(APIClient):
             params["username__exact"] = username__exact
         return [user async for user in self.get_paginated("/search/users/", params=params)]
 
-    @cache(ttl=cache_ttl("fasjson"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("fasjson"), prefix="v2", tags=["{self}:user:{username}"])
     async def get_user(self, *, username: str) -> dict:
         return await self.get_payload(f"/users/{username}/")
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("fasjson"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("fasjson"), prefix="v2", tags=["{self}:user_groups:{username}"])
     async def get_user_groups(self, *, username: str) -> dict:
         return await self.get_payload(f"/users/{username}/groups/")
 
+    def may_invalidate(self, message: "Message") -> bool:
+        return bool(self.FAS_TOPIC_RE.search(message.topic))
+
     async def invalidate_on_message(self, message: "Message", db: "AsyncSession") -> None:
-        if not self.FAS_TOPIC_RE.search(message.topic):
+        if not self.may_invalidate(message):
             # Bail out early
             log.debug("Skipping message with topic %s", message.topic)
             return
@@ -83,37 +110,27 @@ class FASJSONAsyncProxy(APIClient):
             log.warning("No information found about affected user")
             return
 
-        del_keys = [
-            key
-            for pattern in chain(
-                get_pattern_for_cached_calls(self.search_users, self=self, username__exact=None),
-                get_pattern_for_cached_calls(
-                    self.search_users, self=self, username__exact=msg_user
-                ),
-                get_pattern_for_cached_calls(self.get_user, self=self, username=msg_user),
-                get_pattern_for_cached_calls(self.get_user_groups, self=self, username=msg_user),
-            )
-            async for key, _ in cache.get_match(pattern)
+        # The cache entries are tagged, see the cache decorators above. Tags can't be made from
+        # arguments which may be None, all the searches are tagged the same.
+        tags = [
+            f"{self}:search_users",
+            f"{self}:user:{msg_user}",
+            f"{self}:user_groups:{msg_user}",
         ]
+        self.local_cache.invalidate(self.get_user, username=msg_user)
+        self.local_cache.invalidate(self.get_user_groups, username=msg_user)
 
-        # Delete the things in parallel
-        del_tasks = [asyncio.create_task(cache.delete(key)) for key in del_keys]
-        del_results = await asyncio.gather(*del_tasks, return_exceptions=True)
-
-        # Follow-up care
-
-        if exceptions_in_results := [
-            result for result in del_results if isinstance(result, Exception)
-        ]:
+        if failed := await delete_tags(tags):
             log.warning(
-                "Deleting %d cache entries yielded %d exception(s):",
-                len(del_results),
-                len(exceptions_in_results),
+                "Deleting the cache entries of %d tags yielded %d exception(s):",
+                len(tags),
+                len(failed),
             )
-            for exc in exceptions_in_results:
-                log.warning("\t%r", exc)
+            for tag, exc in failed.items():
+                log.warning("\t%s: %r", tag, exc)
 
 
 @ft_cache
 def get_fasjson_proxy() -> FASJSONAsyncProxy:
-    return FASJSONAsyncProxy(get_settings().services.fasjson_url)
+    services = get_settings().services
+    return FASJSONAsyncProxy(services.fasjson_url, **get_client_kwargs(services))
@@ -3,21 +3,26 @@
 # SPDX-License-Identifier: MIT
 
 import asyncio
-import bisect
 import logging
 import re
 from enum import IntFlag, auto
 from functools import cache as ft_cache
 from functools import cached_property as ft_cached_property
-from itertools import chain
 from typing import TYPE_CHECKING, Any
 
 from cashews import cache
 from httpx import URL, QueryParams
 
-from ..cache.util import cache_ttl, get_pattern_for_cached_calls
+from ..cache.local import local_cached
+from ..cache.util import cache_ttl, delete_tags
 from ..core.config import get_settings
-from .base import APIClient, NextPageParams, handle_http_error
+from .base import (
+    APIClient,
+    NextPageParams,
+    get_client_kwargs,
+    handle_http_error,
+    single_flight,
+)
 
 if TYPE_CHECKING:
     from fedora_messaging.message import Message
@@ -61,6 +66,8 @@ class PagureAsyncProxy(APIClient):
 
     API_VERSION = "0"
 
+    cache_scope = "pagure"
+
     PROJECT_TOPIC_RE = re.compile(
         r"pagure\.project\.(?P<usergroup>user|group)\.(?P<action>access\.updated|added|removed)$"
     )
@@ -82,7 +89,9 @@ class PagureAsyncProxy(APIClient):
         return None, None
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("pagure"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("pagure"), prefix="v2", tags=["{self}:projects"])
     async def get_projects(
         self,
         *,
@@ -111,7 +120,9 @@ class PagureAsyncProxy(APIClient):
         ]
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("pagure"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("pagure"), prefix="v2")
     async def get_user_projects(self, *, username: str) -> list[dict[str, Any]]:
         return [
             p
@@ -123,7 +134,9 @@ class PagureAsyncProxy(APIClient):
         ]
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("pagure"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("pagure"), prefix="v2", tags=["{self}:project_users:{project_path}"])
     async def get_project_users(
         self, *, project_path: str, roles: PagureRole = PagureRole.USER_ROLES_MAINTAINER
     ) -> list[str]:
@@ -138,7 +151,9 @@ class PagureAsyncProxy(APIClient):
         return sorted(usernames)
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("pagure"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("pagure"), prefix="v2", tags=["{self}:project_groups:{project_path}"])
     async def get_project_groups(
         self, *, project_path: str, roles: PagureRole = PagureRole.GROUP_ROLES_MAINTAINER
     ) -> list[str]:
@@ -153,7 +168,9 @@ class PagureAsyncProxy(APIClient):
         return sorted(groupnames)
 
     @handle_http_error(list)
-    @cache(ttl=cache_ttl("pagure"), prefix="v1")
+    @local_cached
+    @single_flight
+    @cache(ttl=cache_ttl("pagure"), prefix="v2", tags=["{self}:group_projects:{name}"])
     async def get_group_projects(
         self, *, name: str, acl: PagureRole | None = None
     ) -> list[dict[str, Any]]:
@@ -166,17 +183,24 @@ class PagureAsyncProxy(APIClient):
                 if role & acl
             ]
 
-        seen_fullnames = set()
-        sorted_projects = []
-        for params in params_seq:
-            async for project in self.get_paginated(
-                f"/group/{name}", params=params, payload_field="projects"
-            ):
-                if (fullname := project["fullname"]) in seen_fullnames:
-                    continue
-                seen_fullnames.add(fullname)
-                bisect.insort(sorted_projects, project, key=lambda p: p["fullname"])
-        return sorted_projects
+        async def _get_projects(params):
+            return [
+                project
+                async for project in self.get_paginated(
+                    f"/group/{name}", params=params, payload_field="projects"
+                )
+            ]
+
+        # The listings for the different roles overlap, and the pages can too: keep the first
+        # occurrence of each project and sort them once.
+        projects_by_fullname = {}
+        for projects in await asyncio.gather(*(_get_projects(params) for params in params_seq)):
+            for project in projects:
+                projects_by_fullname.setdefault(project["fullname"], project)
+        return sorted(projects_by_fullname.values(), key=lambda p: p["fullname"])
+
+    def may_invalidate(self, message: "Message") -> bool:
+        return bool(self.PROJECT_TOPIC_RE.search(message.topic))
 
     async def invalidate_on_message(self, message: "Message", db: "AsyncSession") -> None:
         topic = message.topic
@@ -208,10 +232,8 @@ class PagureAsyncProxy(APIClient):
             log.debug("Skipping message for different Pagure instance %s", full_url)
             return
 
-        # These keys describe cache entries to be deleted
-        del_keys = []
-
-        # Identify cache entries to be invalidated and create tasks for their deletion
+        # The cache entries are tagged, see the cache decorators above. Tags can't be made from
+        # arguments which may be None, all the projects listings are tagged the same.
 
         if usergroup == "user":
             # Messages about changes to project users
@@ -224,20 +246,14 @@ class PagureAsyncProxy(APIClient):
                 log.warning("No affected user found when processing message")
                 return
 
-            del_keys = [
-                key
-                for pattern in chain(
-                    get_pattern_for_cached_calls(
-                        self.get_project_users, self=self, project_path=fullname
-                    ),
-                    get_pattern_for_cached_calls(
-                        self.get_projects, self=self, username=None, owner=None
-                    ),
-                    get_pattern_for_cached_calls(self.get_projects, self=self, username=user),
-                    get_pattern_for_cached_calls(self.get_projects, self=self, owner=user),
-                )
-                async for key, _ in cache.get_match(pattern)
+            tags = [
+                f"{self}:project_users:{fullname}",
+                f"{self}:projects",
             ]
+            self.local_cache.invalidate(self.get_project_users, project_path=fullname)
+            self.local_cache.invalidate(self.get_projects, username=None, owner=None)
+            self.local_cache.invalidate(self.get_projects, username=user)
+            self.local_cache.invalidate(self.get_projects, owner=user)
         else:  # usergroup == "group"
             # Messages about changes to project groups
             if action == "removed":
@@ -251,35 +267,24 @@ class PagureAsyncProxy(APIClient):
                 log.warning("No affected group found when processing message")
                 return
 
-            del_keys = [
-                key
-                for pattern in chain(
-                    get_pattern_for_cached_calls(
-                        self.get_project_groups, self=self, project_path=fullname
-                    ),
-                    get_pattern_for_cached_calls(self.get_group_projects, self=self, name=group),
-                )
-                async for key, _ in cache.get_match(pattern)
+            tags = [
+                f"{self}:project_groups:{fullname}",
+                f"{self}:group_projects:{group}",
             ]
+            self.local_cache.invalidate(self.get_project_groups, project_path=fullname)
+            self.local_cache.invalidate(self.get_group_projects, name=group)
 
-        # Delete the things in parallel
-        del_tasks = [asyncio.create_task(cache.delete(key)) for key in del_keys]
-        del_results = await asyncio.gather(*del_tasks, return_exceptions=True)
-
-        # Follow-up care
-
-        if exceptions_in_results := [
-            result for result in del_results if isinstance(result, Exception)
-        ]:
+        if failed := await delete_tags(tags):
             log.warning(
-                "Deleting %d cache entries yielded %d exception(s):",
-                len(del_results),
-                len(exceptions_in_results),
+                "Deleting the cache entries of %d tags yielded %d exception(s):",
+                len(tags),
+                len(failed),
             )
-            for exc in exceptions_in_results:
-                log.warning("\t%r", exc)
+            for tag, exc in failed.items():
+                log.warning("\t%s: %r", tag, exc)
 
 
 @ft_cache
 def get_distgit_proxy() -> PagureAsyncProxy:
-    return PagureAsyncProxy(get_settings().services.distgit_url)
+    services = get_settings().services
+    return PagureAsyncProxy(services.distgit_url, **get_client_kwargs(services))
@@ -0,0 +1,251 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import logging
+from collections.abc import Iterable
+from time import monotonic
+from typing import TYPE_CHECKING, Any
+
+from cashews.ttl import ttl_to_seconds
+
+from ..cache.util import cache_arg
+from ..core.constants import ArtifactType
+from .base import HTTP_ERRORS
+from .pagure import PagureAsyncProxy, PagureRole
+
+if TYPE_CHECKING:
+    from fedora_messaging.message import Message
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+log = logging.getLogger(__name__)
+
+# How long to wait before fetching the snapshot again when it failed, in seconds
+RETRY_DELAY = 300
+
+
+class OwnershipIndex:
+    """Who has access to the projects of a dist-git instance.
+
+    The projects are indexed by their full name, and by the users and groups having access to them.
+    """
+
+    def __init__(self, projects: Iterable[dict[str, Any]] = ()):
+        self.projects = {}
+        self._by_user = {}
+        self._by_group = {}
+        for project in projects:
+            self.set_project(project)
+
+    def set_project(self, project: dict[str, Any]):
+        fullname = project["fullname"]
+        self._unindex(fullname)
+        project = {
+            "name": project["name"],
+            "namespace": project["namespace"],
+            "fullname": fullname,
+            "access_users": project.get("access_users", {}),
+            "access_groups": project.get("access_groups", {}),
+        }
+        self.projects[fullname] = project
+        for usernames in project["access_users"].values():
+            for username in usernames:
+                self._by_user.setdefault(username, set()).add(fullname)
+        for groupnames in project["access_groups"].values():
+            for groupname in groupnames:
+                self._by_group.setdefault(groupname, set()).add(fullname)
+
+    def _unindex(self, fullname: str):
+        project = self.projects.pop(fullname, None)
+        if project is None:
+            return
+        for reverse, access in (
+            (self._by_user, project["access_users"]),
+            (self._by_group, project["access_groups"]),
+        ):
+            # The same name can appear in several roles
+            for name in {name for names in access.values() for name in names}:
+                fullnames = reverse[name]
+                fullnames.discard(fullname)
+                if not fullnames:
+                    del reverse[name]
+
+    @staticmethod
+    def _has_access(access: dict[str, list[str]], name: str, roles: PagureRole) -> bool:
+        return any(name in access.get(role.name.lower(), ()) for role in PagureRole if role & roles)
+
+    def _get_projects(self, fullnames: set[str]) -> list[dict[str, Any]]:
+        return [self.projects[fullname] for fullname in sorted(fullnames)]
+
+    def get_user_projects(
+        self, username: str, roles: PagureRole = PagureRole.USER_ROLES_MAINTAINER
+    ) -> list[dict[str, Any]]:
+        return self._get_projects(
+            {
+                fullname
+                for fullname in self._by_user.get(username, ())
+                if self._has_access(self.projects[fullname]["access_users"], username, roles)
+            }
+        )
+
+    def get_group_projects(self, name: str, acl: PagureRole | None = None) -> list[dict[str, Any]]:
+        roles = acl or PagureRole.GROUP_ROLES
+        return self._get_projects(
+            {
+                fullname
+                for fullname in self._by_group.get(name, ())
+                if self._has_access(self.projects[fullname]["access_groups"], name, roles)
+            }
+        )
+
+    def _get_names(self, access: dict[str, list[str]], roles: PagureRole) -> list[str]:
+        return sorted(
+            {
+                name
+                for role in PagureRole
+                if role & roles
+                for name in access.get(role.name.lower(), ())
+            }
+        )
+
+    def get_project_users(self, project_path: str, roles: PagureRole) -> list[str] | None:
+        """Return the users with access to a project, or ``None`` if it is not in the index."""
+        if (project := self.projects.get(project_path)) is None:
+            return None
+        return self._get_names(project["access_users"], roles)
+
+    def get_project_groups(self, project_path: str, roles: PagureRole) -> list[str] | None:
+        """Return the groups with access to a project, or ``None`` if it is not in the index."""
+        if (project := self.projects.get(project_path)) is None:
+            return None
+        return self._get_names(project["access_groups"], roles)
+
+
+class PagureSnapshotProxy:
+    """Answer the ownership queries from a snapshot of the whole dist-git instance.
+
+    Instead of querying dist-git for each user, group and project, all the projects of the artifact
+    namespaces are fetched once and indexed locally. The index is kept current with the messages
+    about changes to the projects' users and groups, and fetched again in the background after the
+    ``pagure`` cache TTL, while the previous index is still used. Until the first snapshot could be
+    fetched, the queries are passed on to the wrapped proxy, as are the other calls.
+    """
+
+    def __init__(self, proxy: PagureAsyncProxy):
+        self._proxy = proxy
+        self._index = None
+        self._expires_at = 0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    def __getattr__(self, name: str):
+        return getattr(self._proxy, name)
+
+    async def _fetch_namespace(self, namespace: str) -> list[dict[str, Any]]:
+        return [
+            project
+            async for project in self._proxy.get_paginated(
+                "/projects",
+                params={"namespace": namespace, "short": False, "fork": False},
+                payload_field="projects",
+            )
+        ]
+
+    async def _fetch(self):
+        async with self._lock:
+            if monotonic() < self._expires_at:
+                # Fetched while waiting for the lock
+                return
+            log.debug("Fetching the ownership snapshot from %s", self._proxy)
+            # Wait for all the namespaces even if one fails, don't leave requests behind
+            namespaces = await asyncio.gather(
+                *(self._fetch_namespace(artifact_type.value) for artifact_type in ArtifactType),
+                return_exceptions=True,
+            )
+            for result in namespaces:
+                if isinstance(result, HTTP_ERRORS):
+                    log.warning(
+                        "Could not fetch the ownership snapshot from %s: %s", self._proxy, result
+                    )
+                    self._expires_at = monotonic() + RETRY_DELAY
+                    return
+                if isinstance(result, BaseException):
+                    raise result
+            self._index = OwnershipIndex(project for projects in namespaces for project in projects)
+            ttl = ttl_to_seconds(cache_arg("ttl", "pagure")())
+            self._expires_at = monotonic() + ttl
+
+    def _on_refreshed(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Could not refresh the ownership snapshot", exc_info=task.exception())
+
+    async def get_index(self) -> OwnershipIndex | None:
+        """Return the current ownership index, or ``None`` if there isn't any yet."""
+        if self._index is None:
+            # Nothing to serve meanwhile, wait for the first snapshot
+            await self._fetch()
+        elif monotonic() >= self._expires_at and (
+            self._refresh_task is None or self._refresh_task.done()
+        ):
+            self._refresh_task = asyncio.create_task(self._fetch())
+            self._refresh_task.add_done_callback(self._on_refreshed)
+        return self._index
+
+    async def get_user_projects(self, *, username: str) -> list[dict[str, Any]]:
+        index = await self.get_index()
+        if index is None:
+            return await self._proxy.get_user_projects(username=username)
+        return index.get_user_projects(username)
+
+    async def get_group_projects(
+        self, *, name: str, acl: PagureRole | None = None
+    ) -> list[dict[str, Any]]:
+        index = await self.get_index()
+        if index is None:
+            return await self._proxy.get_group_projects(name=name, acl=acl)
+        return index.get_group_projects(name, acl)
+
+    async def get_project_users(
+        self, *, project_path: str, roles: PagureRole = PagureRole.USER_ROLES_MAINTAINER
+    ) -> list[str]:
+        index = await self.get_index()
+        users = None if index is None else index.get_project_users(project_path, roles)
+        if users is None:
+            return await self._proxy.get_project_users(project_path=project_path, roles=roles)
+        return users
+
+    async def get_project_groups(
+        self, *, project_path: str, roles: PagureRole = PagureRole.GROUP_ROLES_MAINTAINER
+    ) -> list[str]:
+        index = await self.get_index()
+        groups = None if index is None else index.get_project_groups(project_path, roles)
+        if groups is None:
+            return await self._proxy.get_project_groups(project_path=project_path, roles=roles)
+        return groups
+
+    def may_invalidate(self, message: "Message") -> bool:
+        return self._proxy.may_invalidate(message)
+
+    async def invalidate_on_message(self, message: "Message", db: "AsyncSession") -> None:
+        await self._proxy.invalidate_on_message(message, db)
+        if self._index is None or not self.may_invalidate(message):
+            return
+        project = message.body.get("project") or {}
+        fullname = project.get("fullname")
+        if not fullname or not project.get("full_url", "").startswith(
+            self._proxy.base_url_with_trailing_slash
+        ):
+            return
+        if not ArtifactType.has_value(project.get("namespace")):
+            return
+        if "access_users" not in project or "access_groups" not in project:
+            try:
+                project = await self._proxy.get(fullname)
+            except HTTP_ERRORS as e:
+                log.warning("Could not update %s in the ownership snapshot: %s", fullname, e)
+                # Fetch the whole snapshot again next time
+                self._expires_at = 0
+                return
+        self._index.set_project(project)
+        log.debug("Updated the access to %s in the ownership snapshot", fullname)
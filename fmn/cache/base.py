@@ -5,9 +5,11 @@
 import asyncio
 import io
 import logging
+from collections.abc import Coroutine
 from datetime import datetime
 from time import monotonic
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
+from uuid import uuid4
 
 from cashews import cache
 from cashews.key import get_cache_key_template
@@ -28,7 +30,13 @@ cache_db_session_maker = make_session_maker()
 
 
 class CachedValue:
-    """Manage a cached value."""
+    """Manage a cached value.
+
+    If the scope has a ``stale_ttl``, the value is kept that long past its ``ttl``. An expired value
+    is still served during this time while a single rebuild runs in the background, the
+    ``*_with_state()`` methods tell whether the value they return is stale. Past ``stale_ttl``,
+    getting the value waits for it to be rebuilt.
+    """
 
     name = None
     cache_version = "v1"
@@ -37,20 +45,129 @@ class CachedValue:
     def __init__(self):
         # Define the function here instead of wrapping it in a regular async function because the
         # cashew decorators are designed to wrap once on init, and do a lot of pre-processing.
-        self.get_value = cache.locked(key=self.name, ttl=lock_ttl(self.name))(
+        self._get_value = cache.locked(key=self.name, ttl=lock_ttl(self.name))(
             # Don't use the lock=True option of the decorator because it does not allow to set
             # the ttl for the lock itself.
-            cache(key=self.name, prefix=self.cache_version, ttl=cache_ttl(self.name))(
+            cache(key=self.name, prefix=self.cache_version, ttl=self._storage_ttl)(
                 self.compute_value
             )
         )
         self._cache_key = get_cache_key_template(
-            self.get_value, key=self.name, prefix=self.cache_version
+            self._get_value, key=self.name, prefix=self.cache_version
         )
+        # The version is bumped every time a new value is stored, so that the processes holding a
+        # local copy of the value know when to fetch it again.
+        self._version_key = f"{self._cache_key}:version"
+        self._computed = 0
+        # The version of the value this process last computed
+        self._computed_version = None
+        self._local_value = None
+        self._local_stale = False
+        self._local_version = None
+        self._local_expires_at = 0
+        self._revalidation = None
         cache_db_session_maker.configure(bind=get_engine())
 
+    def _stale_seconds(self) -> float:
+        stale_ttl = cache_arg("stale_ttl", self.name)()
+        return ttl_to_seconds(stale_ttl) if stale_ttl else 0
+
+    def _storage_ttl(self, *args, **kwargs) -> float:
+        """Return how long the value is stored: its TTL, and how long it may then be served."""
+        return ttl_to_seconds(cache_ttl(self.name)()) + self._stale_seconds()
+
+    async def get_value(self, db: "AsyncSession"):
+        value, _stale = await self.get_value_with_state(db=db)
+        return value
+
+    async def get_value_with_state(self, db: "AsyncSession") -> tuple[Any, bool]:
+        """Return the value, and whether it is stale: expired and being rebuilt."""
+        stale_seconds = self._stale_seconds()
+        if stale_seconds:
+            value = await cache.get(self._cache_key)
+            if value is not None:
+                stale = 0 <= await cache.get_expire(self._cache_key) <= stale_seconds
+                if stale:
+                    log.debug(f"Serving the stale {self.name} cache while it is rebuilt")
+                    self._revalidate()
+                return value, stale
+        computed = self._computed
+        value = await self._get_value(db=db)
+        if self._computed != computed:
+            # The value has just been computed and stored
+            self._computed_version = await self._bump_version()
+        return value, False
+
+    async def _bump_version(self) -> int:
+        return await cache.incr(self._version_key)
+
+    def peek_local_value(self):
+        """Return the local copy of the value if it is recent enough, without any I/O.
+
+        Returns ``None`` if there is no such copy.
+        """
+        if self._local_value is None or monotonic() >= self._local_expires_at:
+            return None
+        return self._local_value
+
+    async def get_local_value(self, db: "AsyncSession"):
+        value, _stale = await self.get_local_value_with_state(db=db)
+        return value
+
+    async def get_local_value_with_state(self, db: "AsyncSession") -> tuple[Any, bool]:
+        """Return the value, from a copy held in this process if it is still current.
+
+        The local copy is used for ``local_ttl`` without asking the cache, then it is only fetched
+        again if the version of the value has changed in the cache in the meantime, or if the value
+        has expired from the cache: expiring does not change the version.
+
+        Also return whether the value is stale, see :meth:`get_value_with_state`.
+        """
+        local_ttl = cache_arg("local_ttl", self.name)()
+        if not local_ttl:
+            return await self.get_value_with_state(db=db)
+        value = self.peek_local_value()
+        if value is not None:
+            return value, self._local_stale
+        version, expire = await asyncio.gather(
+            cache.get(self._version_key), cache.get_expire(self._cache_key)
+        )
+        if (
+            self._local_value is None
+            or version is None
+            or version != self._local_version
+            # The value is not in the cache anymore, or is stale
+            or expire <= self._stale_seconds()
+        ):
+            self._local_value, self._local_stale = await self.get_value_with_state(db=db)
+            # If the value was just computed the version has changed, and will be checked again
+            # next time.
+            self._local_version = version
+        self._local_expires_at = monotonic() + ttl_to_seconds(local_ttl)
+        return self._local_value, self._local_stale
+
+    def _revalidate(self):
+        """Rebuild the value in the background, unless this process is already doing it."""
+        if self._revalidation is not None and not self._revalidation.done():
+            return
+        self._revalidation = self._run_in_background(self._revalidate_once())
+
+    async def _revalidate_once(self):
+        # Only one process rebuilds the value, the others keep serving the stale one meanwhile.
+        lock_key = f"{self._cache_key}:revalidate"
+        token = str(uuid4())
+        if not await cache.set_lock(lock_key, token, expire=ttl_to_seconds(lock_ttl(self.name)())):
+            return
+        try:
+            # Another process may have rebuilt it in the meantime
+            if await cache.get_expire(self._cache_key) <= self._stale_seconds():
+                await self.rebuild()
+        finally:
+            await cache.unlock(lock_key, token)
+
     async def compute_value(self, db: "AsyncSession"):
         log.debug(f"Building the {self.name} cache")
+        self._computed += 1
         before = monotonic()
         now = datetime.utcnow().replace(microsecond=0).isoformat()
         value = await self._compute_value(db=db)
@@ -70,7 +187,8 @@ class CachedValue:
             return
         ttl_early = ttl_to_seconds(ttl_early)
         refreshed = False
-        expire = await cache.get_expire(self._cache_key)
+        # The time left before the value expires, not before it is removed
+        expire = await cache.get_expire(self._cache_key) - self._stale_seconds()
         if expire <= ttl_to_seconds(ttl_early):
             await self.rebuild()
             refreshed = True
@@ -82,20 +200,25 @@ class CachedValue:
         We don't pass the database session here because it is run in the background and we want to
         use our own connection pool.
         """
+        return await cache.locked(key=f"{self.name}:rebuild", ttl=lock_ttl(self.name))(
+            self._rebuild
+        )()
 
-        async def _rebuild():
-            async with cache_db_session_maker.begin() as db:
-                ttl = ttl_to_seconds(cache_arg("ttl", self.name)())
-                value = await self.compute_value(db=db)
-                await cache.set(self._cache_key, value=value, expire=ttl)
-
-        return await cache.locked(key=f"{self.name}:rebuild", ttl=lock_ttl(self.name))(_rebuild)()
+    async def _rebuild(self):
+        # Must be called with the rebuild lock held
+        async with cache_db_session_maker.begin() as db:
+            value = await self.compute_value(db=db)
+            await cache.set(self._cache_key, value=value, expire=self._storage_ttl())
+            await self._bump_version()
 
     async def invalidate(self, db: "AsyncSession"):
         # This does not really invalidate the cache, instead it rebuilds it in the background
         # because rebuilding is very expensive.
         log.debug(f"Rebuilding the {self.name} cache in the background")
-        task = asyncio.create_task(self.rebuild())
+        self._run_in_background(self.rebuild())
+
+    def _run_in_background(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
         self._background_tasks.add(task)
 
         def _on_task_done(task):
@@ -107,6 +230,11 @@ class CachedValue:
                 log.error(tb.getvalue())
 
         task.add_done_callback(_on_task_done)
+        return task
+
+    def may_invalidate(self, message: "Message") -> bool:
+        """Tell whether a message may invalidate the cache, without any I/O."""
+        raise NotImplementedError
 
     async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
         raise NotImplementedError
@@ -114,3 +242,4 @@ class CachedValue:
     async def delete(self):
         log.debug(f"Deleting the {self.name} cache")
         await cache.delete(self._cache_key)
+        await self._bump_version()
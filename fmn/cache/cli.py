@@ -16,6 +16,7 @@ from ..rules.requester import Requester
 from . import configure_cache
 from .rules import RulesCache
 from .tracked import TrackedCache
+from .util import delete_keys
 
 
 @click.group("cache")
@@ -61,9 +62,13 @@ def delete_locks():
 
     async def _do_it():
         configure_cache()
-        async for key in cache.scan("locked:*"):
-            await cache.delete(key)
-            click.echo(f"Deleted lock for {key[7:]}")
+        keys = [key async for key in cache.scan("locked:*")]
+        failed = await delete_keys(keys)
+        for key in keys:
+            if key in failed:
+                click.echo(f"Could not delete lock for {key[7:]}: {failed[key]}")
+            else:
+                click.echo(f"Deleted lock for {key[7:]}")
 
     asyncio.run(_do_it())
     click.echo("Cache locks deleted.")
@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from functools import wraps
+from time import monotonic
+from typing import Any
+
+from cashews import cache
+from cashews.ttl import ttl_to_seconds
+
+from .util import cache_arg
+
+MISSING = object()
+
+
+class LocalCache:
+    """A bounded in-process cache, in front of the shared one.
+
+    The entries expire after the ``local_ttl`` of the scope, and the least recently used ones are
+    evicted beyond its ``local_max_size``. Other processes don't see when an entry is invalidated
+    here, so ``local_ttl`` is how stale a value can get.
+    """
+
+    def __init__(self, scope: str):
+        self.scope = scope
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Return the value stored under ``key``, or ``MISSING``."""
+        try:
+            expires_at, value = self._entries[key]
+        except KeyError:
+            return MISSING
+        if monotonic() >= expires_at:
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        local_ttl = cache_arg("local_ttl", self.scope)()
+        if not local_ttl:
+            return
+        self._entries[key] = (monotonic() + ttl_to_seconds(local_ttl), value)
+        self._entries.move_to_end(key)
+        max_size = cache_arg("local_max_size", self.scope)()
+        while max_size and len(self._entries) > max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, func: Callable, **kwargs):
+        """Drop the stored results of ``func`` called with these keyword arguments.
+
+        The arguments which are not passed match any value, those passed as ``None`` also match
+        calls which left them out.
+        """
+        name = func.__name__
+        for key in [
+            key
+            for key in self._entries
+            if key[0] == name
+            and all(dict(key[1]).get(arg) == value for arg, value in kwargs.items())
+        ]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+def local_cached(func: Callable) -> Callable:
+    """Keep the results of a method in the ``local_cache`` of its object.
+
+    The method must only take keyword arguments. Nothing is kept while the cache is disabled.
+    """
+
+    @wraps(func)
+    async def wrapper(self, **kwargs):
+        if cache.is_disable():
+            return await func(self, **kwargs)
+        key = (func.__name__, tuple(sorted(kwargs.items())))
+        try:
+            value = self.local_cache.get(key)
+        except TypeError:
+            # Unhashable arguments, don't bother
+            return await func(self, **kwargs)
+        if value is MISSING:
+            value = await func(self, **kwargs)
+            self.local_cache.set(key, value)
+        return value
+
+    return wrapper
@@ -3,10 +3,15 @@
 # SPDX-License-Identifier: MIT
 
 import logging
+from collections.abc import Iterable
 from typing import TYPE_CHECKING
 
+from cashews import cache
+
 from ..database.model import Rule
-from .base import CachedValue
+from ..rules.compiled import CompiledRule, RuleSet
+from .base import CachedValue, cache_db_session_maker
+from .util import lock_ttl
 
 if TYPE_CHECKING:
     from fedora_messaging.message import Message
@@ -14,23 +19,184 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+# How long the changes to the rules are logged for the processes holding a copy of the rules.
+CHANGES_TTL = "1h"
+# Above this many changes, reload all the rules instead of applying them.
+MAX_CHANGES = 100
+
 
 class RulesCache(CachedValue):
-    """Cache the rules currently in the database."""
+    """Cache the rules currently in the database.
+
+    Each compiled rule is cached under its own key, and the cached value is the set of the IDs of
+    the enabled rules. When a rule changes, only this rule is reloaded and the change is logged
+    under the new version, so that the processes holding a copy of the rules can apply it. They
+    only reload all the rules if they have missed a change.
+    """
 
     name = "rules"
+    cache_version = "v2"
+
+    def __init__(self):
+        super().__init__()
+        self._rule_set = None
+        self._rule_set_stale = False
+        self._rule_set_version = None
+
+    def _rule_key(self, rule_id: int) -> str:
+        return f"{self._cache_key}:rule:{rule_id}"
+
+    def _change_key(self, version: int) -> str:
+        return f"{self._cache_key}:change:{version}"
+
+    async def get_rule_set(self, db: "AsyncSession") -> RuleSet:
+        rule_set, _stale = await self.get_rule_set_with_state(db=db)
+        return rule_set
+
+    async def get_rule_set_with_state(self, db: "AsyncSession") -> tuple[RuleSet, bool]:
+        """Return the rule set, and whether it was built from the stale list of rules."""
+        version = await cache.get(self._version_key)
+        if self._rule_set is not None:
+            if version == self._rule_set_version:
+                return self._rule_set, self._rule_set_stale
+            changed = await self._get_changes(since=self._rule_set_version, version=version)
+            if changed is not None:
+                rules = await self._get_cached_rules(db, changed)
+                self._rule_set = self._rule_set.updated(
+                    {rule_id: rules.get(rule_id) for rule_id in changed}
+                )
+                self._rule_set_version = version
+                return self._rule_set, self._rule_set_stale
+            log.debug("Some changes to the rules were missed, reloading them all")
+        computed = self._computed
+        rule_ids, stale = await self.get_value_with_state(db=db)
+        if self._computed != computed:
+            # Computing the value has bumped the version, don't reload everything next time
+            version = self._computed_version
+        rules = await self._get_cached_rules(db, rule_ids)
+        self._rule_set = RuleSet(rules.values())
+        self._rule_set_stale = stale
+        self._rule_set_version = version
+        return self._rule_set, stale
+
+    async def get_rules(
+        self, db: "AsyncSession", rule_ids: set[int] | None = None
+    ) -> list[CompiledRule]:
+        """Return the cached rules, only those in ``rule_ids`` if it is set.
+
+        The rules are compiled and independent of the database session, they don't need to be
+        merged into it.
+        """
+        return (await self.get_rule_set(db=db)).get_rules(rule_ids)
+
+    async def _get_changes(self, since: int | None, version: int) -> set[int] | None:
+        """Return the IDs of the rules changed after version ``since``.
+
+        Returns ``None`` if some changes are missing.
+        """
+        if since is None or version is None or not 0 < version - since <= MAX_CHANGES:
+            return None
+        changes = await cache.get_many(
+            *(self._change_key(v) for v in range(since + 1, version + 1))
+        )
+        if any(rule_id is None for rule_id in changes):
+            return None
+        return set(changes)
 
-    async def get_rules(self, db: "AsyncSession"):
-        return [await db.merge(r) for r in await self.get_value(db=db)]
+    async def _get_cached_rules(
+        self, db: "AsyncSession", rule_ids: Iterable[int]
+    ) -> dict[int, CompiledRule]:
+        rule_ids = sorted(rule_ids)
+        if not rule_ids:
+            return {}
+        cached = await cache.get_many(*(self._rule_key(rule_id) for rule_id in rule_ids))
+        rules = {rule.id: rule for rule in cached if rule is not None}
+        # The rule may have expired from the cache, or have been deleted
+        missing = [rule_id for rule_id, rule in zip(rule_ids, cached, strict=True) if rule is None]
+        if missing:
+            loaded = await self._load_rules(db, missing)
+            await self._store_rules(loaded)
+            rules.update((rule.id, rule) for rule in loaded)
+        return rules
+
+    async def _store_rules(self, rules: list[CompiledRule]):
+        if not rules:
+            return
+        await cache.set_many(
+            {self._rule_key(rule.id): rule for rule in rules},
+            expire=self._storage_ttl(),
+        )
 
     async def _compute_value(self, db: "AsyncSession"):
         result = await db.execute(Rule.select_related().filter_by(disabled=False))
-        return list(result.scalars())
+        rules = self._compile_all(result.scalars())
+        await self._store_rules(rules)
+        return frozenset(rule.id for rule in rules)
 
-    async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
-        if (
+    def _compile_all(self, rules: Iterable[Rule]) -> list[CompiledRule]:
+        compiled = []
+        for rule in rules:
+            try:
+                compiled.append(CompiledRule.from_db(rule))
+            except ValueError as e:
+                log.warning("Could not compile rule %s, skipping it: %s", rule.id, e)
+        return compiled
+
+    async def _load_rules(self, db: "AsyncSession", rule_ids: list[int]) -> list[CompiledRule]:
+        result = await db.execute(
+            Rule.select_related().filter(Rule.id.in_(rule_ids)).filter_by(disabled=False)
+        )
+        return self._compile_all(result.scalars())
+
+    async def load_rule(self, db: "AsyncSession", rule_id: int) -> CompiledRule | None:
+        """Load a single rule from the database, bypassing the cache.
+
+        Returns ``None`` if the rule does not exist anymore, is disabled, or can't be compiled.
+        """
+        rules = await self._load_rules(db, [rule_id])
+        return rules[0] if rules else None
+
+    async def update_rule(self, rule_id: int):
+        """Reload a single rule instead of rebuilding the whole cache."""
+
+        async def _update():
+            async with cache_db_session_maker.begin() as db:
+                rule = await self.load_rule(db, rule_id)
+            if rule is None:
+                await cache.delete(self._rule_key(rule_id))
+            else:
+                await self._store_rules([rule])
+            rule_ids = await cache.get(self._cache_key)
+            if rule_ids is not None:
+                rule_ids = rule_ids - {rule_id} if rule is None else rule_ids | {rule_id}
+                expire = await cache.get_expire(self._cache_key)
+                if expire <= 0:
+                    expire = self._storage_ttl()
+                await cache.set(self._cache_key, value=rule_ids, expire=expire)
+            # Log the change under the next version before publishing it. If the version is bumped
+            # by something else in the meantime, the readers will see a gap and reload everything.
+            version = await cache.get(self._version_key) or 0
+            await cache.set(self._change_key(version + 1), value=rule_id, expire=CHANGES_TTL)
+            await self._bump_version()
+            log.debug(f"Updated rule %s in the {self.name} cache", rule_id)
+
+        # Use the rebuild lock, the update must not be overwritten by a concurrent rebuild.
+        return await cache.locked(key=f"{self.name}:rebuild", ttl=lock_ttl(self.name))(_update)()
+
+    def may_invalidate(self, message: "Message") -> bool:
+        return (
             message.topic.endswith("fmn.rule.create.v1")
             or message.topic.endswith("fmn.rule.update.v1")
             or message.topic.endswith("fmn.rule.delete.v1")
-        ):
+        )
+
+    async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
+        if not self.may_invalidate(message):
+            return
+        rule_id = message.body.get("rule", {}).get("id")
+        if rule_id is None:
             await self.invalidate(db)
+            return
+        # Only reload the changed rule, loading all the rules and their relationships is expensive.
+        log.debug(f"Updating rule %s in the {self.name} cache in the background", rule_id)
+        self._run_in_background(self.update_rule(rule_id))
@@ -2,16 +2,24 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 import logging
-from dataclasses import dataclass, field
+from array import array
+from collections.abc import Iterator, Mapping, MutableMapping
+from dataclasses import dataclass, field, fields
 from typing import TYPE_CHECKING
 
-from .base import CachedValue
+from cashews import cache
+
+from ..rules.requester import MemoizedRequester
+from .base import CachedValue, cache_db_session_maker
+from .util import lock_ttl
 
 if TYPE_CHECKING:
     from fedora_messaging.message import Message
     from sqlalchemy.ext.asyncio import AsyncSession
 
+    from ..rules.compiled import CompiledRule
     from ..rules.requester import Requester
     from .rules import RulesCache
 
@@ -28,6 +36,163 @@ class Tracked:
     agent_name: set = field(default_factory=set)
 
 
+class CompactIndex(MutableMapping):
+    """A mapping of strings to sets of rule IDs, stored compactly.
+
+    The keys are kept sorted in a single string, and the rule IDs in a single array of integers
+    with the offsets of each key's IDs. This pickles as a few flat buffers, and the lookup table is
+    only built the first time the mapping is queried.
+
+    The changes are kept aside, an empty set marking a deleted key, and only packed with the rest
+    when the mapping is pickled. The sets it returns are copies: store them back after changing
+    them.
+    """
+
+    SEPARATOR = "\0"
+
+    def __init__(self, keys: str = "", offsets: bytes = b"", rule_ids: bytes = b""):
+        self._keys = keys
+        self._offsets = array("I", offsets)
+        self._rule_ids = array("I", rule_ids)
+        self._positions = None
+        self._changes = {}
+
+    @classmethod
+    def from_dict(cls, index: Mapping[str, set[int]]) -> "CompactIndex":
+        if isinstance(index, cls) and not index._changes:
+            return index
+        keys = sorted(index)
+        offsets = array("I", [0])
+        rule_ids = array("I")
+        for key in keys:
+            rule_ids.extend(sorted(index[key]))
+            offsets.append(len(rule_ids))
+        return cls(cls.SEPARATOR.join(keys), offsets.tobytes(), rule_ids.tobytes())
+
+    def _get_positions(self) -> dict[str, int]:
+        if self._positions is None:
+            keys = self._keys.split(self.SEPARATOR) if self._keys else []
+            self._positions = {key: position for position, key in enumerate(keys)}
+        return self._positions
+
+    def __getitem__(self, key: str) -> set[int]:
+        if key in self._changes:
+            if not self._changes[key]:
+                raise KeyError(key)
+            return set(self._changes[key])
+        position = self._get_positions()[key]
+        return set(self._rule_ids[self._offsets[position] : self._offsets[position + 1]])
+
+    def __setitem__(self, key: str, rule_ids: set[int]):
+        self._changes[key] = set(rule_ids)
+
+    def __delitem__(self, key: str):
+        self[key]  # Raise KeyError if it's not there
+        self._changes[key] = set()
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self._get_positions():
+            if self._changes.get(key, True):
+                yield key
+        for key, rule_ids in self._changes.items():
+            if rule_ids and key not in self._get_positions():
+                yield key
+
+    def __len__(self) -> int:
+        if self._changes:
+            return sum(1 for _key in self)
+        return len(self._offsets) - 1 if self._offsets else 0
+
+    def __reduce__(self):
+        packed = self.from_dict(self)
+        return (
+            self.__class__,
+            (packed._keys, packed._offsets.tobytes(), packed._rule_ids.tobytes()),
+        )
+
+
+@dataclass
+class TrackedIndex:
+    """Map what is tracked to the IDs of the rules tracking it.
+
+    Each attribute maps a tracked value (e.g. a package name) to the set of rule IDs which track it,
+    so that only the rules which care about a message need to be run on it.
+    """
+
+    packages: dict[str, set[int]] = field(default_factory=dict)
+    containers: dict[str, set[int]] = field(default_factory=dict)
+    modules: dict[str, set[int]] = field(default_factory=dict)
+    flatpaks: dict[str, set[int]] = field(default_factory=dict)
+    usernames: dict[str, set[int]] = field(default_factory=dict)
+    agent_name: dict[str, set[int]] = field(default_factory=dict)
+    # What each rule tracks, to retract it without going through the whole index. It is not
+    # pickled, it duplicates the mappings above: None means it must be rebuilt from them.
+    rules: dict[int, Tracked] | None = field(default_factory=dict, repr=False, compare=False)
+
+    def _get_rules(self) -> dict[int, Tracked]:
+        if self.rules is None:
+            self.rules = {}
+            for attr in fields(Tracked):
+                for value, rule_ids in getattr(self, attr.name).items():
+                    for rule_id in rule_ids:
+                        rule_tracked = self.rules.setdefault(rule_id, Tracked())
+                        getattr(rule_tracked, attr.name).add(value)
+        return self.rules
+
+    def add(self, rule_id: int, tracked: Tracked):
+        """Add what a rule tracks to the index."""
+        rule_tracked = self._get_rules().setdefault(rule_id, tracked)
+        for attr in fields(Tracked):
+            values = getattr(tracked, attr.name)
+            if not values:
+                continue
+            if rule_tracked is not tracked:
+                getattr(rule_tracked, attr.name).update(values)
+            index = getattr(self, attr.name)
+            for value in values:
+                rule_ids = index.get(value, set())
+                rule_ids.add(rule_id)
+                index[value] = rule_ids
+
+    def remove(self, rule_id: int):
+        """Retract what a rule tracks from the index.
+
+        The values which aren't tracked by any other rule are dropped.
+        """
+        tracked = self._get_rules().pop(rule_id, None)
+        if tracked is None:
+            return
+        for attr in fields(Tracked):
+            index = getattr(self, attr.name)
+            for value in getattr(tracked, attr.name):
+                rule_ids = index[value]
+                rule_ids.discard(rule_id)
+                if rule_ids:
+                    index[value] = rule_ids
+                else:
+                    del index[value]
+
+    def get_rule_ids(self, message: "Message") -> set[int]:
+        """Return the IDs of the rules which track this message."""
+        rule_ids = set()
+        for msg_attr in ("packages", "containers", "modules", "flatpaks", "usernames"):
+            index = getattr(self, msg_attr)
+            for value in getattr(message, msg_attr):
+                rule_ids.update(index.get(value, ()))
+        rule_ids.update(self.agent_name.get(message.agent_name, ()))
+        return rule_ids
+
+    def __getstate__(self):
+        # With every package in Fedora tracked, a dict of sets is large and slow to unpickle.
+        return {
+            attr.name: CompactIndex.from_dict(getattr(self, attr.name)) for attr in fields(Tracked)
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rules = None
+
+
 class TrackedCache(CachedValue):
     """Used to quickly know whether we want to process an incoming message.
 
@@ -45,6 +210,7 @@ class TrackedCache(CachedValue):
     """
 
     name = "tracked"
+    cache_version = "v2"
 
     def __init__(self, requester: "Requester", rules_cache: "RulesCache"):
         super().__init__()
@@ -52,15 +218,65 @@ class TrackedCache(CachedValue):
         self._rules_cache = rules_cache
 
     async def _compute_value(self, db: "AsyncSession"):
+        tracked_index = TrackedIndex()
+        rules = await self._rules_cache.get_rules(db=db)
+        # Many rules track the same users and groups, only query the backends once for each.
+        requester = MemoizedRequester(self._requester)
+        # The requests to the backends are limited by the proxies, prime all the rules at once.
+        for rule, tracked in zip(
+            rules,
+            await asyncio.gather(*(self._get_tracked(rule, requester) for rule in rules)),
+            strict=True,
+        ):
+            tracked_index.add(rule.id, tracked)
+        return tracked_index
+
+    async def _get_tracked(
+        self, rule: "CompiledRule", requester: "Requester | MemoizedRequester"
+    ) -> Tracked:
         tracked = Tracked()
-        for rule in await self._rules_cache.get_rules(db=db):
-            await rule.tracking_rule.prime_cache(tracked, self._requester)
+        await rule.tracking_rule.prime_cache(tracked, requester)
         return tracked
 
-    async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
-        if (
+    async def update_rule(self, rule_id: int):
+        """Apply the changes of a single rule to the cached value instead of rebuilding it."""
+
+        async def _update():
+            tracked_index = await cache.get(self._cache_key)
+            if tracked_index is None:
+                # Nothing is cached: build it, the processes holding a local copy of the value
+                # would not request it otherwise.
+                await self._rebuild()
+                return
+            expire = await cache.get_expire(self._cache_key)
+            async with cache_db_session_maker.begin() as db:
+                rule = await self._rules_cache.load_rule(db, rule_id)
+            tracked_index.remove(rule_id)
+            if rule is not None:
+                tracked_index.add(rule_id, await self._get_tracked(rule, self._requester))
+            if expire <= 0:
+                expire = self._storage_ttl()
+            await cache.set(self._cache_key, value=tracked_index, expire=expire)
+            await self._bump_version()
+            log.debug(f"Updated rule %s in the {self.name} cache", rule_id)
+
+        # Use the rebuild lock, the update must not be overwritten by a concurrent rebuild.
+        return await cache.locked(key=f"{self.name}:rebuild", ttl=lock_ttl(self.name))(_update)()
+
+    def may_invalidate(self, message: "Message") -> bool:
+        return (
             message.topic.endswith("fmn.rule.create.v1")
             or message.topic.endswith("fmn.rule.update.v1")
             or message.topic.endswith("fmn.rule.delete.v1")
-        ):
+        )
+
+    async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
+        if not self.may_invalidate(message):
+            return
+        rule_id = message.body.get("rule", {}).get("id")
+        if rule_id is None:
             await self.invalidate(db)
+            return
+        # Only apply the changed rule, re-running all the rules is very expensive.
+        log.debug(f"Updating rule %s in the {self.name} cache in the background", rule_id)
+        self._run_in_background(self.update_rule(rule_id))
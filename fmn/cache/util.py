@@ -2,9 +2,10 @@
 #
 # SPDX-License-Identifier: MIT
 
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterable, Iterator
 from functools import cache as ft_cache
 from functools import partial
+from itertools import islice
 from typing import Any
 
 from cashews import cache
@@ -46,6 +47,42 @@ def cache_arg(arg: str, scope: str | None = None) -> Callable[[str, str | None],
 cache_ttl = partial(cache_arg, "ttl")
 lock_ttl = partial(cache_arg, "lock_ttl")
 
+# How many keys are deleted in a single command
+DELETE_BATCH_SIZE = 500
+
+
+async def delete_keys(
+    keys: Iterable[str], batch_size: int = DELETE_BATCH_SIZE
+) -> dict[str, Exception]:
+    """Delete keys from the cache in batches, with a single command for each batch.
+
+    On Redis, each batch is deleted with one ``UNLINK``. Returns the keys which could not be
+    deleted, with the error.
+    """
+    failed = {}
+    keys = iter(keys)
+    while batch := list(islice(keys, batch_size)):
+        try:
+            await cache.delete_many(*batch)
+        except Exception as exc:
+            failed.update(dict.fromkeys(batch, exc))
+    return failed
+
+
+async def delete_tags(tags: Iterable[str]) -> dict[str, Exception]:
+    """Delete the cache entries with these tags.
+
+    The keys of each tag are deleted in batches. Returns the tags whose entries could not all be
+    deleted, with the error.
+    """
+    failed = {}
+    for tag in tags:
+        try:
+            await cache.delete_tags(tag)
+        except Exception as exc:
+            failed[tag] = exc
+    return failed
+
 
 def _get_pattern_for_cached_calls_iter(func: Callable, **kwargs: dict[str, Any]) -> Iterator[str]:
     # This is taken from cashews.validation.invalidate_func(), minus the actual deletion part. This
@@ -4,25 +4,34 @@
 
 import asyncio
 import logging
+import sys
+from collections import Counter
+from collections.abc import Collection
 from concurrent.futures import wait
 
-from aio_pika.exceptions import AMQPConnectionError
 from fedora_messaging import message
 from fedora_messaging.config import conf as fm_config
 from fedora_messaging.exceptions import Nack
 from sqlalchemy.ext.asyncio import AsyncSession
+from twisted.internet import defer
 
 from ..cache import configure_cache
 from ..cache.rules import RulesCache
 from ..cache.tracked import TrackedCache
 from ..core import config
 from ..database import async_session_maker, init_model
-from ..database.model import Generated
+from ..rules.compiled import CompiledRule
+from ..rules.context import MessageContext
+from ..rules.notification import Notification
 from ..rules.requester import Requester
+from .generated import GeneratedCounter
 from .send_queue import SendQueue
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_GENERATED_FLUSH_INTERVAL = 60
+
 
 class Consumer:
     def __init__(self):
@@ -33,10 +42,23 @@ class Consumer:
         self._requester = Requester(config.get_settings().services)
         self._tracked_cache = TrackedCache(requester=self._requester, rules_cache=self._rules_cache)
         self.send_queue = SendQueue(fm_config["consumer_config"]["send_queue"])
+        # The names of the caches currently serving stale values
+        self._stale_caches = set()
+        # Fedora Messaging hands us messages one at a time, but the rules tracking a message can be
+        # run concurrently as they mostly wait on the backends.
+        self._rules_semaphore = asyncio.Semaphore(
+            fm_config["consumer_config"].get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        )
+        self._generated = GeneratedCounter(
+            interval=fm_config["consumer_config"].get(
+                "generated_flush_interval", DEFAULT_GENERATED_FLUSH_INTERVAL
+            )
+        )
         self.loop = asyncio.get_event_loop()
         self._ready = self.loop.create_task(self.setup())
         if not self.loop.is_running():
             self.loop.run_until_complete(self._ready)
+        self._register_shutdown()
 
     async def setup(self):
         # Connect to the database
@@ -45,6 +67,24 @@ class Consumer:
         await self.send_queue.connect()
         # Caching and requesting
         configure_cache()
+        # Record the generated notifications periodically
+        self._generated.start()
+
+    def _register_shutdown(self):
+        # Fedora Messaging runs the consumer in Twisted's reactor, record what is pending before it
+        # stops. Don't install a reactor if there isn't one already (in the unit tests for example).
+        if "twisted.internet.reactor" not in sys.modules:
+            return
+        from twisted.internet import reactor
+
+        reactor.addSystemEventTrigger("before", "shutdown", self._on_shutdown)
+
+    def _on_shutdown(self):
+        return defer.Deferred.fromFuture(asyncio.ensure_future(self.stop(), loop=self.loop))
+
+    async def stop(self):
+        await self._generated.stop()
+        await self.send_queue.close()
 
     def __call__(self, message: message.Message):
         log.debug("Consuming message %s", message.id)
@@ -58,6 +98,9 @@ class Consumer:
 
     async def handle_or_rollback(self, message: message.Message):
         await self._ready
+        if self.is_ignored(message):
+            log.debug("Message %s is not tracked", message.id)
+            return
         log.debug("SQLAlchemy pool status: %s", async_session_maker.kw["bind"].pool.status())
         # Get a database session
         async with async_session_maker.begin() as db:
@@ -66,7 +109,8 @@ class Consumer:
 
     async def _handle(self, message: message.Message, db: AsyncSession):
         await self.refresh_cache_if_needed(message, db)
-        if not await self.is_tracked(message, db):
+        rule_ids = await self.get_tracking_rule_ids(message, db)
+        if not rule_ids:
             log.debug("Message %s is not tracked", message.id)
             return
         if message.deprecated:
@@ -75,44 +119,81 @@ class Consumer:
             return
 
         notifications = set()
-        for rule in await self._rules_cache.get_rules(db=db):
-            async for notification in rule.handle(message, self._requester):
-                notifications.add(notification)
-                # Record that the rule generated a notification
-                db.add(Generated(rule=rule, count=1))
+        rule_set, stale = await self._rules_cache.get_rule_set_with_state(db=db)
+        self._report_stale(self._rules_cache.name, stale)
+        context = MessageContext(
+            message,
+            self._requester,
+            topic_matcher=rule_set.topic_matcher,
+            owners_index=rule_set.owners_index,
+        )
+        # Only run the rules which track this message
+        rules = rule_set.get_rules(rule_ids)
+        results = await asyncio.gather(*(self._run_rule(rule, context) for rule in rules))
+        generated = Counter()
+        for rule, rule_notifications in zip(rules, results, strict=True):
+            notifications.update(rule_notifications)
+            generated[rule.id] += len(rule_notifications)
         # Send the deduplicated notifications
-        for notification in notifications:
-            await self._send(notification, message)
+        await self._send(notifications, message)
+        # Record that the rules generated notifications, only once they are sent: if sending fails
+        # the message will be delivered again.
+        for rule_id, count in generated.items():
+            if count:
+                self._generated.add(rule_id, count)
 
-    async def _send(self, notification, from_msg):
-        log.debug(
-            "Generating notification for message %s via %s", from_msg.id, notification.protocol
-        )
-        try:
-            await self.send_queue.send(notification)
-        except AMQPConnectionError as e:
+    async def _run_rule(self, rule: CompiledRule, context: MessageContext) -> list[Notification]:
+        async with self._rules_semaphore:
+            return [notification async for notification in rule.handle(context)]
+
+    async def _send(self, notifications: Collection[Notification], from_msg):
+        log.debug("Generating %d notifications for message %s", len(notifications), from_msg.id)
+        failed = await self.send_queue.send_many(notifications)
+        for notification, error in failed:
             log.error(
                 "Could not send notification for %s via %s: %s",
                 from_msg.id,
                 notification.protocol,
-                e,
+                error,
             )
-            raise Nack() from e
-
-    async def is_tracked(self, message: message.Message, db: "AsyncSession"):
-        # This is cache-based and should save us running all the messages through all the rules. The
-        # tracked messages will still run though all the rules though, so this could be improved I
-        # suppose, maybe by changing the cache datastructure to point each entry in the cache to the
-        # rules that produced it.
-        tracked = await self._tracked_cache.get_value(db=db)
-        for msg_attr in ("packages", "containers", "modules", "flatpaks", "usernames"):
-            if not set(getattr(message, msg_attr)).isdisjoint(getattr(tracked, msg_attr)):
-                log.debug("Message %s is tracked by %s", message.id, msg_attr)
-                return True
-        if message.agent_name in tracked.agent_name:
-            log.debug("Message %s is tracked by agent_name", message.id)
-            return True
-        return False
+        if failed:
+            raise Nack() from failed[0][1]
+
+    async def get_tracking_rule_ids(self, message: message.Message, db: "AsyncSession") -> set[int]:
+        """Return the IDs of the rules tracking this message.
+
+        This is cache-based and saves us running all the messages through all the rules.
+        """
+        tracked, stale = await self._tracked_cache.get_local_value_with_state(db=db)
+        self._report_stale(self._tracked_cache.name, stale)
+        rule_ids = tracked.get_rule_ids(message)
+        if rule_ids:
+            log.debug("Message %s is tracked by rules %s", message.id, sorted(rule_ids))
+        return rule_ids
+
+    def _report_stale(self, cache_name: str, stale: bool):
+        # Only log when it changes, a stale cache is served for every message while it is rebuilt.
+        if stale and cache_name not in self._stale_caches:
+            log.warning("Running on the stale %s cache while it is rebuilt", cache_name)
+            self._stale_caches.add(cache_name)
+        elif not stale and cache_name in self._stale_caches:
+            log.info("The %s cache is current again", cache_name)
+            self._stale_caches.discard(cache_name)
+
+    def is_ignored(self, message: message.Message) -> bool:
+        """Tell whether the message can be skipped without any I/O.
+
+        Most of the messages on the bus are not tracked, don't open a database transaction or ask
+        the cache for those. This relies on the local copy of the tracked index, if there isn't a
+        current one the message will go through the regular processing, which will fetch it.
+        """
+        tracked = self._tracked_cache.peek_local_value()
+        if tracked is None or tracked.get_rule_ids(message):
+            return False
+        return not any(
+            invalidator.may_invalidate(message)
+            for invalidator in (self._rules_cache, self._tracked_cache, self._requester)
+        )
 
     async def refresh_cache_if_needed(self, message: message.Message, db: AsyncSession):
         await self._rules_cache.invalidate_on_message(message, db)
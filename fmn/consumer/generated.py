@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import logging
+from collections import Counter
+from contextlib import suppress
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import async_session_maker
+from ..database.model import Generated, Rule
+
+log = logging.getLogger(__name__)
+
+
+class GeneratedCounter:
+    """Count the notifications generated by the rules and record them in bulk.
+
+    The counts are aggregated in memory per rule and per time bucket of ``interval`` seconds, and
+    written periodically in a single statement, instead of inserting a row for each notification.
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._counts = Counter()
+        self._task = None
+
+    def _get_bucket(self) -> datetime:
+        now = datetime.now().timestamp()
+        return datetime.fromtimestamp(now - now % self.interval)
+
+    def add(self, rule_id: int, count: int = 1):
+        self._counts[(rule_id, self._get_bucket())] += count
+
+    async def flush(self, db: AsyncSession | None = None):
+        counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+        try:
+            if db is None:
+                async with async_session_maker.begin() as db:
+                    await self._write(counts, db)
+            else:
+                await self._write(counts, db)
+        except BaseException:
+            # Keep the counts for the next flush, also when the periodic flush is cancelled
+            self._counts.update(counts)
+            raise
+        log.debug("Recorded %d generated notification counts", len(counts))
+
+    async def _write(self, counts: Counter, db: AsyncSession):
+        # Rules may have been deleted since they generated notifications
+        result = await db.execute(
+            select(Rule.id).filter(Rule.id.in_({rule_id for rule_id, _ in counts}))
+        )
+        existing = set(result.scalars())
+        values = [
+            {"rule_id": rule_id, "when": when, "count": count}
+            for (rule_id, when), count in counts.items()
+            if rule_id in existing
+        ]
+        if values:
+            await db.execute(insert(Generated), values)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Could not record the generated notification counts")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # Let a periodic flush in progress put its counts back before the last flush
+            with suppress(asyncio.CancelledError):
+                await task
+        await self.flush()
@@ -2,10 +2,13 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 import json
 import logging
 import sys
 import traceback
+from collections.abc import Iterable
+from contextvars import ContextVar
 
 import backoff
 from aio_pika import Message, connect_robust
@@ -16,11 +19,16 @@ from ..rules.notification import Notification
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_IN_FLIGHT = 100
+
+# The connection the current task is publishing with
+publishing_connection = ContextVar("publishing_connection", default=None)
+
 
 async def backoff_hdlr(details):
     log.warning("Publishing message failed. Retrying. %s", traceback.format_tb(sys.exc_info()[2]))
     self = details["args"][0]
-    await self.connect()
+    await self.reconnect(publishing_connection.get())
 
 
 def giveup_hdlr(details):
@@ -36,12 +44,30 @@ class SendQueue:
         self._connection = None
         self._channel = None
         self._exchange = None
+        self._reconnect_lock = asyncio.Lock()
+        self.max_in_flight = config.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT)
 
     async def connect(self):
         self._connection = await connect_robust(self._url)
         self._channel = await self._connection.channel()
         self._exchange = await self._channel.get_exchange("amq.direct")
 
+    async def reconnect(self, failed_connection):
+        """Replace the connection after publishing with ``failed_connection`` failed.
+
+        The notifications are sent concurrently, so they may all fail at the same time: only the
+        first one to get here reconnects, the others will use its new connection.
+        """
+        async with self._reconnect_lock:
+            if self._connection is not failed_connection:
+                return
+            if failed_connection is not None:
+                try:
+                    await failed_connection.close()
+                except Exception as e:
+                    log.debug("Could not close the failed connection: %s", e)
+            await self.connect()
+
     @backoff.on_exception(
         backoff.expo,
         AMQPConnectionError,
@@ -51,11 +77,38 @@ class SendQueue:
     )
     async def send(self, notification: Notification):
         body = json.dumps(notification.content.dict())
+        publishing_connection.set(self._connection)
         await self._exchange.publish(
             Message(body=body.encode("utf-8")),
             routing_key=f"send.{notification.protocol}",
         )
 
+    async def send_many(
+        self, notifications: Iterable[Notification]
+    ) -> list[tuple[Notification, AMQPConnectionError]]:
+        """Publish notifications concurrently.
+
+        Publisher confirms are pipelined with at most ``max_in_flight`` notifications waiting
+        for theirs. Returns the notifications that could not be sent, with the error.
+        """
+        notifications = list(notifications)
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def _send(notification):
+            async with semaphore:
+                await self.send(notification)
+
+        results = await asyncio.gather(
+            *(_send(notification) for notification in notifications), return_exceptions=True
+        )
+        failed = []
+        for notification, result in zip(notifications, results, strict=True):
+            if isinstance(result, AMQPConnectionError):
+                failed.append((notification, result))
+            elif isinstance(result, BaseException):
+                raise result
+        return failed
+
     async def close(self):
         if self._connection:
             await self._connection.close()
@@ -17,11 +17,17 @@ class CacheArgsModel(BaseModel):
     ttl: CashewsTTLTypes | None = None
     lock_ttl: CashewsTTLTypes | None = None
     early_ttl: CashewsTTLTypes | None = None
+    local_ttl: CashewsTTLTypes | None = None
+    # How long an expired value may still be served while it is rebuilt
+    stale_ttl: CashewsTTLTypes | None = None
+    local_max_size: int | None = None
 
 
 class CacheScopedArgsModel(BaseModel):
-    tracked: CacheArgsModel = CacheArgsModel(ttl="1d", lock_ttl="1h", early_ttl="20h")
-    rules: CacheArgsModel = CacheArgsModel(ttl="1d", lock_ttl="5m", early_ttl="20h")
+    tracked: CacheArgsModel = CacheArgsModel(
+        ttl="1d", lock_ttl="1h", early_ttl="20h", local_ttl="10s", stale_ttl="6h"
+    )
+    rules: CacheArgsModel = CacheArgsModel(ttl="1d", lock_ttl="5m", early_ttl="20h", stale_ttl="1h")
     pagure: CacheArgsModel | None = None
     fasjson: CacheArgsModel | None = None
 
@@ -30,7 +36,7 @@ class CacheModel(BaseModel):
     url: stricturl(tld_required=False, host_required=False) = "mem://"
     setup_args: dict[str, Any] | None = None
 
-    default_args: CacheArgsModel = CacheArgsModel(ttl="1h")
+    default_args: CacheArgsModel = CacheArgsModel(ttl="1h", local_ttl="1m", local_max_size=10000)
     scoped_args: CacheScopedArgsModel = CacheScopedArgsModel()
 
 
@@ -46,9 +52,27 @@ class DBModel(BaseModel):
     sqlalchemy: SQLAlchemyModel = SQLAlchemyModel()
 
 
+class HTTPPoolModel(BaseModel):
+    # Use HTTP/2 with the servers which support it (negotiated, the others use HTTP/1.1). This needs
+    # the h2 package, installed with the api and consumer extras.
+    http2: bool = True
+    max_connections: int | None = 100
+    max_keepalive_connections: int | None = 20
+    keepalive_expiry: float | None = 30
+    # Timeouts in seconds, None means no timeout
+    connect_timeout: float | None = 10
+    read_timeout: float | None = 60
+
+
 class ServicesModel(BaseModel):
     fasjson_url: stricturl() = "https://fasjson.fedoraproject.org"
     distgit_url: stricturl() = "https://src.fedoraproject.org"
+    # How many requests can be sent to each service at the same time
+    max_concurrent_requests: int | None = 20
+    # Answer the ownership queries from a snapshot of all the projects in dist-git
+    distgit_snapshot: bool = False
+    # The connection pool shared by all the requests to each service
+    http_pool: HTTPPoolModel = HTTPPoolModel()
 
 
 class Settings(BaseSettings):
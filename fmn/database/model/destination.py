@@ -7,6 +7,7 @@ from typing import TYPE_CHECKING
 from sqlalchemy import Column, ForeignKey, Integer, String, UnicodeText
 from sqlalchemy.orm import relationship
 
+from ...rules.notification import generate_content
 from ..main import Base
 from .generation_rule import GenerationRule
 
@@ -30,19 +31,4 @@ class Destination(Base):
     address = Column(UnicodeText, nullable=False)
 
     def generate(self, message: "Message") -> "Notification.content":
-        app_name = f"[{message.app_name}] " if message.app_name else ""
-        url = message.url if message.url else ""
-        if self.protocol == "email":
-            return {
-                "headers": {
-                    "To": self.address,
-                    "Subject": f"{app_name}{message.summary}",
-                },
-                "body": f"{str(message)}\n{url}",
-            }
-        elif self.protocol == "irc":
-            return {"to": self.address, "message": f"{app_name}{message.summary} {url}"}
-        elif self.protocol == "matrix":
-            return {"to": self.address, "message": f"{app_name}{message.summary} {url}"}
-        else:
-            raise ValueError(f"Unknown destination protocol: {self.protocol}")
+        return generate_content(self.protocol, self.address, message)
@@ -2,18 +2,16 @@
 #
 # SPDX-License-Identifier: MIT
 
-from importlib.metadata import entry_points
 from typing import TYPE_CHECKING
 
 from sqlalchemy import JSON, Column, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship
 
+from ...rules.registry import get_filter_class
 from ..main import Base
 from .generation_rule import GenerationRule
 
 if TYPE_CHECKING:
-    from fedora_messaging.message import Message
-
     from ...rules.requester import Requester
 
 
@@ -31,13 +29,6 @@ class Filter(Base):
     params = Column(JSON)
 
     def get_implementation(self, requester: "Requester"):
-        eps = entry_points(group="fmn.filters", name=self.name)
-        if len(eps) != 1:
-            raise ValueError(f"Unknown filter: {self.name}")
-        impl_class = eps[self.name].load()
+        impl_class = get_filter_class(self.name)
         username = self.generation_rule.rule.user.name
         return impl_class(requester=requester, params=self.params, username=username)
-
-    def matches(self, message: "Message", requester: "Requester"):
-        impl = self.get_implementation(requester)
-        return impl.matches(message)
@@ -2,9 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
-import logging
 from functools import cache
-from typing import TYPE_CHECKING
 
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, UnicodeText, select
 from sqlalchemy.orm import relationship, selectinload
@@ -16,14 +14,6 @@ from .generation_rule import GenerationRule
 from .tracking_rule import TrackingRule
 from .user import User
 
-if TYPE_CHECKING:
-    from fedora_messaging.message import Message
-
-    from ...rules.requester import Requester
-
-
-log = logging.getLogger(__name__)
-
 
 class Rule(Base):
     __tablename__ = "rules"
@@ -61,11 +51,3 @@ class Rule(Base):
             selectinload(cls.generation_rules).selectinload(GenerationRule.destinations),
             selectinload(cls.generation_rules).selectinload(GenerationRule.filters),
         )
-
-    async def handle(self, message: "Message", requester: "Requester"):
-        log.debug("Rule %s handling message %s", self.id, message.id)
-        if not await self.tracking_rule.matches(message, requester):
-            return
-        for generation_rule in self.generation_rules:
-            async for notification in generation_rule.handle(message, requester):
-                yield notification
@@ -2,17 +2,15 @@
 #
 # SPDX-License-Identifier: MIT
 
-from importlib.metadata import entry_points
 from typing import TYPE_CHECKING
 
 from sqlalchemy import JSON, Column, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship
 
+from ...rules.registry import get_tracking_rule_class
 from ..main import Base
 
 if TYPE_CHECKING:
-    from fedora_messaging.message import Message
-
     from ...rules.requester import Requester
 
 
@@ -29,17 +27,6 @@ class TrackingRule(Base):
     params = Column(JSON)
 
     def get_implementation(self, requester: "Requester"):
-        eps = entry_points(group="fmn.tracking_rules", name=self.name)
-        if len(eps) != 1:
-            raise ValueError(f"Unknown tracking rule: {self.name}")
-        impl_class = eps[self.name].load()
+        impl_class = get_tracking_rule_class(self.name)
         owner = self.rule.user.name
         return impl_class(requester, self.params, owner)
-
-    async def matches(self, message: "Message", requester: "Requester"):
-        impl = self.get_implementation(requester)
-        return await impl.matches(message)
-
-    async def prime_cache(self, cache, requester: "Requester"):
-        impl = self.get_implementation(requester)
-        return await impl.prime_cache(cache)
@@ -0,0 +1,223 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+"""Immutable representations of the rules, independent of any database session.
+
+They are built once when the rules cache is rebuilt and evaluated directly by the consumer, so
+that the ORM is not involved in processing incoming messages.
+"""
+
+import json
+import logging
+from collections.abc import AsyncIterator, Iterable, Mapping
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+from .context import MessageContext
+from .filter import Topic
+from .notification import Notification, generate_content
+from .owners import OwnersIndex
+from .registry import get_filter_class, get_tracking_rule_class
+from .topic import TopicMatcher
+
+if TYPE_CHECKING:
+    from fedora_messaging.message import Message
+
+    from ..database.model import Rule
+    from .requester import Requester
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CompiledDestination:
+    protocol: str
+    address: str
+
+    def generate(self, message: "Message") -> Notification:
+        return Notification.parse_obj(
+            {
+                "protocol": self.protocol,
+                "content": generate_content(self.protocol, self.address, message),
+            }
+        )
+
+
+class _Implemented:
+    """Resolve the implementation class once, when the rule is compiled.
+
+    The implementation object is built on first use and kept for the life of the process. It is not
+    pickled, as it holds a reference to the requester.
+    """
+
+    def __post_init__(self):
+        object.__setattr__(self, "_impl_class", self._get_implementation_class())
+        object.__setattr__(self, "_impl", None)
+
+    def __getstate__(self):
+        return {**self.__dict__, "_impl": None}
+
+    def _get_implementation_class(self) -> type:
+        raise NotImplementedError
+
+    def _make_implementation(self, requester: "Requester"):
+        raise NotImplementedError
+
+    def get_implementation(self, requester: "Requester"):
+        impl = self._impl
+        if impl is None or impl._requester is not requester:
+            impl = self._make_implementation(requester)
+            object.__setattr__(self, "_impl", impl)
+        return impl
+
+
+@dataclass(frozen=True)
+class CompiledFilter(_Implemented):
+    name: str
+    params: Any
+    username: str
+
+    def __post_init__(self):
+        super().__post_init__()
+        # Filters with the same key always give the same result on a message
+        username = self.username if self._impl_class.depends_on_user else None
+        key = (self.name, json.dumps(self.params, sort_keys=True), username)
+        object.__setattr__(self, "key", key)
+        # Topic globs are matched all at once, see `TopicMatcher`
+        topic_pattern = self.params if issubclass(self._impl_class, Topic) and self.params else None
+        object.__setattr__(self, "topic_pattern", topic_pattern)
+
+    def _get_implementation_class(self) -> type:
+        return get_filter_class(self.name)
+
+    def _make_implementation(self, requester: "Requester"):
+        return self._impl_class(requester=requester, params=self.params, username=self.username)
+
+    def matches(self, message: "Message", requester: "Requester"):
+        return self.get_implementation(requester).matches(message)
+
+
+@dataclass(frozen=True)
+class CompiledTrackingRule(_Implemented):
+    name: str
+    params: Any
+    owner: str
+
+    def _get_implementation_class(self) -> type:
+        return get_tracking_rule_class(self.name)
+
+    def _make_implementation(self, requester: "Requester"):
+        return self._impl_class(requester, self.params, self.owner)
+
+    async def matches(
+        self, message: "Message", requester: "Requester", context: MessageContext | None = None
+    ):
+        return await self.get_implementation(requester).matches(message, context)
+
+    async def prime_cache(self, cache, requester: "Requester"):
+        # Priming uses a short-lived requester, don't replace the implementation used for matching.
+        return await self._make_implementation(requester).prime_cache(cache)
+
+
+@dataclass(frozen=True)
+class CompiledGenerationRule:
+    id: int
+    filters: tuple[CompiledFilter, ...]
+    destinations: tuple[CompiledDestination, ...]
+
+    def __post_init__(self):
+        object.__setattr__(self, "filters_key", frozenset(f.key for f in self.filters))
+
+    async def handle(self, context: MessageContext) -> AsyncIterator[Notification]:
+        if not context.filters_match(self.filters, self.filters_key):
+            return
+        for destination in self.destinations:
+            yield destination.generate(context.message)
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    id: int
+    name: str | None
+    username: str
+    tracking_rule: CompiledTrackingRule
+    generation_rules: tuple[CompiledGenerationRule, ...]
+
+    @classmethod
+    def from_db(cls, rule: "Rule") -> "CompiledRule":
+        """Compile a rule from the database.
+
+        The rule must have been loaded with its related objects, see `Rule.select_related()`.
+        Raises ValueError if the implementation of its tracking rule or filters is unknown.
+        """
+        username = rule.user.name
+        tracking_rule = rule.tracking_rule
+        return cls(
+            id=rule.id,
+            name=rule.name,
+            username=username,
+            tracking_rule=CompiledTrackingRule(
+                name=tracking_rule.name, params=tracking_rule.params, owner=username
+            ),
+            generation_rules=tuple(
+                CompiledGenerationRule(
+                    id=gr.id,
+                    filters=tuple(
+                        CompiledFilter(name=f.name, params=f.params, username=username)
+                        for f in gr.filters
+                    ),
+                    destinations=tuple(
+                        CompiledDestination(protocol=d.protocol, address=d.address)
+                        for d in gr.destinations
+                    ),
+                )
+                for gr in rule.generation_rules
+            ),
+        )
+
+    async def handle(self, context: MessageContext) -> AsyncIterator[Notification]:
+        log.debug("Rule %s handling message %s", self.id, context.message.id)
+        tracked = await context.is_tracked_by_owners(self.id)
+        if tracked is None:
+            tracked = await self.tracking_rule.matches(context.message, context.requester, context)
+        if not tracked:
+            return
+        for generation_rule in self.generation_rules:
+            async for notification in generation_rule.handle(context):
+                yield notification
+
+
+class RuleSet:
+    """The compiled rules indexed by their ID, and what is derived from them."""
+
+    def __init__(self, rules: Iterable[CompiledRule] = ()):
+        self.rules = {rule.id: rule for rule in rules}
+        self.topic_matcher = TopicMatcher(
+            f.topic_pattern
+            for rule in self.rules.values()
+            for gr in rule.generation_rules
+            for f in gr.filters
+            if f.topic_pattern is not None
+        )
+        self.owners_index = OwnersIndex(self.rules.values())
+
+    def __len__(self):
+        return len(self.rules)
+
+    def updated(self, changes: Mapping[int, CompiledRule | None]) -> "RuleSet":
+        """Return a new rule set with the changed rules, the rules set to ``None`` are removed."""
+        rules = dict(self.rules)
+        for rule_id, rule in changes.items():
+            if rule is None:
+                rules.pop(rule_id, None)
+            else:
+                rules[rule_id] = rule
+        return self.__class__(rules.values())
+
+    def get_rules(self, rule_ids: Iterable[int] | None = None) -> list[CompiledRule]:
+        """Return the rules, only those in ``rule_ids`` if it is set."""
+        if rule_ids is None:
+            return list(self.rules.values())
+        return [self.rules[rule_id] for rule_id in sorted(rule_ids) if rule_id in self.rules]
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import logging
+from collections.abc import Hashable, Iterable
+from functools import cached_property
+from itertools import chain
+from typing import TYPE_CHECKING
+
+from ..core.constants import ArtifactType
+
+if TYPE_CHECKING:
+    from fedora_messaging.message import Message
+
+    from .compiled import CompiledFilter
+    from .owners import OwnersIndex
+    from .requester import Requester
+    from .topic import TopicMatcher
+
+
+log = logging.getLogger(__name__)
+
+
+class MessageContext:
+    """Hold what is computed about a message while the rules are evaluated on it.
+
+    Most users pick the same filters, so each distinct filter (and combination of filters) is
+    evaluated once per message and its result is shared by all the generation rules using it.
+    Likewise, the owners of the message's artifacts are looked up once for all the tracking rules.
+    """
+
+    def __init__(
+        self,
+        message: "Message",
+        requester: "Requester",
+        topic_matcher: "TopicMatcher | None" = None,
+        owners_index: "OwnersIndex | None" = None,
+    ):
+        self.message = message
+        self.requester = requester
+        self._topic_matcher = topic_matcher
+        self._filter_results: dict[Hashable, bool] = {}
+        self._filters_results: dict[Hashable, bool] = {}
+        self._artifacts_owners: dict[str, asyncio.Future] = {}
+        self._owners_index = owners_index
+        self._owners_rule_ids: dict[str, set[int]] = {}
+
+    @cached_property
+    def matching_topic_patterns(self) -> set[str]:
+        return self._topic_matcher.match(self.message.topic)
+
+    def filter_matches(self, filter_: "CompiledFilter") -> bool:
+        try:
+            return self._filter_results[filter_.key]
+        except KeyError:
+            pass
+        if (
+            filter_.topic_pattern is not None
+            and self._topic_matcher is not None
+            and filter_.topic_pattern in self._topic_matcher.patterns
+        ):
+            result = filter_.topic_pattern in self.matching_topic_patterns
+        else:
+            result = bool(filter_.matches(self.message, self.requester))
+        self._filter_results[filter_.key] = result
+        return result
+
+    def filters_match(self, filters: Iterable["CompiledFilter"], key: Hashable) -> bool:
+        """Return whether all the filters match, ``key`` identifies this combination of filters."""
+        try:
+            return self._filters_results[key]
+        except KeyError:
+            result = self._filters_results[key] = all(self.filter_matches(f) for f in filters)
+            return result
+
+    async def get_artifacts_users(self) -> frozenset[str]:
+        """Return the users owning any of the artifacts in the message."""
+        return await self._get_artifacts_owners("get_project_users")
+
+    async def get_artifacts_groups(self) -> frozenset[str]:
+        """Return the groups owning any of the artifacts in the message."""
+        return await self._get_artifacts_owners("get_project_groups")
+
+    async def is_tracked_by_owners(self, rule_id: int) -> bool | None:
+        """Tell whether an ownership rule tracks the message, using the owners index.
+
+        Returns ``None`` if the rule is not in the index.
+        """
+        if self._owners_index is None or rule_id not in self._owners_index:
+            return None
+        # Only look up the kind of owners this rule needs. The rules run concurrently, so the users
+        # and the groups are looked up at the same time when both are needed.
+        kind = self._owners_index.owner_kinds[rule_id]
+        try:
+            rule_ids = self._owners_rule_ids[kind]
+        except KeyError:
+            owners = await self._get_artifacts_owners(f"get_project_{kind}")
+            rule_ids = self._owners_rule_ids[kind] = self._owners_index.get_rule_ids(kind, owners)
+        return rule_id in rule_ids
+
+    def _get_artifacts_owners(self, method: str) -> asyncio.Future:
+        # Rules run concurrently, the first one to ask starts the lookup and the others wait for it.
+        try:
+            future = self._artifacts_owners[method]
+        except KeyError:
+            future = self._artifacts_owners[method] = asyncio.ensure_future(
+                self._fetch_artifacts_owners(method)
+            )
+        # A rule going away must not cancel the lookup for the others
+        return asyncio.shield(future)
+
+    async def _fetch_artifacts_owners(self, method: str) -> frozenset[str]:
+        get_owners = getattr(self.requester.distgit, method)
+        owners = await asyncio.gather(
+            *(
+                get_owners(project_path=f"{artifact_type.value}/{artifact}")
+                for artifact_type in ArtifactType
+                for artifact in getattr(self.message, artifact_type.name)
+            )
+        )
+        return frozenset(chain.from_iterable(owners))
@@ -11,6 +11,8 @@ from .requester import Requester
 
 class Filter:
     name: str
+    # Whether the result depends on the user who set up the filter, or only on the parameters
+    depends_on_user: bool = True
 
     def __init__(self, requester: Requester, params, username):
         self._requester = requester
@@ -23,6 +25,7 @@ class Filter:
 
 class Applications(Filter):
     name = "applications"
+    depends_on_user = False
 
     def __init__(self, requester: Requester, params, username):
         if params:
@@ -37,6 +40,7 @@ class Applications(Filter):
 
 class Severities(Filter):
     name = "severities"
+    depends_on_user = False
     default = (message.INFO, message.WARNING, message.ERROR)
 
     def __init__(self, *args, **kwargs):
@@ -60,6 +64,7 @@ class MyActions(Filter):
 
 class Topic(Filter):
     name = "topic"
+    depends_on_user = False
 
     def matches(self, message):
         if not self.params:
@@ -2,10 +2,13 @@
 #
 # SPDX-License-Identifier: MIT
 
-from typing import Annotated, Literal
+from typing import TYPE_CHECKING, Annotated, Any, Literal
 
 from pydantic import BaseModel, Field
 
+if TYPE_CHECKING:
+    from fedora_messaging.message import Message
+
 
 class FrozenModel(BaseModel):
     class Config:
@@ -54,3 +57,23 @@ class Notification(FrozenModel):
 
     def __getattr__(self, attr):
         return getattr(self.__root__, attr)
+
+
+def generate_content(protocol: str, address: str, message: "Message") -> dict[str, Any]:
+    """Generate the content of a notification for a message."""
+    app_name = f"[{message.app_name}] " if message.app_name else ""
+    url = message.url if message.url else ""
+    if protocol == "email":
+        return {
+            "headers": {
+                "To": address,
+                "Subject": f"{app_name}{message.summary}",
+            },
+            "body": f"{str(message)}\n{url}",
+        }
+    elif protocol == "irc":
+        return {"to": address, "message": f"{app_name}{message.summary} {url}"}
+    elif protocol == "matrix":
+        return {"to": address, "message": f"{app_name}{message.summary} {url}"}
+    else:
+        raise ValueError(f"Unknown destination protocol: {protocol}")
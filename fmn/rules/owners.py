@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from .tracking_rules import ArtifactsGroupOwned, ArtifactsOwned
+
+if TYPE_CHECKING:
+    from .compiled import CompiledRule
+
+
+class OwnersIndex:
+    """Find the ownership rules tracking a message from the owners of its artifacts.
+
+    The rules tracking the artifacts owned by some users or groups are indexed by these users and
+    groups. Once the owners of the message's artifacts are known, the rules tracking it are found
+    with a lookup per owner instead of checking each rule.
+    """
+
+    def __init__(self, rules: Iterable["CompiledRule"] = ()):
+        # The kind of owners tracked by each rule: "users" or "groups"
+        self.owner_kinds: dict[int, str] = {}
+        self.by_owner = {"users": defaultdict(set), "groups": defaultdict(set)}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule: "CompiledRule"):
+        tracking_rule = rule.tracking_rule
+        if tracking_rule.name == ArtifactsOwned.name:
+            kind = "users"
+        elif tracking_rule.name == ArtifactsGroupOwned.name:
+            kind = "groups"
+        else:
+            return
+        self.owner_kinds[rule.id] = kind
+        index = self.by_owner[kind]
+        for name in tracking_rule.params or ():
+            index[name].add(rule.id)
+
+    def __contains__(self, rule_id: int) -> bool:
+        return rule_id in self.owner_kinds
+
+    def get_rule_ids(self, kind: str, owners: Iterable[str]) -> set[int]:
+        """Return the IDs of the rules tracking the artifacts owned by these users or groups."""
+        index = self.by_owner[kind]
+        rule_ids = set()
+        for name in owners:
+            rule_ids.update(index.get(name, ()))
+        return rule_ids
@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+"""Registry of the tracking rule and filter implementations.
+
+Scanning entry points reads package metadata from disk, so this is done once per process.
+"""
+
+from collections import defaultdict
+from functools import cache
+from importlib.metadata import EntryPoint, entry_points
+
+TRACKING_RULES_GROUP = "fmn.tracking_rules"
+FILTERS_GROUP = "fmn.filters"
+
+
+@cache
+def get_entry_points(group: str) -> dict[str, list[EntryPoint]]:
+    result = defaultdict(list)
+    for ep in entry_points(group=group):
+        result[ep.name].append(ep)
+    return dict(result)
+
+
+@cache
+def get_implementation_class(group: str, name: str) -> type:
+    eps = get_entry_points(group).get(name, [])
+    if len(eps) != 1:
+        raise ValueError(f"Unknown implementation in {group}: {name}")
+    return eps[0].load()
+
+
+def get_tracking_rule_class(name: str) -> type:
+    try:
+        return get_implementation_class(TRACKING_RULES_GROUP, name)
+    except ValueError as e:
+        raise ValueError(f"Unknown tracking rule: {name}") from e
+
+
+def get_filter_class(name: str) -> type:
+    try:
+        return get_implementation_class(FILTERS_GROUP, name)
+    except ValueError as e:
+        raise ValueError(f"Unknown filter: {name}") from e
+
+
+def clear_registry():
+    get_entry_points.cache_clear()
+    get_implementation_class.cache_clear()
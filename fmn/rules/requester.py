@@ -2,10 +2,20 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import inspect
 import logging
 from typing import TYPE_CHECKING
 
-from ..backends import FASJSONAsyncProxy, PagureAsyncProxy
+from ..backends import (
+    FASJSONAsyncProxy,
+    PagureAsyncProxy,
+    get_distgit_proxy,
+    get_fasjson_proxy,
+)
+from ..backends.base import get_client_kwargs
+from ..backends.pagure_snapshot import PagureSnapshotProxy
+from ..core.config import get_settings
 
 if TYPE_CHECKING:
     from fedora_messaging.message import Message
@@ -15,10 +25,58 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
+class MemoizedProxy:
+    """Wrap a backend proxy so that each distinct query is only run once.
+
+    The results are kept for the life of this object, it is meant to be short-lived.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._results = {}
+
+    def __getattr__(self, name: str):
+        method = getattr(self._proxy, name)
+        if not inspect.iscoroutinefunction(method):
+            return method
+
+        async def _memoized(**kwargs):
+            key = (name, tuple(sorted(kwargs.items())))
+            try:
+                result = self._results[key]
+            except KeyError:
+                result = self._results[key] = asyncio.ensure_future(method(**kwargs))
+            return await result
+
+        return _memoized
+
+
+class MemoizedRequester:
+    """A requester that runs each distinct backend query only once.
+
+    This is used when building the tracked cache, where many rules track the same users and groups.
+    """
+
+    def __init__(self, requester: "Requester"):
+        self.distgit = MemoizedProxy(requester.distgit)
+        self.fasjson = MemoizedProxy(requester.fasjson)
+
+
 class Requester:
     def __init__(self, config):
-        self.distgit = PagureAsyncProxy(config.distgit_url)
-        self.fasjson = FASJSONAsyncProxy(config.fasjson_url)
+        if config == get_settings().services:
+            # Share the proxies, and their connection pools, with the rest of the process
+            self.distgit = get_distgit_proxy()
+            self.fasjson = get_fasjson_proxy()
+        else:
+            client_kwargs = get_client_kwargs(config)
+            self.distgit = PagureAsyncProxy(config.distgit_url, **client_kwargs)
+            self.fasjson = FASJSONAsyncProxy(config.fasjson_url, **client_kwargs)
+        if config.distgit_snapshot:
+            self.distgit = PagureSnapshotProxy(self.distgit)
+
+    def may_invalidate(self, message: "Message") -> bool:
+        return self.distgit.may_invalidate(message) or self.fasjson.may_invalidate(message)
 
     async def invalidate_on_message(self, message: "Message", db: "AsyncSession"):
         await self.distgit.invalidate_on_message(message, db)
@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+from fnmatch import translate
+
+GLOB_MAGIC_RE = re.compile(r"[*?[]")
+
+
+class TopicMatcher:
+    """Find all the topic globs matching a topic in a single pass.
+
+    The globs are compiled once into lookup tables:
+    - globs without wildcards are looked up as is,
+    - globs ending or starting with a single ``*`` are looked up by the topic's prefixes or suffixes
+      of the right lengths,
+    - the remaining globs are compiled to regular expressions.
+
+    It matches like `fnmatch.fnmatchcase()`.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns = set()
+        self._exact = set()
+        self._prefixes = defaultdict(set)
+        self._suffixes = defaultdict(set)
+        self._regexes = {}
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __getstate__(self):
+        return {"patterns": self.patterns}
+
+    def __setstate__(self, state):
+        self.__init__(state["patterns"])
+
+    def add(self, pattern: str):
+        if pattern in self.patterns:
+            return
+        self.patterns.add(pattern)
+        if pattern == "*":
+            self._prefixes[0].add("")
+        elif not GLOB_MAGIC_RE.search(pattern):
+            self._exact.add(pattern)
+        elif pattern.endswith("*") and not GLOB_MAGIC_RE.search(pattern[:-1]):
+            prefix = pattern[:-1]
+            self._prefixes[len(prefix)].add(prefix)
+        elif pattern.startswith("*") and not GLOB_MAGIC_RE.search(pattern[1:]):
+            suffix = pattern[1:]
+            self._suffixes[len(suffix)].add(suffix)
+        else:
+            self._regexes[pattern] = re.compile(translate(pattern))
+
+    def match(self, topic: str) -> set[str]:
+        """Return the globs matching the topic."""
+        result = set()
+        if topic in self._exact:
+            result.add(topic)
+        topic_length = len(topic)
+        for length, prefixes in self._prefixes.items():
+            if length <= topic_length and (prefix := topic[:length]) in prefixes:
+                result.add(f"{prefix}*")
+        for length, suffixes in self._suffixes.items():
+            if length <= topic_length and (suffix := topic[topic_length - length :]) in suffixes:
+                result.add(f"*{suffix}")
+        result.update(pattern for pattern, regex in self._regexes.items() if regex.match(topic))
+        return result
@@ -2,11 +2,13 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 import logging
 from typing import TYPE_CHECKING
 
 from ..backends import PagureRole
 from ..core.constants import ArtifactType
+from .context import MessageContext
 from .requester import Requester
 
 if TYPE_CHECKING:
@@ -25,7 +27,11 @@ class TrackingRule:
         self._params = params
         self._owner = owner
 
-    async def matches(self, message: "Message"):
+    async def matches(self, message: "Message", context: MessageContext | None = None):
+        """Tell whether the rule tracks the message.
+
+        The context holds what is shared by all the rules evaluated on this message.
+        """
         raise NotImplementedError
 
     async def prime_cache(self, cache):
@@ -39,19 +45,20 @@ class ArtifactsOwned(TrackingRule):
         super().__init__(*args, **kwargs)
         self.usernames = set(self._params)
 
-    async def matches(self, message):
-        for artifact_type in ArtifactType:
-            for artifact in getattr(message, artifact_type.name):
-                owners = await self._requester.distgit.get_project_users(
-                    project_path=f"{artifact_type.value}/{artifact}"
-                )
-                if self.usernames & set(owners):
-                    return True
-        return False
+    async def matches(self, message, context=None):
+        if context is None:
+            context = MessageContext(message, self._requester)
+        return bool(self.usernames & await context.get_artifacts_users())
 
     async def prime_cache(self, cache):
-        for username in self.usernames:
-            owned = await self._requester.distgit.get_user_projects(username=username)
+        # The requests to the backends are limited by the proxies, run them all at once.
+        for future in asyncio.as_completed(
+            [
+                self._requester.distgit.get_user_projects(username=username)
+                for username in self.usernames
+            ]
+        ):
+            owned = await future
             for artifact_type in ArtifactType:
                 getattr(cache, artifact_type.name).update(
                     p["name"] for p in owned if p["namespace"] == artifact_type.value
@@ -65,25 +72,24 @@ class ArtifactsGroupOwned(TrackingRule):
         super().__init__(*args, **kwargs)
         self.groups = set(self._params)
 
-    async def matches(self, message):
-        for artifact_type in ArtifactType:
-            for artifact in getattr(message, artifact_type.name):
-                owners = await self._requester.distgit.get_project_groups(
-                    project_path=f"{artifact_type.value}/{artifact}"
-                )
-                if self.groups & set(owners):
-                    return True
-        return False
+    async def matches(self, message, context=None):
+        if context is None:
+            context = MessageContext(message, self._requester)
+        return bool(self.groups & await context.get_artifacts_groups())
 
     async def prime_cache(self, cache):
-        for group in self.groups:
-            owned = await self._requester.distgit.get_group_projects(
+        async def _get_group_projects(group):
+            projects = await self._requester.distgit.get_group_projects(
                 name=group, acl=PagureRole.GROUP_ROLES_MAINTAINER
             )
+            return group, projects
+
+        for future in asyncio.as_completed([_get_group_projects(group) for group in self.groups]):
+            group, owned = await future
             for role in PagureRole.GROUP_ROLES_MAINTAINER_SET:
                 for artifact_type in ArtifactType:
                     getattr(cache, artifact_type.name).update(
-                        p["fullname"]
+                        p["name"]
                         for p in owned
                         if p["namespace"] == artifact_type.value
                         and group in p["access_groups"].get(role.name.lower(), ())
@@ -101,7 +107,7 @@ class ArtifactsFollowed(TrackingRule):
         }
         # → packages: {"pkg1", "pkg2", "pkg3"}
 
-    async def matches(self, message):
+    async def matches(self, message, context=None):
         for msg_attr, followed in self.followed.items():
             if not followed:
                 continue
@@ -122,7 +128,7 @@ class RelatedEvents(TrackingRule):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    async def matches(self, message):
+    async def matches(self, message, context=None):
         return self._owner in message.usernames
 
     async def prime_cache(self, cache):
@@ -136,7 +142,7 @@ class UsersFollowed(TrackingRule):
         super().__init__(*args, **kwargs)
         self.followed = set(self._params)
 
-    async def matches(self, message):
+    async def matches(self, message, context=None):
         return message.agent_name in self.followed
 
     async def prime_cache(self, cache):
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 from contextlib import nullcontext
 from unittest import mock
 
@@ -9,6 +10,7 @@ import httpx
 import pytest
 
 from fmn.backends import base
+from fmn.core.config import ServicesModel
 
 
 class ConcreteAPIClient(base.APIClient):
@@ -24,6 +26,16 @@ class ConcreteAPIClient(base.APIClient):
         return url, new_params
 
 
+class ConcurrentAPIClient(ConcreteAPIClient):
+    max_concurrent_pages = 2
+
+    def determine_remaining_pages_params(self, url, params, result):
+        return [
+            (url, {**params, "page_number": page_number})
+            for page_number in range(2, result["page"]["total_pages"] + 1)
+        ]
+
+
 @pytest.fixture
 def client():
     client = ConcreteAPIClient()
@@ -136,6 +148,24 @@ class TestAPIClient:
         response.raise_for_status.assert_called_once_with()
         assert result is sentinel
 
+    async def test_get_concurrency(self):
+        client = ConcreteAPIClient(max_concurrent_requests=2)
+        client.client = mock.AsyncMock()
+        in_flight = max_in_flight = 0
+
+        async def _get(url, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return mock.Mock()
+
+        client.client.get.side_effect = _get
+        await asyncio.gather(*(client.get(f"url{i}") for i in range(5)))
+        assert client.client.get.await_count == 5
+        assert max_in_flight == 2
+
     async def test_get_payload(self, client):
         with mock.patch.object(client, "get") as client_get:
             client_get.return_value = {"result": "boo"}
@@ -184,14 +214,145 @@ class TestAPIClient:
             assert len(result) == self.PAGINATE_TOTAL_PAGES * self.PAGINATE_PER_PAGE
             assert all(i == item["boop"] for i, item in enumerate(result))
 
+    async def test_get_paginated_concurrent(self):
+        client = ConcurrentAPIClient()
+        client.client = mock.AsyncMock()
+        results = self.get_paginated_results()
+        in_flight = max_in_flight = 0
+
+        async def _get(url, params):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            page_number = params.get("page_number", 1)
+            # Make the later pages come back first
+            await asyncio.sleep(0.01 * (self.PAGINATE_TOTAL_PAGES - page_number))
+            in_flight -= 1
+            response = mock.Mock()
+            response.json.return_value = results[page_number - 1]
+            return response
+
+        client.client.get.side_effect = _get
+
+        result = [x async for x in client.get_paginated("/foo", params={"foo": "bar"})]
+
+        assert len(result) == self.PAGINATE_TOTAL_PAGES * self.PAGINATE_PER_PAGE
+        assert all(i == item["boop"] for i, item in enumerate(result))
+        assert client.client.get.await_count == self.PAGINATE_TOTAL_PAGES
+        assert client.client.get.await_args_list[-1] == mock.call(
+            "/foo", params={"foo": "bar", "page_number": self.PAGINATE_TOTAL_PAGES}
+        )
+        assert max_in_flight == 2
+
+    async def test_get_paginated_concurrent_stop_early(self):
+        client = ConcurrentAPIClient()
+        client.client = mock.AsyncMock()
+        client.client.get.side_effect = self.get_paginated_responses()
+
+        paginated = client.get_paginated("/foo")
+        async for item in paginated:
+            if item["boop"] == self.PAGINATE_PER_PAGE:
+                break
+        await paginated.aclose()
+
+        # The first page, the one being read and the next one
+        assert client.client.get.await_count == 3
+
+
+async def test_single_flight():
+    calls = []
+    release = asyncio.Event()
+
+    @base.single_flight
+    async def fetch(key, *, flag=False):
+        calls.append((key, flag))
+        await release.wait()
+        return [key]
+
+    tasks = [
+        asyncio.ensure_future(coro)
+        for coro in (fetch("a"), fetch("a"), fetch("b"), fetch("a", flag=True), fetch("a"))
+    ]
+    await asyncio.sleep(0)
+    # One caller going away doesn't cancel the call for the others
+    tasks[0].cancel()
+    release.set()
+    results = await asyncio.gather(*tasks[1:])
+
+    assert results == [["a"], ["b"], ["a"], ["a"]]
+    assert results[0] is results[3]
+    assert calls == [("a", False), ("b", False), ("a", True)]
+
+    # Nothing is kept once the call is done
+    assert await fetch("a") == ["a"]
+    assert len(calls) == 4
+
+
+async def test_single_flight_exception():
+    @base.single_flight
+    async def fetch(key):
+        await asyncio.sleep(0)
+        raise ValueError(key)
+
+    results = await asyncio.gather(fetch("a"), fetch("a"), return_exceptions=True)
+    assert results[0] is results[1]
+    assert isinstance(results[0], ValueError)
+
+
+async def test_single_flight_unhashable():
+    @base.single_flight
+    async def fetch(key):
+        return key
+
+    assert await fetch(["a"]) == ["a"]
+
+
+@pytest.mark.parametrize("h2_installed", (True, False))
+def test_get_client_kwargs(h2_installed, mocker, caplog):
+    find_spec = mocker.patch("importlib.util.find_spec", return_value=object())
+    if not h2_installed:
+        find_spec.return_value = None
+    services = ServicesModel(
+        max_concurrent_requests=3,
+        http_pool={
+            "http2": True,
+            "max_connections": 10,
+            "connect_timeout": 5,
+            "read_timeout": None,
+        },
+    )
+
+    kwargs = base.get_client_kwargs(services)
+
+    find_spec.assert_called_once_with("h2")
+    assert kwargs["max_concurrent_requests"] == 3
+    assert kwargs["http2"] is h2_installed
+    assert kwargs["limits"].max_connections == 10
+    assert kwargs["timeout"] == httpx.Timeout(None, connect=5)
+    if not h2_installed:
+        assert "the h2 package is missing" in caplog.text
+
+    client = ConcreteAPIClient(**kwargs)
+    assert client.client.timeout.connect == 5
+
+
+def test_get_client_kwargs_http2_disabled(mocker, caplog):
+    find_spec = mocker.patch("importlib.util.find_spec")
+    kwargs = base.get_client_kwargs(ServicesModel(http_pool={"http2": False}))
+    assert kwargs["http2"] is False
+    find_spec.assert_not_called()
+    assert "the h2 package is missing" not in caplog.text
+
 
-@pytest.mark.parametrize("testcase", ("success", "raises-exception"))
+@pytest.mark.parametrize("testcase", ("success", "raises-exception", "raises-timeout"))
 async def test_handle_http_error(testcase, mocker):
     async def fn_to_be_decorated():
         if "raises-exception" in testcase:
             raise httpx.HTTPStatusError(
                 "Boo.", request=None, response=httpx.Response(status_code=404)
             )
+        elif "raises-timeout" in testcase:
+            raise httpx.ReadTimeout("Boo.")
         else:
             return ["item"]
 
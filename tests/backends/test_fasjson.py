@@ -2,9 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
-import asyncio
 import logging
-import re
 from itertools import chain
 from unittest import mock
 
@@ -12,7 +10,7 @@ import httpx
 import pytest
 
 from fmn.backends import fasjson
-from fmn.cache.util import get_pattern_for_cached_calls
+from fmn.core.config import ServicesModel
 
 from .base import BaseTestAsyncProxy
 
@@ -70,6 +68,29 @@ class TestFASJSONAsyncProxy(BaseTestAsyncProxy):
         else:
             assert next_url is None
 
+    @pytest.mark.parametrize("testcase", ("normal", "last-page", "pagination-missing"))
+    def test_determine_remaining_pages_params(self, testcase, proxy):
+        page = 1
+        if "last-page" in testcase:
+            page = 3
+
+        if "pagination-missing" in testcase:
+            result = {}
+        else:
+            result = {"page": {"page_number": page, "total_pages": 3}}
+
+        pages = proxy.determine_remaining_pages_params("/boo", params={"foo": "bar"}, result=result)
+
+        if "normal" in testcase:
+            assert pages == [
+                ("/boo", {"foo": "bar", "page_number": 2}),
+                ("/boo", {"foo": "bar", "page_number": 3}),
+            ]
+        elif "last-page" in testcase:
+            assert pages == []
+        else:
+            assert pages is None
+
     async def test_get_user_groups_failure(self, respx_mocker, proxy_unmocked_client):
         route = respx_mocker.get(f"{self.expected_api_url}/users/boop/groups/").mock(
             side_effect=httpx.Response(status_code=500)
@@ -94,11 +115,7 @@ class TestFASJSONAsyncProxy(BaseTestAsyncProxy):
         ),
     )
     async def test_invalidate_on_message(self, mocker, testcase, proxy, caplog):
-        cache = mocker.patch("fmn.backends.fasjson.cache")
-        cache.delete = mock.AsyncMock()
-
-        asyncio_create_task = mocker.patch.object(asyncio, "create_task", wraps=asyncio.create_task)
-        asyncio_gather = mocker.patch.object(asyncio, "gather", wraps=asyncio.gather)
+        delete_tags = mocker.patch("fmn.backends.fasjson.delete_tags", return_value={})
 
         if isinstance(testcase, tuple):
             testcase, topic = testcase
@@ -106,8 +123,7 @@ class TestFASJSONAsyncProxy(BaseTestAsyncProxy):
             topic = "user.create"
 
         if "with-exceptions" in testcase:
-            # 4 keys to delete, let's muck up the last
-            cache.delete.side_effect = [object(), object(), object(), RuntimeError("BOO")]
+            delete_tags.return_value = {"some-tag": RuntimeError("BOO")}
 
         # basic (incomplete) message
         message = mock.Mock(topic=f"org.fedoraproject.prod.fas.{topic}", body={"user": "testuser"})
@@ -121,74 +137,70 @@ class TestFASJSONAsyncProxy(BaseTestAsyncProxy):
         if "skip-other-topic" in testcase:
             message.topic = "this.is.not.the.message.you’re.looking.for"
 
-        # Make up cache keys to be deleted
-
-        async def mocked_cache_get_match(pattern):
-            kwargs = {"self": proxy}
-
-            if ".search_users:" in pattern:
-                func = proxy.search_users
-                kwargs["username__exact"] = None if ":username__exact::" in pattern else user
-            elif ".get_user:" in pattern:
-                func = proxy.get_user
-                kwargs["username"] = user
-            elif ".get_user_groups:" in pattern:
-                func = proxy.get_user_groups
-                kwargs["username"] = user
-
-            key = get_pattern_for_cached_calls(func, **kwargs)[0]
-
-            yield key, None
-
-        cache.get_match.side_effect = mocked_cache_get_match
-
         with caplog.at_level(logging.DEBUG):
             await proxy.invalidate_on_message(message, None)
 
         if "success" not in testcase:
-            asyncio_create_task.assert_not_called()
-            asyncio_gather.assert_not_called()
-            cache.delete.assert_not_called()
+            delete_tags.assert_not_called()
 
             if "missing-user" in testcase:
                 assert "No information found about affected user" in caplog.text
             elif "other-topic" in testcase:
                 assert "Skipping message with topic" in caplog.text
         else:
-            assert any(
-                f":FASJSONAsyncProxy.search_users:self:{proxy}:" in call.args[0]
-                and ":username__exact::" in call.args[0]
-                for call in cache.delete.await_args_list
-            )
-            assert any(
-                f":FASJSONAsyncProxy.search_users:self:{proxy}:" in call.args[0]
-                and f":username__exact:{user}:" in call.args[0]
-                for call in cache.delete.await_args_list
-            )
-            assert any(
-                f":FASJSONAsyncProxy.get_user:self:{proxy}:" in call.args[0]
-                and re.search(rf":username:{user}(?::|$)", call.args[0])
-                for call in cache.delete.await_args_list
+            delete_tags.assert_awaited_once_with(
+                [
+                    f"{proxy}:search_users",
+                    f"{proxy}:user:{user}",
+                    f"{proxy}:user_groups:{user}",
+                ]
             )
-            assert any(
-                f":FASJSONAsyncProxy.get_user_groups:self:{proxy}:" in call.args[0]
-                and re.search(rf":username:{user}(?::|$)", call.args[0])
-                for call in cache.delete.await_args_list
-            )
-            assert len(cache.delete.await_args_list) == 4
 
             if "with-exceptions" in testcase:
-                assert "Deleting 4 cache entries yielded 1 exception(s):" in caplog.text
+                assert "Deleting the cache entries of 3 tags yielded 1 exception(s):" in caplog.text
+                assert "some-tag: RuntimeError('BOO')" in caplog.text
+
+    @pytest.mark.cashews_cache(enabled=True)
+    async def test_invalidate_on_message_tagged(self, proxy):
+        proxy.get_payload = mock.AsyncMock(side_effect=lambda url: url)
+        assert await proxy.get_user(username="testuser") == "/users/testuser/"
+        assert await proxy.get_user(username="other") == "/users/other/"
+        assert await proxy.get_user_groups(username="testuser") == "/users/testuser/groups/"
+        proxy.local_cache.clear()
+        message = mock.Mock(
+            topic="org.fedoraproject.prod.fas.user.update", body={"user": "testuser"}
+        )
+
+        await proxy.invalidate_on_message(message, None)
+
+        assert proxy.get_payload.await_count == 3
+        await proxy.get_user(username="testuser")
+        await proxy.get_user(username="other")
+        await proxy.get_user_groups(username="testuser")
+        assert proxy.get_payload.await_count == 5
+
+    async def test_invalidate_on_message_local_cache(self, mocker, proxy):
+        mocker.patch("fmn.backends.fasjson.cache")
+        local_cache = mocker.patch.object(proxy, "local_cache")
+        message = mock.Mock(topic="org.fedoraproject.prod.fas.user.update", body={"user": "dude"})
+
+        await proxy.invalidate_on_message(message, None)
+
+        assert local_cache.invalidate.call_args_list == [
+            mock.call(proxy.get_user, username="dude"),
+            mock.call(proxy.get_user_groups, username="dude"),
+        ]
 
 
 @mock.patch("fmn.backends.fasjson.get_settings")
 def test_get_fasjson_proxy(get_settings):
     settings = mock.Mock()
-    settings.services.fasjson_url = "http://foo"
+    settings.services = ServicesModel(fasjson_url="http://foo.test", max_concurrent_requests=5)
     get_settings.return_value = settings
 
     proxy = fasjson.get_fasjson_proxy()
-    assert str(proxy.client.base_url).rstrip("/") == "http://foo/v1"
+    assert str(proxy.client.base_url).rstrip("/") == "http://foo.test/v1"
+    assert proxy._requests_semaphore._value == 5
 
     cached_proxy = fasjson.get_fasjson_proxy()
     assert cached_proxy is proxy
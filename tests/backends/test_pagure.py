@@ -12,7 +12,7 @@ import httpx
 import pytest
 
 from fmn.backends import PagureAsyncProxy, PagureRole, get_distgit_proxy
-from fmn.cache.util import get_pattern_for_cached_calls
+from fmn.core.config import ServicesModel
 
 from .base import BaseTestAsyncProxy
 
@@ -290,6 +290,49 @@ class TestPagureAsyncProxy(BaseTestAsyncProxy):
         assert route.called
         assert projects == non_duplicate_projects
 
+    async def test_get_group_projects_multiple_roles(self, respx_mocker, proxy_unmocked_client):
+        def make_project(name):
+            return {"name": name, "fullname": f"rpms/{name}"}
+
+        projects_by_role = {
+            "admin": [make_project("b"), make_project("c")],
+            "commit": [make_project("a"), make_project("b")],
+            "collaborator": [],
+        }
+        routes = [
+            respx_mocker.get(
+                f"{self.expected_api_url}/group/provenpackager",
+                params={"projects": True, "acl": role},
+            ).mock(
+                return_value=httpx.Response(
+                    fastapi.status.HTTP_200_OK,
+                    json={"projects": projects, "pagination": {"next": None}},
+                )
+            )
+            for role, projects in projects_by_role.items()
+        ]
+
+        projects = await proxy_unmocked_client.get_group_projects(
+            name="provenpackager", acl=PagureRole.GROUP_ROLES_MAINTAINER
+        )
+
+        assert all(route.call_count == 1 for route in routes)
+        assert projects == [make_project("a"), make_project("b"), make_project("c")]
+
+    async def test_get_project_users_single_flight(self, respx_mocker, proxy_unmocked_client):
+        route = respx_mocker.get(f"{self.expected_api_url}/rpms/foo").mock(
+            return_value=httpx.Response(
+                fastapi.status.HTTP_200_OK, json={"access_users": {"owner": ["dude"]}}
+            )
+        )
+
+        results = await asyncio.gather(
+            *(proxy_unmocked_client.get_project_users(project_path="rpms/foo") for _ in range(3))
+        )
+
+        assert results == [["dude"]] * 3
+        assert route.call_count == 1
+
     async def test_get_group_projects_failure(self, respx_mocker, proxy_unmocked_client):
         route = respx_mocker.get(f"{self.expected_api_url}/group/provenpackager").mock(
             side_effect=[httpx.Response(fastapi.status.HTTP_404_NOT_FOUND)]
@@ -319,11 +362,7 @@ class TestPagureAsyncProxy(BaseTestAsyncProxy):
         ),
     )
     async def test_invalidate_on_message(self, mocker, testcase, proxy, caplog):
-        cache = mocker.patch("fmn.backends.pagure.cache")
-        cache.delete = mock.AsyncMock()
-
-        asyncio_create_task = mocker.patch.object(asyncio, "create_task", wraps=asyncio.create_task)
-        asyncio_gather = mocker.patch.object(asyncio, "gather", wraps=asyncio.gather)
+        delete_tags = mocker.patch("fmn.backends.pagure.delete_tags", return_value={})
 
         if isinstance(testcase, tuple):
             testcase, usergroup, action = testcase
@@ -332,8 +371,7 @@ class TestPagureAsyncProxy(BaseTestAsyncProxy):
             action = "access.updated"
 
         if "with-exceptions" in testcase:
-            # 4 keys to delete, let's muck up the last
-            cache.delete.side_effect = [object(), object(), object(), RuntimeError("BOO")]
+            delete_tags.return_value = {"some-tag": RuntimeError("BOO")}
 
         # basic (incomplete) message
         message = mock.Mock(
@@ -372,40 +410,11 @@ class TestPagureAsyncProxy(BaseTestAsyncProxy):
             case "skip-other-pagure-instance":
                 project["full_url"] = "https://pagure.io/fedora-infra/ansible"
 
-        # Make up cache keys to be deleted
-
-        async def mocked_cache_get_match(pattern):
-            kwargs = {"self": proxy}
-
-            if ".get_project_users:" in pattern:
-                func = proxy.get_project_users
-                kwargs["project_path"] = "rpms/bash"
-                kwargs["roles"] = None
-            elif ".get_projects:" in pattern:
-                func = proxy.get_projects
-                kwargs["username"] = None if ":username::" in pattern else "the-user"
-                kwargs["owner"] = None if ":owner::" in pattern else "the-user"
-            elif ".get_project_groups:" in pattern:
-                func = proxy.get_project_groups
-                kwargs["project_path"] = "rpms/bash"
-                kwargs["roles"] = None
-            elif ".get_group_projects:" in pattern:
-                func = proxy.get_group_projects
-                kwargs["name"] = "the-group"
-
-            key = get_pattern_for_cached_calls(func, **kwargs)[0]
-
-            yield key, None
-
-        cache.get_match.side_effect = mocked_cache_get_match
-
         with caplog.at_level(logging.DEBUG):
             await proxy.invalidate_on_message(message, None)
 
         if "success" not in testcase:
-            asyncio_create_task.assert_not_called()
-            asyncio_gather.assert_not_called()
-            cache.delete.assert_not_called()
+            delete_tags.assert_not_called()
 
             if "missing-affected" in testcase:
                 assert f"No affected {usergroup} found" in caplog.text
@@ -421,55 +430,84 @@ class TestPagureAsyncProxy(BaseTestAsyncProxy):
                 assert "Skipping message for different Pagure instance" in caplog.text
         else:
             if usergroup == "user":
-                assert any(
-                    f":PagureAsyncProxy.get_project_users:self:{proxy}:" in call.args[0]
-                    and ":project_path:rpms/bash:" in call.args[0]
-                    for call in cache.delete.await_args_list
+                delete_tags.assert_awaited_once_with(
+                    [f"{proxy}:project_users:rpms/bash", f"{proxy}:projects"]
                 )
-                assert any(
-                    f":PagureAsyncProxy.get_projects:self:{proxy}:" in call.args[0]
-                    and ":username::"
-                    and ":owner::" in call.args[0]
-                    for call in cache.delete.await_args_list
-                )
-                assert any(
-                    f":PagureAsyncProxy.get_projects:self:{proxy}:" in call.args[0]
-                    and ":username:the-user:"
-                    and ":owner::" in call.args[0]
-                    for call in cache.delete.await_args_list
-                )
-                assert any(
-                    f":PagureAsyncProxy.get_projects:self:{proxy}:" in call.args[0]
-                    and ":username::"
-                    and ":owner:the-user:" in call.args[0]
-                    for call in cache.delete.await_args_list
-                )
-                assert len(cache.delete.await_args_list) == 4
             elif usergroup == "group":
-                assert any(
-                    f":PagureAsyncProxy.get_project_groups:self:{proxy}:" in call.args[0]
-                    and ":project_path:rpms/bash:" in call.args[0]
-                    for call in cache.delete.await_args_list
+                delete_tags.assert_awaited_once_with(
+                    [f"{proxy}:project_groups:rpms/bash", f"{proxy}:group_projects:the-group"]
                 )
-                assert any(
-                    f":PagureAsyncProxy.get_group_projects:self:{proxy}:" in call.args[0]
-                    and ":name:the-group:" in call.args[0]
-                    for call in cache.delete.await_args_list
-                )
-                assert len(cache.delete.await_args_list) == 2
 
             if "with-exceptions" in testcase:
-                assert "Deleting 4 cache entries yielded 1 exception(s):" in caplog.text
+                assert "Deleting the cache entries of 2 tags yielded 1 exception(s):" in caplog.text
+                assert "some-tag: RuntimeError('BOO')" in caplog.text
+
+    @pytest.mark.cashews_cache(enabled=True)
+    async def test_invalidate_on_message_tagged(self, proxy):
+        proxy.get = mock.AsyncMock(return_value={"access_users": {"owner": ["the-user"]}})
+        await proxy.get_project_users(project_path="rpms/bash")
+        await proxy.get_project_users(project_path="rpms/other")
+        proxy.local_cache.clear()
+        message = mock.Mock(
+            topic="org.fedoraproject.prod.pagure.project.user.added",
+            body={
+                "project": {"fullname": "rpms/bash", "full_url": f"{self.URL}/rpms/bash"},
+                "new_user": "the-user",
+            },
+        )
+
+        await proxy.invalidate_on_message(message, None)
+
+        await proxy.get_project_users(project_path="rpms/bash")
+        await proxy.get_project_users(project_path="rpms/other")
+        assert [call.args for call in proxy.get.await_args_list] == [
+            ("rpms/bash",),
+            ("rpms/other",),
+            ("rpms/bash",),
+        ]
+
+    @pytest.mark.parametrize("usergroup", ("user", "group"))
+    async def test_invalidate_on_message_local_cache(self, mocker, usergroup, proxy):
+        mocker.patch("fmn.backends.pagure.cache")
+        local_cache = mocker.patch.object(proxy, "local_cache")
+        message = mock.Mock(
+            topic=f"org.fedoraproject.prod.pagure.project.{usergroup}.added",
+            body={
+                "project": {"fullname": "rpms/bash", "full_url": f"{self.URL}/rpms/bash"},
+                f"new_{usergroup}": f"the-{usergroup}",
+            },
+        )
+
+        await proxy.invalidate_on_message(message, None)
+
+        if usergroup == "user":
+            assert local_cache.invalidate.call_args_list == [
+                mock.call(proxy.get_project_users, project_path="rpms/bash"),
+                mock.call(proxy.get_projects, username=None, owner=None),
+                mock.call(proxy.get_projects, username="the-user"),
+                mock.call(proxy.get_projects, owner="the-user"),
+            ]
+        else:
+            assert local_cache.invalidate.call_args_list == [
+                mock.call(proxy.get_project_groups, project_path="rpms/bash"),
+                mock.call(proxy.get_group_projects, name="the-group"),
+            ]
 
 
 @mock.patch("fmn.backends.pagure.get_settings")
 def test_get_distgit_proxy(get_settings):
     settings = mock.Mock()
-    settings.services.distgit_url = "http://foo"
+    settings.services = ServicesModel(
+        distgit_url="http://foo.test",
+        max_concurrent_requests=None,
+        http_pool={"http2": False, "read_timeout": 30},
+    )
     get_settings.return_value = settings
 
     proxy = get_distgit_proxy()
-    assert str(proxy.client.base_url).rstrip("/") == "http://foo/api/0"
+    assert str(proxy.client.base_url).rstrip("/") == "http://foo.test/api/0"
+    assert proxy._requests_semaphore is None
+    assert proxy.client.timeout.read == 30
 
     cached_proxy = get_distgit_proxy()
     assert cached_proxy is proxy
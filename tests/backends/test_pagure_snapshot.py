@@ -0,0 +1,259 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from unittest import mock
+
+import httpx
+import pytest
+
+from fmn.backends import PagureAsyncProxy, PagureRole
+from fmn.backends.pagure_snapshot import RETRY_DELAY, OwnershipIndex, PagureSnapshotProxy
+
+URL = "https://pagure.test"
+
+
+def make_project(namespace, name, users=None, groups=None):
+    return {
+        "name": name,
+        "namespace": namespace,
+        "fullname": f"{namespace}/{name}",
+        "full_url": f"{URL}/{namespace}/{name}",
+        "access_users": users or {},
+        "access_groups": groups or {},
+    }
+
+
+PROJECTS = [
+    make_project("rpms", "pkg1", users={"owner": ["user1"], "ticket": ["user2"]}),
+    make_project("rpms", "pkg2", users={"commit": ["user2"]}, groups={"commit": ["group1"]}),
+    make_project("containers", "ctr1", users={"owner": ["user1"]}, groups={"ticket": ["group1"]}),
+]
+
+
+@pytest.fixture
+def snapshot_proxy(mocker):
+    proxy = PagureAsyncProxy(URL)
+    by_namespace = {}
+    for project in PROJECTS:
+        by_namespace.setdefault(project["namespace"], []).append(project)
+
+    async def get_paginated(url, *, params, payload_field):
+        for project in by_namespace.get(params["namespace"], []):
+            yield project
+
+    mocker.patch.object(proxy, "get_paginated", side_effect=get_paginated)
+    return PagureSnapshotProxy(proxy)
+
+
+def test_ownership_index():
+    index = OwnershipIndex(PROJECTS)
+    assert [p["fullname"] for p in index.get_user_projects("user1")] == [
+        "containers/ctr1",
+        "rpms/pkg1",
+    ]
+    # Ticket access does not make a maintainer
+    assert [p["fullname"] for p in index.get_user_projects("user2")] == ["rpms/pkg2"]
+    assert [
+        p["fullname"] for p in index.get_group_projects("group1", PagureRole.GROUP_ROLES_MAINTAINER)
+    ] == ["rpms/pkg2"]
+    assert [p["fullname"] for p in index.get_group_projects("group1")] == [
+        "containers/ctr1",
+        "rpms/pkg2",
+    ]
+    assert index.get_project_users("rpms/pkg1", PagureRole.USER_ROLES_MAINTAINER) == ["user1"]
+    assert index.get_project_users("rpms/pkg1", PagureRole.USER_ROLES) == ["user1", "user2"]
+    assert index.get_project_groups("rpms/pkg2", PagureRole.GROUP_ROLES_MAINTAINER) == ["group1"]
+    assert index.get_project_users("rpms/unknown", PagureRole.USER_ROLES) is None
+    assert index.get_project_groups("rpms/unknown", PagureRole.GROUP_ROLES) is None
+
+
+def test_ownership_index_set_project():
+    index = OwnershipIndex(PROJECTS)
+    index.set_project(make_project("rpms", "pkg1", users={"owner": ["user3"]}))
+    assert [p["fullname"] for p in index.get_user_projects("user1")] == ["containers/ctr1"]
+    assert [p["fullname"] for p in index.get_user_projects("user3")] == ["rpms/pkg1"]
+    assert "user2" in index._by_user
+    index.set_project(make_project("rpms", "pkg2"))
+    assert "user2" not in index._by_user
+    assert index._by_group == {"group1": {"containers/ctr1"}}
+
+
+async def test_snapshot_proxy(snapshot_proxy):
+    projects = await snapshot_proxy.get_user_projects(username="user1")
+    assert [p["fullname"] for p in projects] == ["containers/ctr1", "rpms/pkg1"]
+    projects = await snapshot_proxy.get_group_projects(
+        name="group1", acl=PagureRole.GROUP_ROLES_MAINTAINER
+    )
+    assert [p["fullname"] for p in projects] == ["rpms/pkg2"]
+    assert await snapshot_proxy.get_project_users(project_path="rpms/pkg2") == ["user2"]
+    assert await snapshot_proxy.get_project_groups(project_path="rpms/pkg2") == ["group1"]
+    # The snapshot is only fetched once, for each namespace
+    assert snapshot_proxy._proxy.get_paginated.call_count == 4
+    # Other attributes come from the proxy
+    assert snapshot_proxy.base_url == URL
+
+
+async def test_snapshot_proxy_unknown_project(snapshot_proxy, mocker):
+    get_project_users = mocker.patch.object(
+        snapshot_proxy._proxy, "get_project_users", return_value=["someone"]
+    )
+    assert await snapshot_proxy.get_project_users(project_path="rpms/other") == ["someone"]
+    get_project_users.assert_called_once_with(
+        project_path="rpms/other", roles=PagureRole.USER_ROLES_MAINTAINER
+    )
+    get_project_groups = mocker.patch.object(
+        snapshot_proxy._proxy, "get_project_groups", return_value=["somegroup"]
+    )
+    assert await snapshot_proxy.get_project_groups(project_path="rpms/other") == ["somegroup"]
+    get_project_groups.assert_called_once_with(
+        project_path="rpms/other", roles=PagureRole.GROUP_ROLES_MAINTAINER
+    )
+
+
+async def test_snapshot_proxy_expired(snapshot_proxy, mocker):
+    monotonic = mocker.patch("fmn.backends.pagure_snapshot.monotonic", return_value=1000)
+    await snapshot_proxy.get_user_projects(username="user1")
+    index = snapshot_proxy._index
+    monotonic.return_value = 1000 + 3600
+    # The previous index is used while the snapshot is fetched again in the background
+    projects = await snapshot_proxy.get_user_projects(username="user1")
+    assert [p["fullname"] for p in projects] == ["containers/ctr1", "rpms/pkg1"]
+    assert snapshot_proxy._index is index
+    await snapshot_proxy._refresh_task
+    assert snapshot_proxy._proxy.get_paginated.call_count == 8
+    assert snapshot_proxy._index is not index
+
+
+async def http_error(url, *, params, payload_field):
+    raise httpx.HTTPStatusError("dummy", request=mock.Mock(), response=mock.Mock())
+    yield  # pragma: no cover
+
+
+async def test_snapshot_proxy_error(snapshot_proxy, mocker, caplog):
+    monotonic = mocker.patch("fmn.backends.pagure_snapshot.monotonic", return_value=1000)
+    get_paginated = snapshot_proxy._proxy.get_paginated
+    get_paginated.side_effect = http_error
+    proxy_methods = {
+        name: mocker.patch.object(snapshot_proxy._proxy, name, return_value=[])
+        for name in (
+            "get_user_projects",
+            "get_group_projects",
+            "get_project_users",
+            "get_project_groups",
+        )
+    }
+    # Without a snapshot, the queries go to the wrapped proxy
+    assert await snapshot_proxy.get_user_projects(username="user1") == []
+    assert await snapshot_proxy.get_group_projects(name="group1") == []
+    assert await snapshot_proxy.get_project_users(project_path="rpms/pkg1") == []
+    assert await snapshot_proxy.get_project_groups(project_path="rpms/pkg1") == []
+    proxy_methods["get_user_projects"].assert_called_once_with(username="user1")
+    proxy_methods["get_group_projects"].assert_called_once_with(name="group1", acl=None)
+    assert "Could not fetch the ownership snapshot" in caplog.text
+    # The snapshot is not fetched again on every call
+    assert get_paginated.call_count == 4
+    monotonic.return_value = 1000 + RETRY_DELAY
+    get_paginated.side_effect = None
+    get_paginated.reset_mock()
+    await snapshot_proxy.get_user_projects(username="user1")
+    assert snapshot_proxy._index is not None
+    assert get_paginated.call_count == 4
+
+
+async def timeout_error(url, *, params, payload_field):
+    raise httpx.ReadTimeout("dummy")
+    yield  # pragma: no cover
+
+
+@pytest.mark.parametrize("error", (http_error, timeout_error))
+async def test_snapshot_proxy_refresh_error(snapshot_proxy, mocker, error):
+    monotonic = mocker.patch("fmn.backends.pagure_snapshot.monotonic", return_value=1000)
+    await snapshot_proxy.get_user_projects(username="user1")
+    index = snapshot_proxy._index
+    monotonic.return_value = 1000 + 3600
+    snapshot_proxy._proxy.get_paginated.side_effect = error
+    await snapshot_proxy.get_user_projects(username="user1")
+    await snapshot_proxy._refresh_task
+    # The previous index is kept
+    assert snapshot_proxy._index is index
+    assert snapshot_proxy._expires_at == 1000 + 3600 + RETRY_DELAY
+
+
+async def test_snapshot_proxy_refresh_crash(snapshot_proxy, mocker, caplog):
+    monotonic = mocker.patch("fmn.backends.pagure_snapshot.monotonic", return_value=1000)
+    await snapshot_proxy.get_user_projects(username="user1")
+    monotonic.return_value = 1000 + 3600
+    snapshot_proxy._proxy.get_paginated.side_effect = ValueError("boom")
+    await snapshot_proxy.get_user_projects(username="user1")
+    with pytest.raises(ValueError):
+        await snapshot_proxy._refresh_task
+    # Let the done callback run
+    await asyncio.sleep(0)
+    assert "Could not refresh the ownership snapshot" in caplog.text
+
+
+async def test_snapshot_proxy_message(snapshot_proxy, mocker, make_mocked_message):
+    invalidate_on_message = mocker.patch.object(snapshot_proxy._proxy, "invalidate_on_message")
+    await snapshot_proxy.get_user_projects(username="user1")
+    project = make_project("rpms", "pkg1", users={"owner": ["user1", "user3"]})
+    message = make_mocked_message(
+        topic="pagure.project.user.added", body={"project": project, "new_user": "user3"}
+    )
+    assert snapshot_proxy.may_invalidate(message)
+    db = object()
+    await snapshot_proxy.invalidate_on_message(message, db)
+    invalidate_on_message.assert_called_once_with(message, db)
+    assert await snapshot_proxy.get_project_users(project_path="rpms/pkg1") == ["user1", "user3"]
+
+
+async def test_snapshot_proxy_message_fetch_project(snapshot_proxy, mocker, make_mocked_message):
+    mocker.patch.object(snapshot_proxy._proxy, "invalidate_on_message")
+    get = mocker.patch.object(
+        snapshot_proxy._proxy,
+        "get",
+        return_value=make_project("rpms", "pkg2", groups={"admin": ["group2"]}),
+    )
+    await snapshot_proxy.get_user_projects(username="user1")
+    project = make_project("rpms", "pkg2")
+    del project["access_users"]
+    del project["access_groups"]
+    message = make_mocked_message(
+        topic="pagure.project.group.added", body={"project": project, "new_group": "group2"}
+    )
+    await snapshot_proxy.invalidate_on_message(message, object())
+    get.assert_called_once_with("rpms/pkg2")
+    assert await snapshot_proxy.get_project_groups(project_path="rpms/pkg2") == ["group2"]
+
+    # If the project can't be fetched, the whole snapshot will be fetched again
+    get.side_effect = httpx.HTTPStatusError("dummy", request=mock.Mock(), response=mock.Mock())
+    await snapshot_proxy.invalidate_on_message(message, object())
+    assert snapshot_proxy._expires_at == 0
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"project": make_project("rpms", "pkg1") | {"full_url": "https://other.test/rpms/pkg1"}},
+        {"project": make_project("tests", "pkg1")},
+        {},
+    ],
+    ids=["other-instance", "other-namespace", "no-project"],
+)
+async def test_snapshot_proxy_message_ignored(snapshot_proxy, mocker, make_mocked_message, body):
+    mocker.patch.object(snapshot_proxy._proxy, "invalidate_on_message")
+    await snapshot_proxy.get_user_projects(username="user1")
+    set_project = mocker.patch.object(snapshot_proxy._index, "set_project")
+    message = make_mocked_message(topic="pagure.project.user.added", body=body)
+    await snapshot_proxy.invalidate_on_message(message, object())
+    set_project.assert_not_called()
+
+
+async def test_snapshot_proxy_message_not_loaded(snapshot_proxy, mocker, make_mocked_message):
+    mocker.patch.object(snapshot_proxy._proxy, "invalidate_on_message")
+    message = make_mocked_message(
+        topic="pagure.project.user.added", body={"project": make_project("rpms", "pkg1")}
+    )
+    await snapshot_proxy.invalidate_on_message(message, object())
+    assert snapshot_proxy._index is None
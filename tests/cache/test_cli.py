@@ -47,12 +47,15 @@ def test_delete_tracked(mocker, cli_runner):
     configure_cache = mocker.patch("fmn.cache.cli.configure_cache")
     cache = mocker.patch("fmn.cache.base.cache")
     cache.delete = mock.AsyncMock()
+    cache.incr = mock.AsyncMock()
 
     result = cli_runner.invoke(cli, ["cache", "delete-tracked"])
 
     assert result.exit_code == 0, result.output
     configure_cache.assert_called_once_with()
-    cache.delete.assert_called_once_with("v1:tracked")
+    cache.delete.assert_called_once_with("v2:tracked")
+    # The processes holding a local copy will fetch it again
+    cache.incr.assert_called_once_with("v2:tracked:version")
 
 
 @pytest.mark.cashews_cache(enabled=True)
@@ -65,9 +68,9 @@ def test_refresh_new(mocker, cli_runner, mocked_session_maker):
 @pytest.mark.cashews_cache(enabled=True)
 def test_refresh_recent(mocker, cli_runner, mocked_session_maker, persistent_cache):
     async def _set_cache():
-        # Set the expiration higher than early_ttl
-        await cache.set("v1:rules", value="dummy", expire=86400)
-        await cache.set("v1:tracked", value="dummy", expire=86400)
+        # Set the expiration higher than early_ttl, past the time the values may be served stale
+        await cache.set("v2:rules", value="dummy", expire=86400 + 3600)
+        await cache.set("v2:tracked", value="dummy", expire=86400 + 6 * 3600)
 
     asyncio.run(_set_cache())
     result = cli_runner.invoke(cli, ["cache", "refresh"])
@@ -79,8 +82,8 @@ def test_refresh_recent(mocker, cli_runner, mocked_session_maker, persistent_cac
 def test_refresh_old(mocker, cli_runner, mocked_session_maker, persistent_cache):
     async def _set_cache():
         # Set the expiration lower than early_ttl
-        await cache.set("v1:rules", value="dummy", expire=42)
-        await cache.set("v1:tracked", value="dummy", expire=42)
+        await cache.set("v2:rules", value="dummy", expire=42)
+        await cache.set("v2:tracked", value="dummy", expire=42)
 
     asyncio.run(_set_cache())
 
@@ -118,6 +121,22 @@ def test_delete_locks(mocker, cli_runner):
     assert result.output == "Deleted lock for foo\nDeleted lock for bar\nCache locks deleted.\n"
 
 
+def test_delete_locks_failed(mocker, cli_runner):
+    async def _set_cache():
+        await cache.set("locked:foo", value="dummy")
+        await cache.set("locked:bar", value="dummy")
+
+    mocker.patch("fmn.cache.cli.configure_cache")
+    mocker.patch("fmn.cache.cli.delete_keys", return_value={"locked:bar": RuntimeError("BOO")})
+    asyncio.run(_set_cache())
+    result = cli_runner.invoke(cli, ["cache", "delete-locks"])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "Deleted lock for foo\nCould not delete lock for bar: BOO\nCache locks deleted.\n"
+    )
+
+
 @pytest.mark.cashews_cache(enabled=True)
 def test_get_build_durations(mocker, cli_runner):
     async def _set_cache():
@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import pytest
+from cashews import cache
+
+from fmn.cache.local import MISSING, LocalCache, local_cached
+
+
+@pytest.fixture
+def cache_args(mocker):
+    args = {"local_ttl": "1m", "local_max_size": 3}
+    mocker.patch("fmn.cache.local.cache_arg", side_effect=lambda arg, scope: lambda: args[arg])
+    return args
+
+
+@pytest.fixture
+def monotonic(mocker):
+    return mocker.patch("fmn.cache.local.monotonic", return_value=1000)
+
+
+def test_local_cache(cache_args, monotonic):
+    local_cache = LocalCache("scope")
+    assert local_cache.get("key") is MISSING
+    local_cache.set("key", "value")
+    assert local_cache.get("key") == "value"
+    monotonic.return_value = 1000 + 60
+    assert local_cache.get("key") is MISSING
+    assert len(local_cache) == 0
+
+
+def test_local_cache_lru(cache_args, monotonic):
+    local_cache = LocalCache("scope")
+    for key in ("key1", "key2", "key3"):
+        local_cache.set(key, key)
+    # Use key1 so that key2 is the least recently used
+    assert local_cache.get("key1") == "key1"
+    local_cache.set("key4", "key4")
+    assert len(local_cache) == 3
+    assert local_cache.get("key2") is MISSING
+    assert local_cache.get("key1") == "key1"
+
+
+def test_local_cache_disabled(cache_args):
+    cache_args["local_ttl"] = None
+    local_cache = LocalCache("scope")
+    local_cache.set("key", "value")
+    assert local_cache.get("key") is MISSING
+
+
+def test_local_cache_invalidate(cache_args):
+    def get_projects():
+        pass  # pragma: no cover
+
+    local_cache = LocalCache("scope")
+    local_cache.set(("get_projects", (("username", "dude"),)), 1)
+    local_cache.set(("get_projects", (("owner", "dude"),)), 2)
+    local_cache.set(("get_projects", (("namespace", "rpms"),)), 3)
+    local_cache.set(("get_users", (("username", "dude"),)), 4)
+
+    local_cache.invalidate(get_projects, username="dude")
+    assert len(local_cache) == 3
+    local_cache.invalidate(get_projects, username=None, owner=None)
+    assert len(local_cache) == 2
+    assert local_cache.get(("get_projects", (("owner", "dude"),))) == 2
+    local_cache.invalidate(get_projects)
+    assert len(local_cache) == 1
+
+
+class Proxy:
+    def __init__(self):
+        self.local_cache = LocalCache("scope")
+        self.calls = []
+
+    @local_cached
+    async def get_user(self, *, username):
+        self.calls.append(username)
+        return {"username": username}
+
+
+async def test_local_cached(cache_args):
+    proxy = Proxy()
+    assert await proxy.get_user(username="dude") == {"username": "dude"}
+    assert await proxy.get_user(username="dude") == {"username": "dude"}
+    assert await proxy.get_user(username="other") == {"username": "other"}
+    assert proxy.calls == ["dude", "other"]
+    proxy.local_cache.invalidate(Proxy.get_user, username="dude")
+    await proxy.get_user(username="dude")
+    assert proxy.calls == ["dude", "other", "dude"]
+    # Unhashable arguments
+    await proxy.get_user(username=["dude"])
+    await proxy.get_user(username=["dude"])
+    assert len(proxy.calls) == 5
+
+
+async def test_local_cached_cache_disabled(cache_args):
+    proxy = Proxy()
+    with cache.disabling():
+        await proxy.get_user(username="dude")
+        await proxy.get_user(username="dude")
+    assert proxy.calls == ["dude", "dude"]
+    assert len(proxy.local_cache) == 0
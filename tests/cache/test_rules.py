@@ -5,36 +5,98 @@
 import asyncio
 
 import pytest
+from cashews import cache
 
 from fmn.cache.rules import RulesCache
 from fmn.database import model
+from fmn.rules.compiled import (
+    CompiledDestination,
+    CompiledFilter,
+    CompiledGenerationRule,
+    CompiledRule,
+    CompiledTrackingRule,
+)
+
+
+def make_rule(user, name):
+    return model.Rule(
+        user=user,
+        name=name,
+        tracking_rule=model.TrackingRule(name="users-followed", params=["someone"]),
+        generation_rules=[
+            model.GenerationRule(
+                destinations=[model.Destination(protocol="email", address="dummy@example.com")],
+                filters=[model.Filter(name="applications", params=["koji"])],
+            )
+        ],
+    )
 
 
 @pytest.mark.cashews_cache(enabled=True)
 async def test_rules_cache(mocker, db_async_session):
     rc = RulesCache()
     user = model.User(name="dummy")
-    rule = model.Rule(user=user, name="the name")
+    rule = make_rule(user, "the name")
     db_async_session.add_all([user, rule])
     await db_async_session.commit()
 
+    expected = CompiledRule(
+        id=rule.id,
+        name="the name",
+        username="dummy",
+        tracking_rule=CompiledTrackingRule(
+            name="users-followed", params=["someone"], owner="dummy"
+        ),
+        generation_rules=(
+            CompiledGenerationRule(
+                id=rule.generation_rules[0].id,
+                filters=(CompiledFilter(name="applications", params=["koji"], username="dummy"),),
+                destinations=(CompiledDestination(protocol="email", address="dummy@example.com"),),
+            ),
+        ),
+    )
+
     # First call
     rules = await rc.get_rules(db=db_async_session)
-    assert len(rules) == 1
-    assert rules[0] in db_async_session
+    assert rules == [expected]
     await db_async_session.commit()
     # Clear the session cache to pretend we've restarted (or we're another instance)
     db_async_session.expunge_all()
-    # Call a second time
+    # Call a second time, the rules don't need the session
     rules = await rc.get_rules(db=db_async_session)
-    assert len(rules) == 1
-    assert rules[0] in db_async_session
+    assert rules == [expected]
+    assert not any(isinstance(obj, model.Rule) for obj in db_async_session)
+
+
+async def test_rules_cache_rule_ids(db_async_session):
+    rc = RulesCache()
+    user = model.User(name="dummy")
+    rules = [make_rule(user, f"rule {i}") for i in range(3)]
+    db_async_session.add_all([user, *rules])
+    await db_async_session.commit()
+
+    result = await rc.get_rules(db=db_async_session, rule_ids={rules[2].id, rules[0].id, 42})
+    assert [r.id for r in result] == [rules[0].id, rules[2].id]
+
+
+async def test_rules_cache_unknown_implementation(db_async_session, caplog):
+    rc = RulesCache()
+    user = model.User(name="dummy")
+    rules = [make_rule(user, f"rule {i}") for i in range(2)]
+    rules[1].tracking_rule.name = "does-not-exist"
+    db_async_session.add_all([user, *rules])
+    await db_async_session.commit()
+
+    result = await rc.get_rules(db=db_async_session)
+    assert [r.id for r in result] == [rules[0].id]
+    assert f"Could not compile rule {rules[1].id}, skipping it" in caplog.text
 
 
 async def test_rule_disabled(db_async_session):
     rc = RulesCache()
     user = model.User(name="dummy")
-    rule = model.Rule(user=user, name="the name", disabled=True)
+    rule = make_rule(user, "the name")
+    rule.disabled = True
     db_async_session.add_all([user, rule])
     await db_async_session.commit()
     rules = await rc.get_rules(db=db_async_session)
@@ -70,3 +132,148 @@ async def test_invalidate_on_message(mocker, topic, expected, make_mocked_messag
         rc.invalidate.assert_called_once_with(db)
     else:
         rc.invalidate.assert_not_called()
+
+
+async def test_invalidate_on_message_rule(mocker, make_mocked_message):
+    message = make_mocked_message(
+        topic="fmn.rule.delete.v1", body={"rule": {"id": 42}, "user": {"name": "dummy"}}
+    )
+    rc = RulesCache()
+    mocker.patch.object(rc, "invalidate")
+    mocker.patch.object(rc, "update_rule")
+    await rc.invalidate_on_message(message, object())
+    await asyncio.gather(*rc._background_tasks)
+    rc.invalidate.assert_not_called()
+    rc.update_rule.assert_called_once_with(42)
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_update_rule(mocker, db_async_session):
+    user = model.User(name="dummy")
+    rules = [make_rule(user, f"rule {i}") for i in range(2)]
+    db_async_session.add_all([user, *rules])
+    await db_async_session.commit()
+    # Two processes holding a copy of the rules
+    rc1 = RulesCache()
+    rc2 = RulesCache()
+    assert [r.name for r in await rc1.get_rules(db=db_async_session)] == ["rule 0", "rule 1"]
+    assert [r.name for r in await rc2.get_rules(db=db_async_session)] == ["rule 0", "rule 1"]
+    get_value = mocker.patch.object(rc2, "get_value_with_state", wraps=rc2.get_value_with_state)
+
+    rules[0].name = "changed"
+    await db_async_session.commit()
+    await rc1.update_rule(rules[0].id)
+    assert [r.name for r in await rc2.get_rules(db=db_async_session)] == ["changed", "rule 1"]
+
+    rules[1].disabled = True
+    await db_async_session.commit()
+    await rc1.update_rule(rules[1].id)
+    assert [r.name for r in await rc2.get_rules(db=db_async_session)] == ["changed"]
+    assert await cache.get(rc1._cache_key) == {rules[0].id}
+    assert await cache.get(rc1._rule_key(rules[1].id)) is None
+    # The changes were applied without reloading all the rules
+    get_value.assert_not_called()
+
+    rules[1].disabled = False
+    await db_async_session.commit()
+    await rc1.update_rule(rules[1].id)
+    assert [r.name for r in await rc2.get_rules(db=db_async_session)] == ["changed", "rule 1"]
+    get_value.assert_not_called()
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_missed_change(mocker, db_async_session):
+    user = model.User(name="dummy")
+    rule = make_rule(user, "the name")
+    db_async_session.add_all([user, rule])
+    await db_async_session.commit()
+    rc1 = RulesCache()
+    rc2 = RulesCache()
+    await rc2.get_rules(db=db_async_session)
+    get_value = mocker.patch.object(rc2, "get_value_with_state", wraps=rc2.get_value_with_state)
+
+    rule.name = "changed"
+    await db_async_session.commit()
+    await rc1.update_rule(rule.id)
+    # The change has expired from the log
+    version = await cache.get(rc1._version_key)
+    await cache.delete(rc1._change_key(version))
+    rules = await rc2.get_rules(db=db_async_session)
+    assert [r.name for r in rules] == ["changed"]
+    get_value.assert_called_once_with(db=db_async_session)
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_rules_cache_current(mocker, db_async_session):
+    user = model.User(name="dummy")
+    db_async_session.add_all([user, make_rule(user, "the name")])
+    await db_async_session.commit()
+    rc = RulesCache()
+    await rc.get_rules(db=db_async_session)
+    assert rc._rule_set_version == await cache.get(rc._version_key) == 1
+    get_cached_rules = mocker.patch.object(rc, "_get_cached_rules", wraps=rc._get_cached_rules)
+    # The rules have not changed since they were built, they are not loaded again
+    assert [r.name for r in await rc.get_rules(db=db_async_session)] == ["the name"]
+    get_cached_rules.assert_not_called()
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_rules_cache_version_missing(mocker, db_async_session):
+    user = model.User(name="dummy")
+    db_async_session.add_all([user, make_rule(user, "the name")])
+    await db_async_session.commit()
+    rc = RulesCache()
+    await rc.get_rules(db=db_async_session)
+    get_cached_rules = mocker.patch.object(rc, "_get_cached_rules", wraps=rc._get_cached_rules)
+    # The version has expired: reload the rules once, not on every call
+    await cache.delete(rc._version_key)
+    await rc.get_rules(db=db_async_session)
+    await rc.get_rules(db=db_async_session)
+    get_cached_rules.assert_called_once()
+    assert rc._rule_set_version is None
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_update_rule_no_expiration(db_async_session):
+    user = model.User(name="dummy")
+    rule = make_rule(user, "the name")
+    db_async_session.add_all([user, rule])
+    await db_async_session.commit()
+    rc = RulesCache()
+    await cache.set(rc._cache_key, frozenset())
+    await rc.update_rule(rule.id)
+    assert await cache.get(rc._cache_key) == {rule.id}
+    assert await cache.get_expire(rc._cache_key) > 0
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_update_rule_not_cached(db_async_session):
+    user = model.User(name="dummy")
+    rule = make_rule(user, "the name")
+    db_async_session.add_all([user, rule])
+    await db_async_session.commit()
+    rc = RulesCache()
+    await rc.update_rule(rule.id)
+    # The rule is stored and the change is logged, the rest will be built when requested
+    assert await cache.get(rc._cache_key) is None
+    assert (await cache.get(rc._rule_key(rule.id))).name == "the name"
+    assert await cache.get(rc._change_key(1)) == rule.id
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_rules_cache_stale(mocker, db_async_session):
+    user = model.User(name="dummy")
+    db_async_session.add_all([user, make_rule(user, "the name")])
+    await db_async_session.commit()
+    rc = RulesCache()
+    await rc.get_rules(db=db_async_session)
+    # Expire the list of rules, it may still be served for stale_ttl
+    await cache.expire(rc._cache_key, 60)
+    mocker.patch.object(rc, "rebuild")
+    rc._rule_set = None
+    rule_set, stale = await rc.get_rule_set_with_state(db=db_async_session)
+    assert stale is True
+    assert [r.name for r in rule_set.get_rules()] == ["the name"]
+    # The rule set remembers it was built from a stale list
+    assert await rc.get_rule_set_with_state(db=db_async_session) == (rule_set, True)
+    await asyncio.gather(*rc._background_tasks)
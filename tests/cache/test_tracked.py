@@ -4,13 +4,17 @@
 
 import asyncio
 import logging
+import pickle
 from unittest.mock import Mock
 
 import pytest
+from cashews import cache
 
 from fmn.cache.rules import RulesCache
-from fmn.cache.tracked import TrackedCache
+from fmn.cache.tracked import CompactIndex, Tracked, TrackedCache, TrackedIndex
 from fmn.database.model import Rule, TrackingRule, User
+from fmn.rules.compiled import CompiledTrackingRule
+from fmn.rules.requester import MemoizedRequester
 
 
 @pytest.fixture
@@ -28,10 +32,124 @@ async def test_build_tracked(mocker, requester, db_async_session):
     tr = TrackingRule(id=1, name="artifacts-owned", params={"username": "dummy"})
     rule = Rule(id=1, name="dummy", user=User(name="dummy"), tracking_rule=tr, generation_rules=[])
     db_async_session.add_all([rule, tr])
-    prime_cache = mocker.patch.object(tr, "prime_cache")
+    prime_cache = mocker.patch.object(CompiledTrackingRule, "prime_cache")
     tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
     tracked = await tracked_cache.get_value(db=db_async_session)
-    prime_cache.assert_called_once_with(tracked, requester)
+    assert isinstance(tracked, TrackedIndex)
+    prime_cache.assert_called_once()
+    assert prime_cache.call_args.args[0] == Tracked()
+    memoized_requester = prime_cache.call_args.args[1]
+    assert isinstance(memoized_requester, MemoizedRequester)
+    assert memoized_requester.distgit._proxy is requester.distgit
+
+
+def test_tracked_index(make_mocked_message):
+    tracked_index = TrackedIndex()
+    tracked_index.add(1, Tracked(packages={"pkg1", "pkg2"}, agent_name={"dummy"}))
+    tracked_index.add(2, Tracked(packages={"pkg2"}, usernames={"user1"}))
+    assert tracked_index.packages == {"pkg1": {1}, "pkg2": {1, 2}}
+    assert tracked_index.agent_name == {"dummy": {1}}
+    assert tracked_index.usernames == {"user1": {2}}
+
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg1"]})
+    assert tracked_index.get_rule_ids(message) == {1}
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg2"]})
+    assert tracked_index.get_rule_ids(message) == {1, 2}
+    message = make_mocked_message(
+        topic="dummy", body={"usernames": ["user1"], "agent_name": "dummy"}
+    )
+    assert tracked_index.get_rule_ids(message) == {1, 2}
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg3"], "agent_name": "other"})
+    assert tracked_index.get_rule_ids(message) == set()
+
+
+def test_compact_index():
+    index = CompactIndex.from_dict({"pkg2": {3, 1}, "pkg1": {2}})
+    assert index._positions is None
+    assert index["pkg1"] == {2}
+    assert index["pkg2"] == {1, 3}
+    assert index.get("pkg3", ()) == ()
+    assert index.get(None, ()) == ()
+    assert list(index) == ["pkg1", "pkg2"]
+    assert len(index) == 2
+    assert index == {"pkg1": {2}, "pkg2": {1, 3}}
+    assert CompactIndex.from_dict(index) is index
+    empty = CompactIndex.from_dict({})
+    assert len(empty) == 0
+    assert dict(empty) == {}
+
+
+def test_compact_index_changes():
+    index = CompactIndex.from_dict({"pkg2": {3, 1}, "pkg1": {2}})
+    rule_ids = index["pkg1"]
+    rule_ids.add(4)
+    # The returned sets are copies
+    assert index["pkg1"] == {2}
+    index["pkg1"] = rule_ids
+    index["pkg3"] = {5}
+    del index["pkg2"]
+    with pytest.raises(KeyError):
+        index["pkg2"]
+    with pytest.raises(KeyError):
+        del index["pkg2"]
+    assert list(index) == ["pkg1", "pkg3"]
+    assert len(index) == 2
+    assert index == {"pkg1": {2, 4}, "pkg3": {5}}
+
+    loaded = pickle.loads(pickle.dumps(index))  # noqa: S301
+    assert loaded._changes == {}
+    assert loaded == index
+    assert CompactIndex.from_dict(index) is not index
+
+
+def test_tracked_index_pickle(make_mocked_message):
+    tracked_index = TrackedIndex()
+    tracked_index.add(1, Tracked(packages={"pkg1", "pkg2"}, agent_name={"dummy"}))
+    tracked_index.add(2, Tracked(packages={"pkg2"}))
+
+    pickled = pickle.dumps(tracked_index)
+    # What each rule tracks is not stored, it is rebuilt from the mappings when needed
+    assert b"rules" not in pickled
+    assert b"Tracked" not in pickled.replace(b"TrackedIndex", b"")
+    loaded = pickle.loads(pickled)  # noqa: S301
+    assert isinstance(loaded.packages, CompactIndex)
+    assert loaded == tracked_index
+    assert loaded.rules is None
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg2"], "agent_name": "dummy"})
+    assert loaded.get_rule_ids(message) == {1, 2}
+
+    # It can still be updated
+    loaded.add(3, Tracked(packages={"pkg1"}))
+    assert loaded.packages == {"pkg1": {1, 3}, "pkg2": {1, 2}}
+    assert isinstance(loaded.containers, CompactIndex)
+
+
+def test_tracked_index_remove():
+    tracked_index = TrackedIndex()
+    tracked_index.add(1, Tracked(packages={"pkg1", "pkg2"}, agent_name={"dummy"}))
+    tracked_index.add(2, Tracked(packages={"pkg2"}))
+    tracked_index = pickle.loads(pickle.dumps(tracked_index))  # noqa: S301
+    tracked_index.remove(1)
+    assert tracked_index.rules == {2: Tracked(packages={"pkg2"})}
+    assert tracked_index.packages == {"pkg2": {2}}
+    assert tracked_index.agent_name == {}
+    # Untouched mappings stay compact
+    assert isinstance(tracked_index.usernames, CompactIndex)
+    tracked_index.remove(2)
+    assert tracked_index.packages == {}
+    assert tracked_index.rules == {}
+    # Unknown rule
+    tracked_index.remove(3)
+
+
+def test_tracked_index_same_rule():
+    tracked_index = TrackedIndex()
+    tracked_index.add(1, Tracked(packages={"pkg1"}))
+    tracked_index.add(1, Tracked(packages={"pkg2"}, usernames={"user1"}))
+    assert tracked_index.rules == {1: Tracked(packages={"pkg1", "pkg2"}, usernames={"user1"})}
+    tracked_index.remove(1)
+    assert tracked_index.packages == {}
+    assert tracked_index.usernames == {}
 
 
 @pytest.mark.cashews_cache(enabled=True)
@@ -45,6 +163,93 @@ async def test_get_value(mocker, requester, db_async_session):
     assert result1 == result2
 
 
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_value_stale(mocker, requester, db_async_session):
+    rules_cache = mocker.AsyncMock()
+    rules_cache.get_rules.return_value = []
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    await tracked_cache.rebuild()
+    stale_value = await cache.get(tracked_cache._cache_key)
+    # Expire the value, it may still be served for stale_ttl
+    await cache.expire(tracked_cache._cache_key, 60)
+    rebuild = mocker.patch.object(tracked_cache, "rebuild", wraps=tracked_cache.rebuild)
+
+    results = await asyncio.gather(
+        *(tracked_cache.get_value_with_state(db=db_async_session) for _i in range(3))
+    )
+    assert results == [(stale_value, True)] * 3
+    await asyncio.gather(*tracked_cache._background_tasks)
+    # A single rebuild ran
+    rebuild.assert_called_once_with()
+    assert await cache.get_expire(tracked_cache._cache_key) > 86400
+    _value, stale = await tracked_cache.get_value_with_state(db=db_async_session)
+    assert stale is False
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_local_value_stale(mocker, requester, db_async_session):
+    mocker.patch("fmn.cache.base.monotonic", return_value=1000)
+    tracked_cache = TrackedCache(requester=requester, rules_cache=mocker.AsyncMock())
+    mocker.patch.object(tracked_cache, "rebuild")
+    await cache.set(tracked_cache._cache_key, "stale", expire=60)
+    assert await tracked_cache.get_local_value_with_state(db=db_async_session) == ("stale", True)
+    # The local copy remembers it is stale
+    assert await tracked_cache.get_local_value_with_state(db=db_async_session) == ("stale", True)
+    await asyncio.gather(*tracked_cache._background_tasks)
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_value_stale_rebuilding_elsewhere(mocker, requester, db_async_session):
+    tracked_cache = TrackedCache(requester=requester, rules_cache=mocker.AsyncMock())
+    await cache.set(tracked_cache._cache_key, "stale", expire=60)
+    await cache.set_lock(f"{tracked_cache._cache_key}:revalidate", "other", expire=60)
+    rebuild = mocker.patch.object(tracked_cache, "rebuild")
+    assert await tracked_cache.get_value(db=db_async_session) == "stale"
+    await asyncio.gather(*tracked_cache._background_tasks)
+    rebuild.assert_not_called()
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_value_too_stale(mocker, requester, db_async_session):
+    rules_cache = mocker.AsyncMock()
+    rules_cache.get_rules.return_value = []
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    await tracked_cache.rebuild()
+    # Past stale_ttl the value is gone, and rebuilt before being returned
+    await cache.delete(tracked_cache._cache_key)
+    rebuild = mocker.patch.object(tracked_cache, "rebuild")
+    result = await tracked_cache.get_value(db=db_async_session)
+    assert isinstance(result, TrackedIndex)
+    rebuild.assert_not_called()
+    assert rules_cache.get_rules.call_count == 2
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_value_no_stale_ttl(mocker, requester, db_async_session):
+    rules_cache = mocker.AsyncMock()
+    rules_cache.get_rules.return_value = []
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    mocker.patch.object(tracked_cache, "_stale_seconds", return_value=0)
+    result1 = await tracked_cache.get_value(db=db_async_session)
+    result2 = await tracked_cache.get_value(db=db_async_session)
+    assert result1 == result2
+    rules_cache.get_rules.assert_called_once_with(db=db_async_session)
+    # The version is only bumped when the value is computed
+    assert await cache.get(tracked_cache._version_key) == 1
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_revalidate_already_rebuilt(mocker, requester):
+    tracked_cache = TrackedCache(requester=requester, rules_cache=mocker.AsyncMock())
+    # Another process rebuilt the value before the lock was acquired
+    await cache.set(tracked_cache._cache_key, "fresh", expire=86400 * 2)
+    rebuild = mocker.patch.object(tracked_cache, "rebuild")
+    await tracked_cache._revalidate_once()
+    rebuild.assert_not_called()
+    # The lock is released
+    assert not await cache.is_locked(f"{tracked_cache._cache_key}:revalidate")
+
+
 @pytest.mark.cashews_cache(enabled=True)
 async def test_invalidate(mocker, requester):
     tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
@@ -82,6 +287,67 @@ async def test_invalidate_on_message(mocker, requester, topic, expected, make_mo
         tracked_cache.invalidate.assert_not_called()
 
 
+async def test_invalidate_on_message_rule(mocker, requester, make_mocked_message):
+    message = make_mocked_message(
+        topic="fmn.rule.update.v1", body={"rule": {"id": 42}, "user": {"name": "dummy"}}
+    )
+    tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
+    mocker.patch.object(tracked_cache, "invalidate")
+    mocker.patch.object(tracked_cache, "update_rule")
+    await tracked_cache.invalidate_on_message(message, object())
+    await asyncio.gather(*tracked_cache._background_tasks)
+    tracked_cache.invalidate.assert_not_called()
+    tracked_cache.update_rule.assert_called_once_with(42)
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_update_rule(requester, db_async_session):
+    user = User(name="dummy")
+    rules = [
+        Rule(
+            user=user,
+            name=f"rule{i}",
+            tracking_rule=TrackingRule(name="users-followed", params=["someone"]),
+            generation_rules=[],
+        )
+        for i in range(2)
+    ]
+    db_async_session.add_all([user, *rules])
+    await db_async_session.commit()
+    tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
+    # Nothing is cached yet, it is built
+    await tracked_cache.update_rule(rules[0].id)
+    tracked = await cache.get(tracked_cache._cache_key)
+    assert tracked.agent_name == {"someone": {rules[0].id, rules[1].id}}
+    assert await cache.get(tracked_cache._version_key) == 1
+
+    rules[0].tracking_rule.params = ["other"]
+    await db_async_session.commit()
+    await tracked_cache.update_rule(rules[0].id)
+    tracked = await cache.get(tracked_cache._cache_key)
+    assert tracked.agent_name == {"someone": {rules[1].id}, "other": {rules[0].id}}
+
+    rules[1].disabled = True
+    await db_async_session.commit()
+    await tracked_cache.update_rule(rules[1].id)
+    tracked = await cache.get(tracked_cache._cache_key)
+    assert tracked.agent_name == {"other": {rules[0].id}}
+    assert await cache.get_expire(tracked_cache._cache_key) > 0
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_update_rule_no_expiration(mocker, requester):
+    rules_cache = mocker.AsyncMock()
+    rules_cache.load_rule.return_value = None
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    tracked_index = TrackedIndex()
+    tracked_index.add(1, Tracked(packages={"pkg1"}))
+    await cache.set(tracked_cache._cache_key, tracked_index)
+    await tracked_cache.update_rule(1)
+    assert (await cache.get(tracked_cache._cache_key)).packages == {}
+    assert await cache.get_expire(tracked_cache._cache_key) > 0
+
+
 @pytest.mark.cashews_cache(enabled=True)
 async def test_invalidate_error(mocker, requester, caplog):
     tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
@@ -94,3 +360,67 @@ async def test_invalidate_error(mocker, requester, caplog):
     assert len(caplog.record_tuples) == 1
     assert caplog.record_tuples[0][1] == logging.ERROR
     assert caplog.record_tuples[0][2].startswith("Traceback")
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_local_value(mocker, requester, db_async_session):
+    monotonic = mocker.patch("fmn.cache.base.monotonic", return_value=1000)
+    rules_cache = mocker.AsyncMock()
+    rules_cache.get_rules.return_value = []
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    await tracked_cache.rebuild()
+    assert tracked_cache.peek_local_value() is None
+
+    result1 = await tracked_cache.get_local_value(db=db_async_session)
+    assert isinstance(result1, TrackedIndex)
+    assert tracked_cache.peek_local_value() is result1
+
+    # The local copy is used as long as it is recent enough
+    get_value = mocker.patch.object(
+        tracked_cache, "get_value_with_state", wraps=tracked_cache.get_value_with_state
+    )
+    assert await tracked_cache.get_local_value(db=db_async_session) is result1
+    get_value.assert_not_called()
+
+    # After local_ttl it is only fetched again if the version changed
+    monotonic.return_value = 1011
+    assert tracked_cache.peek_local_value() is None
+    assert await tracked_cache.get_local_value(db=db_async_session) is result1
+    get_value.assert_not_called()
+
+    monotonic.return_value = 1022
+    await tracked_cache.rebuild()
+    result2 = await tracked_cache.get_local_value(db=db_async_session)
+    get_value.assert_called_once_with(db=db_async_session)
+    assert result2 is not result1
+    assert result2 == result1
+
+
+@pytest.mark.cashews_cache(enabled=True)
+async def test_get_local_value_expired(mocker, requester, db_async_session):
+    monotonic = mocker.patch("fmn.cache.base.monotonic", return_value=1000)
+    rules_cache = mocker.AsyncMock()
+    rules_cache.get_rules.return_value = []
+    tracked_cache = TrackedCache(requester=requester, rules_cache=rules_cache)
+    result1 = await tracked_cache.get_local_value(db=db_async_session)
+    assert rules_cache.get_rules.call_count == 1
+
+    # The value expires from the cache, this does not change its version
+    await cache.delete(tracked_cache._cache_key)
+    monotonic.return_value = 1011
+    result2 = await tracked_cache.get_local_value(db=db_async_session)
+    assert rules_cache.get_rules.call_count == 2
+    assert result2 is not result1
+    assert await cache.get(tracked_cache._cache_key) is not None
+
+
+async def test_get_local_value_disabled(mocker, requester, db_async_session):
+    mocker.patch("fmn.cache.base.cache_arg", return_value=lambda: None)
+    tracked_cache = TrackedCache(requester=requester, rules_cache=RulesCache())
+    get_value = mocker.patch.object(
+        tracked_cache, "get_value_with_state", return_value=(TrackedIndex(), False)
+    )
+    await tracked_cache.get_local_value(db=db_async_session)
+    await tracked_cache.get_local_value(db=db_async_session)
+    assert get_value.call_count == 2
+    assert tracked_cache.peek_local_value() is None
@@ -78,3 +78,35 @@ def test_get_pattern_for_cached_calls(with_self, with_arg):
         else pattern.endswith(f":self:{expected_self}")
         for pattern in patterns
     )
+
+
+async def test_delete_keys(mocker):
+    delete_many = mocker.patch.object(cache, "delete_many")
+    error = RuntimeError("BOO")
+    delete_many.side_effect = [None, error, None]
+
+    failed = await util.delete_keys((f"key{i}" for i in range(5)), batch_size=2)
+
+    assert delete_many.call_args_list == [
+        mock.call("key0", "key1"),
+        mock.call("key2", "key3"),
+        mock.call("key4"),
+    ]
+    assert failed == {"key2": error, "key3": error}
+
+
+async def test_delete_keys_nothing(mocker):
+    delete_many = mocker.patch.object(cache, "delete_many")
+    assert await util.delete_keys([]) == {}
+    delete_many.assert_not_called()
+
+
+async def test_delete_tags(mocker):
+    delete_tags = mocker.patch.object(cache, "delete_tags")
+    error = RuntimeError("BOO")
+    delete_tags.side_effect = [None, error]
+
+    failed = await util.delete_tags(["tag1", "tag2"])
+
+    assert delete_tags.call_args_list == [mock.call("tag1"), mock.call("tag2")]
+    assert failed == {"tag2": error}
@@ -20,12 +20,13 @@ from fedora_messaging import message
 import fmn.api.handlers.misc
 from fmn.api import main
 from fmn.backends import FASJSONAsyncProxy, get_distgit_proxy, get_fasjson_proxy
-from fmn.cache.tracked import Tracked, TrackedCache
+from fmn.cache.tracked import TrackedCache, TrackedIndex
 from fmn.cache.util import cache_arg
 from fmn.core.config import get_settings
 from fmn.database.main import Base, async_session_maker, get_engine, init_model
 from fmn.database.migrations.main import alembic_migration
 from fmn.database.model import Destination, Filter, GenerationRule, Rule, TrackingRule, User
+from fmn.rules.registry import clear_registry
 
 from .message import Message
 
@@ -45,6 +46,7 @@ def clear_caches():
     get_distgit_proxy.cache_clear()
     get_fasjson_proxy.cache_clear()
     fmn.api.handlers.misc.get_applications.cache_clear()
+    clear_registry()
 
 
 def pytest_configure(config):
@@ -362,7 +364,7 @@ def reset_cache_arg_caches(register_cache_arg_fns):
 @pytest.fixture
 def mocked_tracked_cache(mocker):
     mocked = mock.Mock()
-    mocked.get_value = mock.AsyncMock(return_value=Tracked())
+    mocked.get_value = mock.AsyncMock(return_value=TrackedIndex())
     mocked.invalidate_on_message = mock.AsyncMock()
     mocked.invalidate = mock.AsyncMock()
     mocked.delete = mock.AsyncMock()
@@ -370,6 +372,11 @@ def mocked_tracked_cache(mocker):
     def _make_tracked_cache(*args, **kwargs):
         obj = TrackedCache(*args, **kwargs)
         obj.get_value = mocked.get_value
+
+        async def _get_value_with_state(db):
+            return await mocked.get_value(db=db), False
+
+        obj.get_value_with_state = _get_value_with_state
         obj.invalidate = mocked.invalidate
         obj.invalidate_on_message = mocked.invalidate_on_message
         obj.delete = mocked.delete
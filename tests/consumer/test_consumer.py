@@ -3,6 +3,9 @@
 # SPDX-License-Identifier: MIT
 
 import asyncio
+import logging
+import sys
+from functools import partial
 from unittest.mock import AsyncMock, Mock
 
 import pytest
@@ -11,8 +14,9 @@ from fedora_messaging.config import conf as fm_config
 from fedora_messaging.exceptions import Nack
 from sqlalchemy import select
 
-from fmn.cache.tracked import Tracked
+from fmn.cache.tracked import TrackedIndex
 from fmn.consumer.consumer import Consumer
+from fmn.consumer.send_queue import SendQueue
 from fmn.core import config
 from fmn.database import model
 from fmn.rules.notification import Notification
@@ -31,6 +35,8 @@ def mocked_send_queue_class(mocker):
     send_queue = Mock(name="send_queue")
     send_queue.connect = AsyncMock()
     send_queue.send = AsyncMock()
+    send_queue.max_in_flight = 10
+    send_queue.send_many = partial(SendQueue.send_many, send_queue)
     return mocker.patch("fmn.consumer.consumer.SendQueue", return_value=send_queue)
 
 
@@ -56,11 +62,78 @@ async def test_consumer_init(
         {
             "fasjson_url": "https://fasjson.fedoraproject.org",
             "distgit_url": "https://src.fedoraproject.org",
+            "max_concurrent_requests": 20,
+            "distgit_snapshot": False,
+            "http_pool": {
+                "http2": True,
+                "max_connections": 100,
+                "max_keepalive_connections": 20,
+                "keepalive_expiry": 30,
+                "connect_timeout": 10,
+                "read_timeout": 60,
+            },
         }
     )
     mocked_send_queue_class.assert_called_once_with("SEND_QUEUE_CONFIG")
 
 
+async def test_consumer_shutdown(
+    mocker, mocked_tracked_cache, mocked_requester_class, mocked_send_queue_class
+):
+    reactor = mocker.patch("twisted.internet.reactor")
+    mocker.patch.dict(sys.modules, {"twisted.internet.reactor": reactor})
+    c = Consumer()
+    await c._ready
+    reactor.addSystemEventTrigger.assert_called_once_with("before", "shutdown", c._on_shutdown)
+
+    # The pending counts are recorded and the connection is closed before the reactor stops
+    c._generated = Mock(name="generated")
+    c._generated.stop = AsyncMock()
+    c.send_queue.close = AsyncMock()
+    await c._on_shutdown().asFuture(asyncio.get_running_loop())
+    c._generated.stop.assert_called_once_with()
+    c.send_queue.close.assert_called_once_with()
+
+
+async def test_consumer_shutdown_no_reactor(
+    mocker, mocked_tracked_cache, mocked_requester_class, mocked_send_queue_class
+):
+    reactor = mocker.patch("twisted.internet.reactor")
+    mocker.patch.dict(sys.modules)
+    del sys.modules["twisted.internet.reactor"]
+    c = Consumer()
+    await c._ready
+    reactor.addSystemEventTrigger.assert_not_called()
+
+
+async def test_consumer_stale_tracked(
+    mocker,
+    mocked_tracked_cache,
+    mocked_requester_class,
+    mocked_send_queue_class,
+    make_mocked_message,
+    caplog,
+):
+    c = Consumer()
+    await c._ready
+    get_local_value = mocker.patch.object(
+        c._tracked_cache,
+        "get_local_value_with_state",
+        return_value=(TrackedIndex(packages={"pkg1": {1}}), True),
+    )
+    message = make_mocked_message(topic="dummy.topic", body={"packages": ["pkg1"]})
+    caplog.set_level(logging.INFO)
+    # Only report when it changes
+    for _i in range(2):
+        assert await c.get_tracking_rule_ids(message, None) == {1}
+    assert caplog.messages.count("Running on the stale tracked cache while it is rebuilt") == 1
+    get_local_value.return_value = (TrackedIndex(packages={"pkg1": {1}}), False)
+    for _i in range(2):
+        await c.get_tracking_rule_ids(message, None)
+    assert caplog.messages.count("The tracked cache is current again") == 1
+    assert c._stale_caches == set()
+
+
 def test_consumer_loop_not_running(
     mocker,
     mocked_tracked_cache,
@@ -105,14 +178,6 @@ async def test_consumer_call_tracked(
     db_async_session,
 ):
     c = Consumer()
-    mocked_tracked_cache.get_value.return_value = Tracked(
-        packages={"pkg1"},
-        containers=set(),
-        modules=set(),
-        flatpaks=set(),
-        usernames=set(),
-        agent_name=set(),
-    )
     await c._ready
 
     user = model.User(name="dummy")
@@ -123,6 +188,7 @@ async def test_consumer_call_tracked(
     d = model.Destination(generation_rule=gr, protocol="email", address="dummy@example.com")
     db_async_session.add_all([user, record, tr, gr, f, d])
     await db_async_session.commit()
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": {record.id}})
 
     c._requester.distgit.get_project_users = AsyncMock(return_value=["dummy"])
 
@@ -154,6 +220,7 @@ async def test_consumer_call_tracked(
         "headers": {"Subject": "Message on dummy.topic", "To": "dummy@example.com"},
     }
 
+    await c._generated.flush(db_async_session)
     result = await db_async_session.execute(select(model.Generated))
     generated = list(result.scalars())
     assert len(generated) == 1
@@ -191,6 +258,43 @@ async def test_consumer_call_failure(
     mocked_session_maker.__aexit__.assert_called_once()
 
 
+async def test_consumer_call_ignored(
+    mocker,
+    mocked_tracked_cache,
+    mocked_requester_class,
+    mocked_send_queue_class,
+    make_mocked_message,
+    mocked_session_maker,
+):
+    c = Consumer()
+    await c._ready
+    c._requester.may_invalidate.return_value = False
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": {1}})
+    handle = mocker.patch.object(c, "_handle")
+
+    # No local copy of the tracked index yet
+    message = make_mocked_message(topic="dummy.topic", body={"packages": ["pkg2"]})
+    assert c.is_ignored(message) is False
+    await c._tracked_cache.get_local_value(db=None)
+
+    # Untracked messages are dropped before opening a transaction
+    assert c.is_ignored(message) is True
+    await c.handle_or_rollback(message)
+    mocked_session_maker.__aenter__.assert_not_called()
+    handle.assert_not_called()
+
+    # Tracked messages and the messages that can invalidate the caches are processed
+    message = make_mocked_message(topic="dummy.topic", body={"packages": ["pkg1"]})
+    assert c.is_ignored(message) is False
+    message = make_mocked_message(topic="fmn.rule.update.v1", body={})
+    assert c.is_ignored(message) is False
+    message = make_mocked_message(topic="dummy.topic", body={"packages": ["pkg2"]})
+    c._requester.may_invalidate.return_value = True
+    assert c.is_ignored(message) is False
+    await c.handle_or_rollback(message)
+    handle.assert_called_once()
+
+
 async def test_consumer_call_tracked_agent_name(
     mocker,
     mocked_tracked_cache,
@@ -199,20 +303,13 @@ async def test_consumer_call_tracked_agent_name(
     make_mocked_message,
 ):
     c = Consumer()
-    mocked_tracked_cache.get_value.return_value = Tracked(
-        packages=set(),
-        containers=set(),
-        modules=set(),
-        flatpaks=set(),
-        usernames=set(),
-        agent_name={"dummy"},
-    )
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(agent_name={"dummy": {1}})
 
     message = make_mocked_message(
         topic="dummy.topic", body={"packages": ["pkg1"], "agent_name": "dummy"}
     )
     await c._ready
-    assert (await c.is_tracked(message, None)) is True
+    assert (await c.get_tracking_rule_ids(message, None)) == {1}
 
 
 async def test_consumer_deprecated_schema(
@@ -223,7 +320,7 @@ async def test_consumer_deprecated_schema(
     make_mocked_message,
 ):
     c = Consumer()
-    mocked_tracked_cache.get_value.return_value = Tracked(packages={"pkg1"})
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": {1}})
     c._rules_cache = mocker.AsyncMock()
     message = make_mocked_message(
         topic="dummy.topic",
@@ -245,9 +342,11 @@ async def test_consumer_send_error(
 
     with pytest.raises(Nack):
         await c._send(
-            Notification.parse_obj(
-                {"protocol": "irc", "content": {"to": "dummy", "message": "foobar"}}
-            ),
+            [
+                Notification.parse_obj(
+                    {"protocol": "irc", "content": {"to": "dummy", "message": "foobar"}}
+                )
+            ],
             message,
         )
 
@@ -280,19 +379,12 @@ async def test_consumer_duplicate(
     db_async_session,
 ):
     c = Consumer()
-    mocked_tracked_cache.get_value.return_value = Tracked(
-        packages={"pkg1"},
-        containers=set(),
-        modules=set(),
-        flatpaks=set(),
-        usernames=set(),
-        agent_name=set(),
-    )
     await c._ready
 
     # Create two identical rules
     user = model.User(name="dummy")
     db_async_session.add(user)
+    rules = []
     for i in range(2):
         rule = model.Rule(user=user, name=f"Rule {i}")
         db_async_session.add(rule)
@@ -302,8 +394,12 @@ async def test_consumer_duplicate(
         gr1 = model.GenerationRule()
         gr1.destinations.append(model.Destination(protocol="email", address="dummy@example.com"))
         rule.generation_rules.append(gr1)
+        rules.append(rule)
 
     await db_async_session.commit()
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(
+        packages={"pkg1": {rule.id for rule in rules}}
+    )
 
     # This should generate a single notification
     message = make_mocked_message(
@@ -316,7 +412,130 @@ async def test_consumer_duplicate(
     c.send_queue.send.assert_called_once()
 
     # We still consider that each rule generated a notification, even if only one was sent
+    await c._generated.flush(db_async_session)
     result = await db_async_session.execute(select(model.Generated))
     generated = list(result.scalars())
     assert len(generated) == 2
     assert sum(g.count for g in generated) == 2
+
+
+async def test_consumer_send_error_not_counted(
+    mocker,
+    mocked_tracked_cache,
+    mocked_requester_class,
+    mocked_send_queue_class,
+    make_mocked_message,
+    db_schema,
+    db_async_session,
+):
+    c = Consumer()
+    await c._ready
+
+    user = model.User(name="dummy")
+    rule = model.Rule(user=user, name="the name")
+    rule.tracking_rule = model.TrackingRule(
+        name="artifacts-followed", params=[{"name": "pkg1", "type": "rpms"}]
+    )
+    gr = model.GenerationRule()
+    gr.destinations.append(model.Destination(protocol="email", address="dummy@example.com"))
+    rule.generation_rules.append(gr)
+    db_async_session.add_all([user, rule])
+    await db_async_session.commit()
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": {rule.id}})
+    c.send_queue.send.side_effect = AMQPConnectionError()
+
+    message = make_mocked_message(
+        topic="dummy.topic",
+        body={"packages": ["pkg1"], "agent_name": "someone"},
+    )
+    with pytest.raises(Nack):
+        await c._handle(message, db_async_session)
+
+    # The message will be delivered again, don't count its notifications twice
+    assert not c._generated._counts
+
+
+async def test_consumer_only_tracking_rules(
+    mocker,
+    mocked_tracked_cache,
+    mocked_requester_class,
+    mocked_send_queue_class,
+    make_mocked_message,
+    db_schema,
+    db_async_session,
+):
+    c = Consumer()
+    await c._ready
+
+    user = model.User(name="dummy")
+    db_async_session.add(user)
+    rules = []
+    for i in range(2):
+        rule = model.Rule(user=user, name=f"Rule {i}")
+        db_async_session.add(rule)
+        rule.tracking_rule = model.TrackingRule(
+            name="artifacts-followed", params=[{"name": "pkg1", "type": "rpms"}]
+        )
+        gr = model.GenerationRule()
+        gr.destinations.append(model.Destination(protocol="email", address=f"dummy{i}@example.com"))
+        rule.generation_rules.append(gr)
+        rules.append(rule)
+    await db_async_session.commit()
+
+    # Only the first rule is in the tracked index
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": {rules[0].id}})
+
+    message = make_mocked_message(
+        topic="dummy.topic",
+        body={"packages": ["pkg1"], "agent_name": "someone"},
+    )
+    await c._handle(message, db_async_session)
+
+    c.send_queue.send.assert_called_once()
+    assert c.send_queue.send.call_args[0][0].content.headers.To == "dummy0@example.com"
+
+
+async def test_consumer_rules_concurrency(
+    mocker,
+    mocked_tracked_cache,
+    mocked_requester_class,
+    mocked_send_queue_class,
+    make_mocked_message,
+):
+    mocker.patch.dict(fm_config["consumer_config"], {"max_concurrency": 2})
+    c = Consumer()
+    await c._ready
+
+    running = 0
+    max_running = 0
+
+    async def _handle(context):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(running, max_running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        yield Notification.parse_obj(
+            {"protocol": "irc", "content": {"to": "dummy", "message": context.message.topic}}
+        )
+
+    rules = []
+    for i in range(5):
+        rule = Mock(name=f"rule{i}", id=i)
+        rule.handle = _handle
+        rules.append(rule)
+    rule_set = Mock(name="rule_set")
+    rule_set.get_rules.return_value = rules
+    c._rules_cache = Mock(name="rules_cache")
+    c._rules_cache.invalidate_on_message = AsyncMock()
+    c._rules_cache.get_rule_set_with_state = AsyncMock(return_value=(rule_set, False))
+    mocked_tracked_cache.get_value.return_value = TrackedIndex(packages={"pkg1": set(range(5))})
+    db = Mock(name="db")
+
+    message = make_mocked_message(topic="dummy.topic", body={"packages": ["pkg1"]})
+    await c._handle(message, db)
+
+    assert max_running == 2
+    # The notifications are deduplicated, but each rule generated one
+    c.send_queue.send.assert_called_once()
+    assert sorted(rule_id for rule_id, _when in c._generated._counts) == list(range(5))
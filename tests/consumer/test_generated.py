@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from sqlalchemy import select
+
+from fmn.consumer.generated import GeneratedCounter
+from fmn.database import model
+
+
+async def test_generated_aggregate(db_async_session, db_rule):
+    counter = GeneratedCounter(interval=60)
+    for _i in range(3):
+        counter.add(db_rule.id)
+    await counter.flush(db_async_session)
+
+    result = await db_async_session.execute(select(model.Generated))
+    generated = list(result.scalars())
+    assert len(generated) == 1
+    assert generated[0].rule_id == db_rule.id
+    assert generated[0].count == 3
+    assert generated[0].when.timestamp() % 60 == 0
+    # Nothing left to flush
+    assert not counter._counts
+
+
+async def test_generated_deleted_rule(db_async_session, db_rule):
+    counter = GeneratedCounter(interval=60)
+    counter.add(db_rule.id)
+    counter.add(db_rule.id + 1000)
+    await counter.flush(db_async_session)
+
+    result = await db_async_session.execute(select(model.Generated))
+    assert [g.rule_id for g in result.scalars()] == [db_rule.id]
+
+
+async def test_generated_deleted_rules_only(db_async_session):
+    counter = GeneratedCounter(interval=60)
+    counter.add(1000)
+    await counter.flush(db_async_session)
+
+    result = await db_async_session.execute(select(model.Generated))
+    assert list(result.scalars()) == []
+
+
+async def test_generated_flush_own_session(mocker):
+    session_maker = mocker.patch("fmn.consumer.generated.async_session_maker")
+    db = Mock(name="db")
+    db.execute = AsyncMock(return_value=Mock(scalars=Mock(return_value=[1])))
+    session_maker.begin.return_value.__aenter__.return_value = db
+    counter = GeneratedCounter(interval=60)
+    counter.add(1)
+    await counter.flush()
+    session_maker.begin.assert_called_once_with()
+    # Check the rule and insert the counts
+    assert db.execute.call_count == 2
+
+
+async def test_generated_flush_empty(mocker):
+    session_maker = mocker.patch("fmn.consumer.generated.async_session_maker")
+    counter = GeneratedCounter(interval=60)
+    await counter.flush()
+    session_maker.begin.assert_not_called()
+
+
+async def test_generated_flush_failure():
+    counter = GeneratedCounter(interval=60)
+    counter.add(1, count=2)
+    db = Mock(name="db")
+    db.execute = AsyncMock(side_effect=ValueError("boom"))
+    with pytest.raises(ValueError):
+        await counter.flush(db)
+    # The counts are kept for the next flush
+    counter.add(1)
+    assert list(counter._counts.values()) == [3]
+
+
+async def test_generated_periodic(mocker):
+    counter = GeneratedCounter(interval=0.01)
+    calls = []
+
+    async def _flush():
+        calls.append(None)
+        if len(calls) == 1:
+            raise ValueError("boom")
+
+    mocker.patch.object(counter, "flush", side_effect=_flush)
+    counter.start()
+    task = counter._task
+    # Starting again does not run a second task
+    counter.start()
+    assert counter._task is task
+    await asyncio.sleep(0.05)
+    await counter.stop()
+    assert counter._task is None
+    # The periodic task survived the failure, and stopping flushes one last time
+    assert len(calls) >= 3
+
+
+async def test_generated_stop_during_flush(mocker):
+    counter = GeneratedCounter(interval=0.01)
+    counter.add(1, count=2)
+    writing = asyncio.Event()
+    written = []
+
+    async def _write(counts, db):
+        if not writing.is_set():
+            writing.set()
+            # Block until the periodic flush is cancelled
+            await asyncio.Event().wait()
+        written.append(counts)
+
+    mocker.patch.object(counter, "_write", side_effect=_write)
+    mocker.patch("fmn.consumer.generated.async_session_maker")
+    counter.start()
+    await writing.wait()
+    await counter.stop()
+    # The counts of the interrupted flush were written by the last flush
+    assert [list(counts.values()) for counts in written] == [[2]]
+    assert not counter._counts
+
+
+async def test_generated_stop_not_started(mocker):
+    counter = GeneratedCounter(interval=60)
+    flush = mocker.patch.object(counter, "flush")
+    await counter.stop()
+    flush.assert_called_once_with()
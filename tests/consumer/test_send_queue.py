@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 import logging
 from unittest.mock import AsyncMock
 
@@ -119,3 +120,94 @@ async def test_send_queue_reconnect_success(connection, notif, caplog):
 
     logs = [r for r in caplog.records if r.name.startswith("fmn.consumer.send_queue")]
     assert len(logs) == 2
+
+
+async def test_send_queue_send_many(connection):
+    sq = SendQueue({"amqp_url": "amqp://", "max_in_flight": 2})
+    await sq.connect()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def _publish(message, routing_key):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(in_flight, max_in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if routing_key == "send.irc":
+            raise AMQPConnectionError("dummy error")
+
+    connection._exchange.publish.side_effect = _publish
+    notifs = [
+        Notification.parse_obj({"protocol": "irc", "content": {"to": "dummy", "message": "foo"}}),
+        *(
+            Notification.parse_obj(
+                {
+                    "protocol": "email",
+                    "content": {"headers": {"To": f"dummy{i}", "Subject": "dummy"}, "body": "d"},
+                }
+            )
+            for i in range(4)
+        ),
+    ]
+    failed = await sq.send_many(notifs)
+
+    assert max_in_flight == 2
+    # The failed notification was retried 3 times
+    assert connection._exchange.publish.call_count == 7
+    assert len(failed) == 1
+    assert failed[0][0] is notifs[0]
+    assert isinstance(failed[0][1], AMQPConnectionError)
+
+
+async def test_send_queue_send_many_other_error(connection, notif):
+    sq = SendQueue({"amqp_url": "amqp://"})
+    await sq.connect()
+    connection._exchange.publish.side_effect = ValueError("dummy error")
+    with pytest.raises(ValueError):
+        await sq.send_many([notif])
+
+
+async def test_send_queue_reconnect_once(connection, mocker):
+    sq = SendQueue({"amqp_url": "amqp://", "max_in_flight": 10})
+    await sq.connect()
+    connect_robust = mocker.patch(
+        "fmn.consumer.send_queue.connect_robust", return_value=AsyncMock(name="new_connection")
+    )
+    sleep = asyncio.sleep
+
+    async def _publish(message, routing_key):
+        # Let the other notifications be published meanwhile
+        await sleep(0)
+        raise AMQPConnectionError("dummy error")
+
+    connection._exchange.publish.side_effect = _publish
+    # Don't wait between the tries
+    mocker.patch("asyncio.sleep")
+    notifications = [
+        Notification.parse_obj({"protocol": "irc", "content": {"to": f"user{i}", "message": "hi"}})
+        for i in range(5)
+    ]
+
+    await sq.send_many(notifications)
+
+    # All the notifications failed at once, but only one new connection was opened
+    connect_robust.assert_called_once()
+    connection.close.assert_called_once_with()
+
+
+async def test_send_queue_reconnect_close_error(connection, mocker):
+    sq = SendQueue({"amqp_url": "amqp://"})
+    await sq.connect()
+    connection.close.side_effect = AMQPConnectionError("already closed")
+    new_connection = AsyncMock(name="new_connection")
+    mocker.patch("fmn.consumer.send_queue.connect_robust", return_value=new_connection)
+    await sq.reconnect(connection)
+    assert sq._connection is new_connection
+
+
+async def test_send_queue_reconnect_not_connected(connection):
+    sq = SendQueue({"amqp_url": "amqp://"})
+    await sq.reconnect(None)
+    assert sq._connection is connection
+    connection.close.assert_not_called()
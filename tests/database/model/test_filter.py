@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+from importlib.metadata import EntryPoint
 from unittest.mock import Mock
 
 import pytest
@@ -19,7 +20,7 @@ def test_get_implementation(db_rule):
 
 
 def test_get_implementation_ep_not_found(mocker):
-    mocker.patch("fmn.database.model.filter.entry_points", return_value=[])
+    mocker.patch("fmn.rules.registry.entry_points", return_value=[])
     requester = Mock()
     f = model.Filter(name="my_actions")
     with pytest.raises(ValueError):
@@ -27,7 +28,11 @@ def test_get_implementation_ep_not_found(mocker):
 
 
 def test_get_implementation_conflicting_eps(mocker):
-    mocker.patch("fmn.database.model.filter.entry_points", return_value=["ep1", "ep2"])
+    eps = [
+        EntryPoint(name="my_actions", value=f"{module}:Dummy", group="fmn.filters")
+        for module in ("ep1", "ep2")
+    ]
+    mocker.patch("fmn.rules.registry.entry_points", return_value=eps)
     requester = Mock()
     f = model.Filter(name="my_actions")
     with pytest.raises(ValueError):
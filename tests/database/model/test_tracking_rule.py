@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+from importlib.metadata import EntryPoint
 from unittest.mock import Mock
 
 import pytest
@@ -27,7 +28,7 @@ def test_get_implementation(rule_db):
 
 
 def test_get_implementation_ep_not_found(mocker, rule_db):
-    mocker.patch("fmn.database.model.tracking_rule.entry_points", return_value=[])
+    mocker.patch("fmn.rules.registry.entry_points", return_value=[])
     requester = Mock()
     tr = model.TrackingRule(name="artifacts-followed", params={}, rule=rule_db)
     with pytest.raises(ValueError):
@@ -35,17 +36,12 @@ def test_get_implementation_ep_not_found(mocker, rule_db):
 
 
 def test_get_implementation_conflicting_eps(mocker, rule_db):
-    mocker.patch("fmn.database.model.tracking_rule.entry_points", return_value=["ep1", "ep2"])
+    eps = [
+        EntryPoint(name="artifacts-followed", value=f"{module}:Dummy", group="fmn.tracking_rules")
+        for module in ("ep1", "ep2")
+    ]
+    mocker.patch("fmn.rules.registry.entry_points", return_value=eps)
     requester = Mock()
     tr = model.TrackingRule(name="artifacts-followed", params={}, rule=rule_db)
     with pytest.raises(ValueError):
         tr.get_implementation(requester)
-
-
-async def test_prime_cache(mocker, rule_db):
-    cache = Mock(name="cache")
-    requester = Mock(name="requester")
-    tr = model.TrackingRule(name="artifacts-followed", params={}, rule=rule_db)
-    impl_prime_cache = mocker.patch.object(ArtifactsFollowed, "prime_cache")
-    await tr.prime_cache(cache, requester)
-    impl_prime_cache.assert_called_once_with(cache)
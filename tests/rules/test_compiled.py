@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import pickle
+from unittest.mock import Mock
+
+import pytest
+
+from fmn.database import model
+from fmn.rules.compiled import (
+    CompiledDestination,
+    CompiledFilter,
+    CompiledGenerationRule,
+    CompiledRule,
+    CompiledTrackingRule,
+    RuleSet,
+)
+from fmn.rules.context import MessageContext
+from fmn.rules.filter import Applications
+from fmn.rules.tracking_rules import UsersFollowed
+
+
+@pytest.fixture
+def compiled_rule():
+    return CompiledRule(
+        id=1,
+        name="darule",
+        username="dummy",
+        tracking_rule=CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy"),
+        generation_rules=(
+            CompiledGenerationRule(
+                id=1,
+                filters=(CompiledFilter(name="applications", params=["koji"], username="dummy"),),
+                destinations=tuple(
+                    CompiledDestination(protocol="email", address=f"n{i}") for i in range(1, 4)
+                ),
+            ),
+        ),
+    )
+
+
+def test_from_db():
+    user = model.User(name="dummy")
+    rule = model.Rule(
+        id=1,
+        name="darule",
+        user=user,
+        tracking_rule=model.TrackingRule(name="users-followed", params=["user1"]),
+        generation_rules=[
+            model.GenerationRule(
+                id=2,
+                filters=[model.Filter(name="my_actions", params=True)],
+                destinations=[model.Destination(protocol="irc", address="dummy")],
+            )
+        ],
+    )
+    compiled = CompiledRule.from_db(rule)
+    assert compiled == CompiledRule(
+        id=1,
+        name="darule",
+        username="dummy",
+        tracking_rule=CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy"),
+        generation_rules=(
+            CompiledGenerationRule(
+                id=2,
+                filters=(CompiledFilter(name="my_actions", params=True, username="dummy"),),
+                destinations=(CompiledDestination(protocol="irc", address="dummy"),),
+            ),
+        ),
+    )
+
+
+def test_pickle(compiled_rule):
+    assert pickle.loads(pickle.dumps(compiled_rule)) == compiled_rule  # noqa: S301
+
+
+async def test_handle_match(compiled_rule, make_mocked_message):
+    message = make_mocked_message(topic="dummy", body={"agent_name": "user1", "app": "koji"})
+    result = [n async for n in compiled_rule.handle(MessageContext(message, Mock()))]
+    assert len(result) == 3
+    assert [n.content.headers.dict()["To"] for n in result] == ["n1", "n2", "n3"]
+
+
+async def test_handle_filtered(compiled_rule, make_mocked_message):
+    message = make_mocked_message(topic="dummy", body={"agent_name": "user1", "app": "bodhi"})
+    result = [n async for n in compiled_rule.handle(MessageContext(message, Mock()))]
+    assert result == []
+
+
+async def test_handle_no_match(compiled_rule, make_mocked_message):
+    message = make_mocked_message(topic="dummy", body={"agent_name": "user2", "app": "koji"})
+    result = [n async for n in compiled_rule.handle(MessageContext(message, Mock()))]
+    assert result == []
+
+
+def test_get_implementation():
+    requester = Mock()
+    tr = CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy")
+    assert isinstance(tr.get_implementation(requester), UsersFollowed)
+    f = CompiledFilter(name="applications", params=["koji"], username="dummy")
+    assert isinstance(f.get_implementation(requester), Applications)
+
+
+def test_get_implementation_reused():
+    requester = Mock()
+    tr = CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy")
+    impl = tr.get_implementation(requester)
+    assert tr.get_implementation(requester) is impl
+    # Another requester gets another implementation object
+    assert tr.get_implementation(Mock()) is not impl
+
+
+def test_get_implementation_pickle():
+    requester = Mock()
+    tr = CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy")
+    tr.get_implementation(requester)
+    unpickled = pickle.loads(pickle.dumps(tr))  # noqa: S301
+    assert unpickled == tr
+    assert unpickled._impl is None
+    assert isinstance(unpickled.get_implementation(requester), UsersFollowed)
+
+
+def test_get_implementation_not_found():
+    with pytest.raises(ValueError):
+        CompiledTrackingRule(name="does-not-exist", params=[], owner="dummy")
+    with pytest.raises(ValueError):
+        CompiledFilter(name="does-not-exist", params=[], username="dummy")
+
+
+async def test_prime_cache(mocker):
+    cache = Mock(name="cache")
+    requester = Mock(name="requester")
+    tr = CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy")
+    impl_prime_cache = mocker.patch.object(UsersFollowed, "prime_cache")
+    await tr.prime_cache(cache, requester)
+    impl_prime_cache.assert_called_once_with(cache)
+
+
+def test_filter_key():
+    f1 = CompiledFilter(name="applications", params=["koji"], username="user1")
+    f2 = CompiledFilter(name="applications", params=["koji"], username="user2")
+    assert f1.key == f2.key
+    f1 = CompiledFilter(name="my_actions", params=False, username="user1")
+    f2 = CompiledFilter(name="my_actions", params=False, username="user2")
+    assert f1.key != f2.key
+
+
+def test_rule_set_updated(compiled_rule):
+    other = CompiledRule(
+        id=2,
+        name="other",
+        username="dummy",
+        tracking_rule=CompiledTrackingRule(name="users-followed", params=["user1"], owner="dummy"),
+        generation_rules=(
+            CompiledGenerationRule(
+                id=2,
+                filters=(CompiledFilter(name="topic", params="org.*", username="dummy"),),
+                destinations=(CompiledDestination(protocol="irc", address="dummy"),),
+            ),
+        ),
+    )
+    rule_set = RuleSet([compiled_rule])
+    updated = rule_set.updated({2: other})
+    assert updated.get_rules() == [compiled_rule, other]
+    assert updated.topic_matcher.patterns == {"org.*"}
+    # The original rule set is not changed
+    assert rule_set.get_rules() == [compiled_rule]
+    updated = updated.updated({1: None, 2: None, 3: None})
+    assert len(updated) == 0
+    assert updated.topic_matcher.patterns == set()
@@ -0,0 +1,119 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+
+from fmn.rules.compiled import (
+    CompiledFilter,
+    CompiledGenerationRule,
+    CompiledRule,
+    CompiledTrackingRule,
+    RuleSet,
+)
+from fmn.rules.context import MessageContext
+from fmn.rules.filter import Applications, Severities, Topic
+from fmn.rules.tracking_rules import ArtifactsGroupOwned, ArtifactsOwned
+
+
+async def test_filters_evaluated_once(mocker, make_mocked_message):
+    applications_matches = mocker.spy(Applications, "matches")
+    severities_matches = mocker.spy(Severities, "matches")
+    generation_rules = [
+        CompiledGenerationRule(
+            id=i,
+            filters=(
+                CompiledFilter(name="applications", params=["koji"], username=f"user{i}"),
+                CompiledFilter(name="severities", params=["info"], username=f"user{i}"),
+            ),
+            destinations=(),
+        )
+        for i in range(10)
+    ]
+    message = make_mocked_message(topic="dummy", body={"app": "koji"})
+    context = MessageContext(message, Mock())
+    for gr in generation_rules:
+        assert [n async for n in gr.handle(context)] == []
+        assert context.filters_match(gr.filters, gr.filters_key) is True
+    assert applications_matches.call_count == 1
+    assert severities_matches.call_count == 1
+
+
+def test_filters_short_circuit(mocker, make_mocked_message):
+    severities_matches = mocker.spy(Severities, "matches")
+    filters = (
+        CompiledFilter(name="applications", params=["bodhi"], username="dummy"),
+        CompiledFilter(name="severities", params=["info"], username="dummy"),
+    )
+    message = make_mocked_message(topic="dummy", body={"app": "koji"})
+    context = MessageContext(message, Mock())
+    assert context.filters_match(filters, frozenset(f.key for f in filters)) is False
+    severities_matches.assert_not_called()
+
+
+def test_topic_matcher(mocker, make_mocked_message):
+    topic_matches = mocker.spy(Topic, "matches")
+    filters = [
+        CompiledFilter(name="topic", params=pattern, username="dummy")
+        for pattern in ("dummy.*", "*.topic", "other.*")
+    ]
+    rule_set = RuleSet(
+        [
+            CompiledRule(
+                id=1,
+                name="dummy",
+                username="dummy",
+                tracking_rule=CompiledTrackingRule(
+                    name="related-events", params=None, owner="dummy"
+                ),
+                generation_rules=tuple(
+                    CompiledGenerationRule(id=i, filters=(f,), destinations=())
+                    for i, f in enumerate(filters)
+                ),
+            )
+        ]
+    )
+    assert rule_set.topic_matcher.patterns == {"dummy.*", "*.topic", "other.*"}
+    message = make_mocked_message(topic="dummy.topic", body={})
+    context = MessageContext(message, Mock(), topic_matcher=rule_set.topic_matcher)
+    assert [context.filter_matches(f) for f in filters] == [True, True, False]
+    topic_matches.assert_not_called()
+
+    # A pattern unknown to the matcher falls back to the filter
+    f = CompiledFilter(name="topic", params="dummy.top?c", username="dummy")
+    assert context.filter_matches(f) is True
+    topic_matches.assert_called_once()
+
+
+async def test_artifacts_owners_resolved_once(make_mocked_message):
+    async def get_project_users(*, project_path):
+        await asyncio.sleep(0)
+        return [f"{project_path}-owner"]
+
+    async def get_project_groups(*, project_path):
+        return [f"{project_path}-group"]
+
+    requester = Mock()
+    requester.distgit.get_project_users = AsyncMock(side_effect=get_project_users)
+    requester.distgit.get_project_groups = AsyncMock(side_effect=get_project_groups)
+    message = make_mocked_message(
+        topic="dummy", body={"packages": ["pkg1", "pkg2"], "containers": ["ctr1"]}
+    )
+    context = MessageContext(message, requester)
+    rules = [
+        *(ArtifactsOwned(requester, [f"user{i}", "rpms/pkg2-owner"], "dummy") for i in range(10)),
+        *(ArtifactsGroupOwned(requester, [f"group{i}"], "dummy") for i in range(10)),
+    ]
+
+    results = await asyncio.gather(*(rule.matches(message, context) for rule in rules))
+
+    assert results == [True] * 10 + [False] * 10
+    assert requester.distgit.get_project_users.await_count == 3
+    assert requester.distgit.get_project_groups.await_count == 3
+    assert await context.get_artifacts_users() == {
+        "rpms/pkg1-owner",
+        "rpms/pkg2-owner",
+        "containers/ctr1-owner",
+    }
+    assert requester.distgit.get_project_users.await_count == 3
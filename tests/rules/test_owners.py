@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+
+from fmn.rules.compiled import CompiledRule, CompiledTrackingRule, RuleSet
+from fmn.rules.context import MessageContext
+from fmn.rules.owners import OwnersIndex
+from fmn.rules.tracking_rules import ArtifactsOwned
+
+
+def make_rule(rule_id, tracking_rule, params):
+    return CompiledRule(
+        id=rule_id,
+        name=None,
+        username="dummy",
+        tracking_rule=CompiledTrackingRule(name=tracking_rule, params=params, owner="dummy"),
+        generation_rules=(),
+    )
+
+
+RULES = [
+    make_rule(1, "artifacts-owned", ["user1", "user2"]),
+    make_rule(2, "artifacts-owned", ["user2"]),
+    make_rule(3, "artifacts-group-owned", ["group1"]),
+    make_rule(4, "related-events", None),
+]
+
+
+def test_owners_index():
+    index = OwnersIndex(RULES)
+    assert index.owner_kinds == {1: "users", 2: "users", 3: "groups"}
+    assert 4 not in index
+    assert index.get_rule_ids("users", ["user2"]) == {1, 2}
+    assert index.get_rule_ids("users", ["user1", "other"]) == {1}
+    assert index.get_rule_ids("groups", ["group1"]) == {3}
+    assert index.get_rule_ids("groups", ["other"]) == set()
+
+
+async def test_owners_index_context(mocker, make_mocked_message):
+    matches = mocker.spy(ArtifactsOwned, "matches")
+    requester = Mock()
+    requester.distgit.get_project_users = AsyncMock(return_value=["user1"])
+    requester.distgit.get_project_groups = AsyncMock(return_value=[])
+    rule_set = RuleSet(RULES)
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg1", "pkg2"]})
+    context = MessageContext(message, requester, owners_index=rule_set.owners_index)
+
+    assert [await context.is_tracked_by_owners(rule_id) for rule_id in (1, 2, 3, 4)] == [
+        True,
+        False,
+        False,
+        None,
+    ]
+    for rule in RULES[:3]:
+        assert [n async for n in rule.handle(context)] == []
+    matches.assert_not_called()
+    assert requester.distgit.get_project_users.await_count == 2
+    assert requester.distgit.get_project_groups.await_count == 2
+
+
+async def test_owners_index_context_users_only(make_mocked_message):
+    requester = Mock()
+    requester.distgit.get_project_users = AsyncMock(return_value=["user1"])
+    requester.distgit.get_project_groups = AsyncMock(return_value=[])
+    rule_set = RuleSet(RULES)
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg1"]})
+    context = MessageContext(message, requester, owners_index=rule_set.owners_index)
+
+    assert await context.is_tracked_by_owners(1) is True
+    # The groups are not looked up for a rule tracking users
+    requester.distgit.get_project_users.assert_awaited_once_with(project_path="rpms/pkg1")
+    requester.distgit.get_project_groups.assert_not_called()
+
+
+async def test_owners_index_context_concurrent(make_mocked_message):
+    lookups = []
+
+    async def get_owners(project_path):
+        lookups.append(project_path)
+        await asyncio.sleep(0)
+        # Both lookups have started before either one is done
+        assert len(lookups) == 2
+        return ["group1"]
+
+    requester = Mock()
+    requester.distgit.get_project_users = AsyncMock(side_effect=get_owners)
+    requester.distgit.get_project_groups = AsyncMock(side_effect=get_owners)
+    rule_set = RuleSet(RULES)
+    message = make_mocked_message(topic="dummy", body={"packages": ["pkg1"]})
+    context = MessageContext(message, requester, owners_index=rule_set.owners_index)
+
+    results = await asyncio.gather(context.is_tracked_by_owners(1), context.is_tracked_by_owners(3))
+    assert results == [False, True]
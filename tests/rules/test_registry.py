@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+from importlib.metadata import EntryPoint
+
+import pytest
+
+from fmn.rules import registry
+from fmn.rules.filter import Topic
+from fmn.rules.tracking_rules import ArtifactsOwned
+
+
+def test_get_classes():
+    assert registry.get_tracking_rule_class("artifacts-owned") is ArtifactsOwned
+    assert registry.get_filter_class("topic") is Topic
+
+
+def test_entry_points_loaded_once(mocker):
+    entry_points = mocker.patch(
+        "fmn.rules.registry.entry_points",
+        return_value=[
+            EntryPoint(name="topic", value="fmn.rules.filter:Topic", group=registry.FILTERS_GROUP)
+        ],
+    )
+    for _i in range(3):
+        assert registry.get_filter_class("topic") is Topic
+    with pytest.raises(ValueError, match="Unknown filter: applications"):
+        registry.get_filter_class("applications")
+    entry_points.assert_called_once_with(group=registry.FILTERS_GROUP)
+
+
+def test_unknown():
+    with pytest.raises(ValueError, match="Unknown tracking rule: dummy"):
+        registry.get_tracking_rule_class("dummy")
+    with pytest.raises(ValueError, match="Unknown filter: dummy"):
+        registry.get_filter_class("dummy")
@@ -2,13 +2,15 @@
 #
 # SPDX-License-Identifier: MIT
 
+import asyncio
 from unittest.mock import AsyncMock
 
 import pytest
 
-from fmn.backends import FASJSONAsyncProxy, PagureAsyncProxy
+from fmn.backends import FASJSONAsyncProxy, PagureAsyncProxy, get_distgit_proxy, get_fasjson_proxy
+from fmn.backends.pagure_snapshot import PagureSnapshotProxy
 from fmn.core.config import get_settings
-from fmn.rules.requester import Requester
+from fmn.rules.requester import MemoizedRequester, Requester
 
 
 @pytest.fixture
@@ -23,6 +25,21 @@ def test_requester_attributes(mocked_fasjson_proxy):
     assert isinstance(requester.distgit, PagureAsyncProxy)
     assert hasattr(requester, "fasjson")
     assert isinstance(requester.fasjson, FASJSONAsyncProxy)
+    # The proxies are shared
+    assert requester.distgit is get_distgit_proxy()
+    assert requester.fasjson is get_fasjson_proxy()
+
+
+def test_requester_config(mocked_fasjson_proxy):
+    services = get_settings().services.copy(
+        update={
+            "distgit_url": "https://distgit.example.com",
+            "fasjson_url": "https://fasjson.example.com",
+        }
+    )
+    requester = Requester(services)
+    assert requester.distgit.base_url == "https://distgit.example.com"
+    assert requester.fasjson.base_url == "https://fasjson.example.com"
 
 
 async def test_requester_invalidate(mocked_fasjson_proxy):
@@ -34,3 +51,45 @@ async def test_requester_invalidate(mocked_fasjson_proxy):
     await requester.invalidate_on_message(message, db)
     requester.distgit.invalidate_on_message.assert_called_once_with(message, db)
     requester.fasjson.invalidate_on_message.assert_called_once_with(message, db)
+
+
+@pytest.mark.parametrize(
+    "distgit,fasjson,expected",
+    [(False, False, False), (True, False, True), (False, True, True)],
+)
+def test_requester_may_invalidate(mocked_fasjson_proxy, mocker, distgit, fasjson, expected):
+    requester = Requester(get_settings().services)
+    mocker.patch.object(requester.distgit, "may_invalidate", return_value=distgit)
+    mocker.patch.object(requester.fasjson, "may_invalidate", return_value=fasjson)
+    message = object()
+    assert requester.may_invalidate(message) is expected
+    requester.distgit.may_invalidate.assert_called_once_with(message)
+
+
+async def test_memoized_requester(requester, mocker):
+    calls = []
+
+    async def get_user_projects(*, username):
+        calls.append(username)
+        await asyncio.sleep(0)
+        return [username]
+
+    mocker.patch.object(requester.distgit, "get_user_projects", side_effect=get_user_projects)
+    memoized = MemoizedRequester(requester)
+    results = await asyncio.gather(
+        memoized.distgit.get_user_projects(username="user1"),
+        memoized.distgit.get_user_projects(username="user1"),
+        memoized.distgit.get_user_projects(username="user2"),
+    )
+    assert results == [["user1"], ["user1"], ["user2"]]
+    assert await memoized.distgit.get_user_projects(username="user1") == ["user1"]
+    assert sorted(calls) == ["user1", "user2"]
+    # Other attributes are passed through
+    assert memoized.distgit.base_url == requester.distgit.base_url
+
+
+def test_requester_distgit_snapshot(mocked_fasjson_proxy):
+    services = get_settings().services.copy(update={"distgit_snapshot": True})
+    requester = Requester(services)
+    assert isinstance(requester.distgit, PagureSnapshotProxy)
+    assert isinstance(requester.distgit._proxy, PagureAsyncProxy)
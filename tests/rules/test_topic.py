@@ -0,0 +1,65 @@
+# SPDX-FileCopyrightText: Contributors to the Fedora Project
+#
+# SPDX-License-Identifier: MIT
+
+import pickle
+from fnmatch import fnmatchcase
+
+import pytest
+
+from fmn.rules.topic import TopicMatcher
+
+PATTERNS = [
+    "org.fedoraproject.prod.bodhi.update.comment",
+    "org.fedoraproject.*",
+    "*.comment",
+    "*bodhi*",
+    "org.*.bodhi.*",
+    "*",
+    "*.update.comment*",
+    "org.fedoraproject.prod.bodhi.update.comment*",
+    "*org.fedoraproject.prod.bodhi.update.comment",
+    "org.fedoraproject.prod.bodhi.update.comment.long*",
+    "org.fedoraproject.prod.?odhi.*",
+    "[ab]*",
+]
+
+
+@pytest.mark.parametrize(
+    "topic",
+    [
+        "org.fedoraproject.prod.bodhi.update.comment",
+        "org.fedoraproject.prod.koji.build.state.change",
+        "abc",
+        "x.comment",
+        "",
+    ],
+)
+def test_topic_matcher(topic):
+    matcher = TopicMatcher(PATTERNS)
+    expected = {pattern for pattern in PATTERNS if fnmatchcase(topic, pattern)}
+    assert matcher.match(topic) == expected
+
+
+def test_topic_matcher_pickle():
+    matcher = TopicMatcher(PATTERNS)
+    unpickled = pickle.loads(pickle.dumps(matcher))  # noqa: S301
+    assert unpickled.patterns == matcher.patterns
+    topic = "org.fedoraproject.prod.bodhi.update.comment"
+    assert unpickled.match(topic) == matcher.match(topic)
+
+
+def test_topic_matcher_empty():
+    assert TopicMatcher().match("dummy") == set()
+
+
+def test_topic_matcher_duplicate():
+    matcher = TopicMatcher(["org.*.bodhi.*", "org.fedoraproject.*"])
+    matcher.add("org.*.bodhi.*")
+    matcher.add("org.fedoraproject.*")
+    assert len(matcher._regexes) == 1
+    assert matcher._prefixes == {len("org.fedoraproject."): {"org.fedoraproject."}}
+    assert matcher.match("org.fedoraproject.prod.bodhi.update") == {
+        "org.*.bodhi.*",
+        "org.fedoraproject.*",
+    }
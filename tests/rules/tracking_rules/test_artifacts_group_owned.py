@@ -29,8 +29,23 @@ async def test_artifacts_group_owned_cache(requester, cache):
     tr = ArtifactsGroupOwned(requester, ["group1"], owner="testuser")
     await tr.prime_cache(cache)
     assert cache == Tracked(
-        packages=set(["rpms/rpms-1", "rpms/rpms-2"]),
-        containers=set(["containers/containers-1", "containers/containers-2"]),
-        modules=set(["modules/modules-1", "modules/modules-2"]),
-        flatpaks=set(["flatpaks/flatpaks-1", "flatpaks/flatpaks-2"]),
+        packages=set(["rpms-1", "rpms-2"]),
+        containers=set(["containers-1", "containers-2"]),
+        modules=set(["modules-1", "modules-2"]),
+        flatpaks=set(["flatpaks-1", "flatpaks-2"]),
     )
+
+
+async def test_artifacts_group_owned_cache_multiple_groups(requester, cache):
+    async def get_group_projects(*, name, acl):
+        return [
+            {"namespace": "rpms", "name": f"{name}-pkg", "access_groups": {"commit": [name]}},
+            # Another group has access to this project
+            {"namespace": "rpms", "name": "other-pkg", "access_groups": {"commit": ["other"]}},
+        ]
+
+    requester.distgit.get_group_projects.side_effect = get_group_projects
+    tr = ArtifactsGroupOwned(requester, ["group1", "group2"], "testuser")
+    await tr.prime_cache(cache)
+    assert requester.distgit.get_group_projects.await_count == 2
+    assert cache == Tracked(packages={"group1-pkg", "group2-pkg"})
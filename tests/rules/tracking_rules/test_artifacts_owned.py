@@ -36,3 +36,14 @@ async def test_artifacts_owned_cache(requester, cache):
         modules=set(["modules-1", "modules-2"]),
         flatpaks=set(["flatpaks-1", "flatpaks-2"]),
     )
+
+
+async def test_artifacts_owned_cache_multiple_users(requester, cache):
+    async def get_user_projects(*, username):
+        return [{"namespace": "rpms", "name": f"{username}-pkg"}]
+
+    requester.distgit.get_user_projects.side_effect = get_user_projects
+    tr = ArtifactsOwned(requester, ["user1", "user2", "user3"], "testuser")
+    await tr.prime_cache(cache)
+    assert requester.distgit.get_user_projects.await_count == 3
+    assert cache == Tracked(packages={"user1-pkg", "user2-pkg", "user3-pkg"})